@@ -0,0 +1,565 @@
+"""
+Fake Daemons
+
+in-process stand-ins of the docker engine api and of supervisor's xml-rpc
+interface, sharing one fake host, so the agent can be benchmarked at any
+instance count without real containers
+
+every container's pid is the benchmark's own pid, so psutil has a real
+process to read
+"""
+
+import collections
+import json
+import os
+import queue
+import re
+import socketserver
+import struct
+import threading
+import time
+import urllib.parse
+import uuid
+import xmlrpc.client
+import xmlrpc.server
+from http.server import BaseHTTPRequestHandler, ThreadingHTTPServer
+
+
+__all__ = ["FakeHost", "FakeDocker", "FakeSupervisor"]
+
+# supervisor states and fault codes
+STOPPED, RUNNING = (0, "STOPPED"), (20, "RUNNING")
+BAD_NAME, ALREADY_STARTED, NOT_RUNNING, ALREADY_ADDED = 10, 60, 70, 90
+
+
+class FakeHost(object):
+    """
+    Containers, images and supervisor processes of one fake host
+
+    :param latency: seconds every backend call takes
+    """
+
+    def __init__(self, conf_dir, latency=0):
+        self.conf_dir = conf_dir
+        self.latency = latency
+        self.lock = threading.RLock()
+        self.containers = {}
+        self.images = set()
+        self.processes = {}
+        self.loaded = set()
+        self.calls = collections.Counter()
+        self._subscribers = []
+
+    def call(self, name):
+        """count one round trip to a backend, as ``name``"""
+        self.count(name)
+        if self.latency:
+            time.sleep(self.latency)
+
+    def count(self, name):
+        with self.lock:
+            self.calls[name] += 1
+
+    def reset_calls(self):
+        with self.lock:
+            calls, self.calls = self.calls, collections.Counter()
+        return calls
+
+    # docker side
+
+    def subscribe(self):
+        events = queue.Queue()
+        with self.lock:
+            self._subscribers.append(events)
+        return events
+
+    def unsubscribe(self, events):
+        with self.lock:
+            self._subscribers.remove(events)
+
+    def emit(self, status, container):
+        event = dict(
+            status=status,
+            id=container["Id"],
+            time=int(time.time()),
+            Type="container",
+            Action=status,
+            Actor=dict(
+                ID=container["Id"],
+                Attributes=dict(name=container["Name"].lstrip("/"))
+            )
+        )
+        with self.lock:
+            for events in self._subscribers:
+                events.put(event)
+
+    def run_container(self, name, image, running=True):
+        cid = uuid.uuid4().hex + uuid.uuid4().hex
+        container = dict(
+            Id=cid,
+            Name="/{0}".format(name),
+            Image=image,
+            Created=int(time.time()),
+            State=dict(
+                Running=running,
+                Restarting=False,
+                Pid=os.getpid() if running else 0,
+                ExitCode=0,
+                StartedAt="2015-07-01T00:00:00Z",
+                FinishedAt="0001-01-01T00:00:00Z"
+            ),
+            # (stream, unix time, data) the container wrote
+            Output=[]
+        )
+        with self.lock:
+            self.containers[cid] = container
+        self.emit("create", container)
+        if running:
+            self.emit("start", container)
+        return container
+
+    def find_container(self, id_or_name):
+        with self.lock:
+            if id_or_name in self.containers:
+                return self.containers[id_or_name]
+            for container in self.containers.values():
+                if container["Name"].lstrip("/") == id_or_name:
+                    return container
+        return None
+
+    def write_output(self, id_or_name, stream, data, at=None):
+        """the container ``id_or_name`` writes ``data`` to ``stream``"""
+        container = self.find_container(id_or_name)
+        with self.lock:
+            container["Output"].append(
+                (stream, time.time() if at is None else at, data)
+            )
+
+    def remove_container(self, container):
+        with self.lock:
+            if self.containers.pop(container["Id"], None) is None:
+                return
+        self.emit("die", container)
+        self.emit("destroy", container)
+
+    # supervisor side
+
+    def add_process(self, name, running=False):
+        state, statename = RUNNING if running else STOPPED
+        with self.lock:
+            self.processes[name] = dict(
+                name=name,
+                group=name,
+                state=state,
+                statename=statename,
+                pid=os.getpid() if running else 0,
+                start=int(time.time()),
+                stop=0,
+                now=int(time.time()),
+                description="",
+                spawnerr="",
+                exitstatus=0,
+                logfile="",
+                stdout_logfile="",
+                stderr_logfile=""
+            )
+            self.loaded.add(name)
+
+    def populate(self, instance_ids, image):
+        """deploy ``instance_ids``, all running"""
+        self.images.add(image)
+        for instance_id in instance_ids:
+            self.add_process(instance_id, running=True)
+            self.run_container(instance_id, image)
+
+
+def rfc3339_nano(at):
+    """docker's timestamp of unix time ``at``, trailing zeros trimmed"""
+    seconds, nanos = divmod(int(round(at * 10 ** 9)), 10 ** 9)
+    fraction = "{0:09d}".format(nanos).rstrip("0")
+    return time.strftime("%Y-%m-%dT%H:%M:%S", time.gmtime(seconds)) + \
+        ("." + fraction if fraction else "") + "Z"
+
+
+class DockerHandler(BaseHTTPRequestHandler):
+    protocol_version = "HTTP/1.1"
+
+    ROUTES = (
+        ("GET", r"/info$", "info"),
+        ("GET", r"/version$", "version"),
+        ("GET", r"/containers/json$", "containers"),
+        ("POST", r"/containers/create$", "create_container"),
+        ("GET", r"/containers/(?P<cid>[^/]+)/json$", "inspect_container"),
+        ("POST", r"/containers/(?P<cid>[^/]+)/start$", "start"),
+        ("POST", r"/containers/(?P<cid>[^/]+)/stop$", "stop"),
+        ("POST", r"/containers/(?P<cid>[^/]+)/kill$", "kill"),
+        ("DELETE", r"/containers/(?P<cid>[^/]+)$", "remove_container"),
+        ("POST", r"/images/create$", "pull"),
+        ("GET", r"/images/(?P<name>.+)/json$", "inspect_image"),
+        ("GET", r"/containers/(?P<cid>[^/]+)/logs$", "logs"),
+        ("GET", r"/events$", "events"),
+    )
+
+    def log_message(self, *args):
+        pass
+
+    @property
+    def host(self):
+        return self.server.host
+
+    def do_GET(self):
+        self.dispatch("GET")
+
+    def do_POST(self):
+        self.dispatch("POST")
+
+    def do_DELETE(self):
+        self.dispatch("DELETE")
+
+    def dispatch(self, method):
+        url = urllib.parse.urlsplit(self.path)
+        path = re.sub(r"^/v[\d.]+", "", url.path)
+        self.query = dict(urllib.parse.parse_qsl(url.query))
+        length = int(self.headers.get("Content-Length") or 0)
+        body = self.rfile.read(length) if length else b""
+        self.body = json.loads(body.decode("utf-8")) if body else {}
+        for route_method, pattern, name in self.ROUTES:
+            match = re.match(pattern, path)
+            if route_method == method and match:
+                self.host.call("docker.{0}".format(name))
+                return getattr(self, name)(**match.groupdict())
+        self.reply(404, dict(message="no route {0} {1}".format(method, path)))
+
+    def reply(self, status, payload=None):
+        body = json.dumps(payload).encode("utf-8") if payload is not None \
+            else b""
+        self.send_response(status)
+        self.send_header("Content-Type", "application/json")
+        self.send_header("Content-Length", str(len(body)))
+        self.end_headers()
+        self.wfile.write(body)
+
+    def reply_stream(self, chunks):
+        self.send_response(200)
+        self.send_header("Content-Type", "application/json")
+        self.send_header("Transfer-Encoding", "chunked")
+        self.end_headers()
+        for chunk in chunks:
+            data = json.dumps(chunk).encode("utf-8") + b"\r\n"
+            self.wfile.write("{0:x}\r\n".format(len(data)).encode("ascii"))
+            self.wfile.write(data + b"\r\n")
+            self.wfile.flush()
+        self.wfile.write(b"0\r\n\r\n")
+
+    def container_or_404(self, cid):
+        container = self.host.find_container(cid)
+        if container is None:
+            self.reply(404, dict(message="no such container: " + cid))
+        return container
+
+    def info(self):
+        self.reply(200, dict(Containers=len(self.host.containers)))
+
+    def version(self):
+        self.reply(200, dict(ApiVersion="1.12", Version="1.0.0"))
+
+    def containers(self):
+        with self.host.lock:
+            listing = [
+                dict(
+                    Id=container["Id"],
+                    Names=[container["Name"]],
+                    Image=container["Image"],
+                    Created=container["Created"],
+                    Status="Up 1 hours" if container["State"]["Running"]
+                    else "Exited (0) 1 hours ago"
+                )
+                for container in self.host.containers.values()
+                if container["State"]["Running"] or self.query.get("all")
+            ]
+        self.reply(200, listing)
+
+    def create_container(self):
+        name = self.query.get("name")
+        if name and self.host.find_container(name) is not None:
+            return self.reply(409, dict(message="conflict: " + name))
+        container = self.host.run_container(
+            name or uuid.uuid4().hex[:12], self.body.get("Image"),
+            running=False
+        )
+        self.reply(201, dict(Id=container["Id"], Warnings=None))
+
+    def inspect_container(self, cid):
+        container = self.container_or_404(cid)
+        if container is not None:
+            self.reply(200, container)
+
+    def start(self, cid):
+        container = self.container_or_404(cid)
+        if container is None:
+            return
+        container["State"].update(Running=True, Pid=os.getpid())
+        self.host.emit("start", container)
+        self.reply(204)
+
+    def stop(self, cid):
+        container = self.container_or_404(cid)
+        if container is None:
+            return
+        container["State"].update(
+            Running=False, Pid=0, FinishedAt="2015-07-01T01:00:00Z"
+        )
+        self.host.emit("die", container)
+        self.reply(204)
+
+    def kill(self, cid):
+        container = self.container_or_404(cid)
+        if container is not None:
+            self.host.remove_container(container)
+            self.reply(204)
+
+    def remove_container(self, cid):
+        container = self.container_or_404(cid)
+        if container is not None:
+            self.host.remove_container(container)
+            self.reply(204)
+
+    def logs(self, cid):
+        """the output so far, docker would follow a running container"""
+        container = self.container_or_404(cid)
+        if container is None:
+            return
+        since = int(self.query.get("since", 0))
+        streams = [
+            stream for stream in ("stdout", "stderr")
+            if self.query.get(stream) == "1"
+        ]
+        frames = []
+        with self.host.lock:
+            output = list(container["Output"])
+        for stream, at, data in output:
+            if stream not in streams or at < since:
+                continue
+            if self.query.get("timestamps") == "1":
+                data = rfc3339_nano(at).encode("ascii") + b" " + data
+            # multiplexed stream: type, 3 zero bytes, length
+            frames.append(struct.pack(
+                ">BxxxL", 1 if stream == "stdout" else 2, len(data)
+            ) + data)
+        body = b"".join(frames)
+        self.send_response(200)
+        self.send_header("Content-Type", "application/vnd.docker.raw-stream")
+        self.send_header("Content-Length", str(len(body)))
+        self.end_headers()
+        self.wfile.write(body)
+
+    def pull(self):
+        image = "{0}:{1}".format(
+            self.query.get("fromImage"), self.query.get("tag", "latest")
+        )
+        self.host.images.add(image)
+        self.reply_stream([
+            dict(status="Pulling from {0}".format(image)),
+            dict(status="Download complete"),
+            dict(status="Status: Downloaded newer image for " + image),
+        ])
+
+    def inspect_image(self, name):
+        if name not in self.host.images:
+            return self.reply(404, dict(message="no such image: " + name))
+        self.reply(200, dict(Id=uuid.uuid4().hex, RepoTags=[name]))
+
+    def events(self):
+        events = self.host.subscribe()
+
+        def stream():
+            while True:
+                try:
+                    yield events.get(timeout=1)
+                except queue.Empty:
+                    if self.server.closed:
+                        return
+        try:
+            self.reply_stream(stream())
+        except OSError:
+            # the agent hung up
+            pass
+        finally:
+            self.host.unsubscribe(events)
+
+
+class FakeDocker(object):
+    """
+    Docker engine api on ``127.0.0.1``, serving the calls the agent makes
+    """
+
+    def __init__(self, host):
+        self.server = ThreadingHTTPServer(("127.0.0.1", 0), DockerHandler)
+        self.server.daemon_threads = True
+        self.server.host = host
+        self.server.closed = False
+
+    @property
+    def url(self):
+        return "tcp://127.0.0.1:{0}".format(self.server.server_address[1])
+
+    def start(self):
+        runner = threading.Thread(
+            target=self.server.serve_forever, name="fake-docker"
+        )
+        runner.daemon = True
+        runner.start()
+
+    def stop(self):
+        self.server.closed = True
+        self.server.shutdown()
+
+
+class SupervisorRPC(object):
+    """the ``supervisor.*`` namespace of supervisor's rpc interface"""
+
+    def __init__(self, host):
+        self.host = host
+
+    def _process(self, name):
+        process = self.host.processes.get(name.split(":")[-1])
+        if process is None:
+            raise xmlrpc.client.Fault(BAD_NAME, "BAD_NAME: {0}".format(name))
+        return process
+
+    def getState(self):
+        return dict(statecode=1, statename="RUNNING")
+
+    def getAllProcessInfo(self):
+        with self.host.lock:
+            return [dict(process) for process in self.host.processes.values()]
+
+    def getProcessInfo(self, name):
+        with self.host.lock:
+            return dict(self._process(name))
+
+    def reloadConfig(self):
+        confs = set(
+            name[:-len(".ini")] for name in os.listdir(self.host.conf_dir)
+            if name.endswith(".ini")
+        )
+        with self.host.lock:
+            added = sorted(confs - self.host.loaded)
+            removed = sorted(self.host.loaded - confs)
+        return [[added, [], removed]]
+
+    def addProcessGroup(self, name):
+        with self.host.lock:
+            if name in self.host.processes:
+                raise xmlrpc.client.Fault(
+                    ALREADY_ADDED, "ALREADY_ADDED: {0}".format(name)
+                )
+            self.host.add_process(name)
+        return True
+
+    def removeProcessGroup(self, name):
+        with self.host.lock:
+            process = self._process(name)
+            if process["state"] == RUNNING[0]:
+                raise xmlrpc.client.Fault(91, "STILL_RUNNING: " + name)
+            del self.host.processes[name]
+            self.host.loaded.discard(name)
+        return True
+
+    def startProcess(self, name, wait=True):
+        with self.host.lock:
+            process = self._process(name)
+            if process["state"] == RUNNING[0]:
+                raise xmlrpc.client.Fault(
+                    ALREADY_STARTED, "ALREADY_STARTED: {0}".format(name)
+                )
+            process.update(
+                state=RUNNING[0], statename=RUNNING[1], pid=os.getpid()
+            )
+        # supervisor runs ``docker run`` which creates the container
+        self.host.run_container(process["name"], "fake-image")
+        return True
+
+    def stopProcess(self, name, wait=True):
+        with self.host.lock:
+            process = self._process(name)
+            if process["state"] != RUNNING[0]:
+                raise xmlrpc.client.Fault(
+                    NOT_RUNNING, "NOT_RUNNING: {0}".format(name)
+                )
+            process.update(state=STOPPED[0], statename=STOPPED[1], pid=0)
+        # ``docker run --rm`` removes the container when it exits
+        container = self.host.find_container(process["name"])
+        if container is not None:
+            self.host.remove_container(container)
+        return True
+
+
+class CountingRequestHandler(xmlrpc.server.SimpleXMLRPCRequestHandler):
+    # supervisor keeps connections alive
+    protocol_version = "HTTP/1.1"
+
+    def log_message(self, *args):
+        pass
+
+    def do_POST(self):
+        # one request is one round trip, even if it is a multicall
+        self.server.host.call("supervisor")
+        xmlrpc.server.SimpleXMLRPCRequestHandler.do_POST(self)
+
+
+class CountingXMLRPCServer(socketserver.ThreadingMixIn,
+                           xmlrpc.server.SimpleXMLRPCServer):
+    daemon_threads = True
+
+    def _dispatch(self, method, params):
+        self.host.count(method)
+        return super(CountingXMLRPCServer, self)._dispatch(method, params)
+
+
+class FakeSupervisor(object):
+    """
+    Supervisor xml-rpc interface on ``127.0.0.1``, with ``system.multicall``
+    """
+
+    def __init__(self, host):
+        self.server = CountingXMLRPCServer(
+            ("127.0.0.1", 0), requestHandler=CountingRequestHandler,
+            logRequests=False, allow_none=True
+        )
+        self.server.host = host
+        self.server.register_instance(
+            _Namespaces(supervisor=SupervisorRPC(host))
+        )
+        self.server.register_multicall_functions()
+
+    @property
+    def url(self):
+        return "http://127.0.0.1:{0}/RPC2".format(
+            self.server.server_address[1]
+        )
+
+    def start(self):
+        runner = threading.Thread(
+            target=self.server.serve_forever, name="fake-supervisor"
+        )
+        runner.daemon = True
+        runner.start()
+
+    def stop(self):
+        self.server.shutdown()
+
+
+class _Namespaces(object):
+    """resolve dotted ``namespace.method`` names of registered objects"""
+
+    def __init__(self, **namespaces):
+        self._namespaces = namespaces
+
+    def _dispatch(self, method, params):
+        namespace, _, name = method.partition(".")
+        target = self._namespaces.get(namespace)
+        if target is None or name.startswith("_") or \
+                not hasattr(target, name):
+            raise xmlrpc.client.Fault(1, "UNKNOWN_METHOD: " + method)
+        return getattr(target, name)(*params)
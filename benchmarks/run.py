@@ -0,0 +1,322 @@
+#!/usr/bin/env python
+"""
+Agent Benchmarks
+
+drives the agent's instance api against fake docker and supervisor
+daemons pre-populated with 10, 100 and 1000 instances, and reports
+throughput, p50/p99 latency and backend round trips per operation
+
+every host size runs in its own process, the agent's clients and
+background threads are per process
+
+Usage::
+
+    python benchmarks/run.py
+    python benchmarks/run.py --sizes 100 --repeat 20 --latency-ms 1
+    python benchmarks/run.py --json baseline.json
+"""
+
+import argparse
+import concurrent.futures
+import json
+import os
+import subprocess
+import sys
+import tempfile
+import time
+
+__curdir__ = os.path.dirname(os.path.realpath(__file__))
+sys.path.insert(0, os.path.dirname(__curdir__))
+
+import fakes  # noqa
+
+
+IMAGE = "registry.bench.local/bench/app:c0ffee"
+CONFIG = """\
+HOSTNAME = "bench"
+HOST_IP = "127.0.0.1"
+DOCKER_URL = {docker_url!r}
+DOCKER_VERSION = "1.12"
+DOCKER_TIMEOUT = 10
+SUPERVISOR_SERVER_URL = {supervisor_url!r}
+SUPERVISOR_CONF_DIR = {conf_dir!r}
+START_TIMEOUT = 10
+STOP_TIMEOUT = 10
+PAAS_DOMAIN = "bench.local"
+PLAYGROUND = {playground!r}
+LOG_MAX_MB = 1
+LOG_BACKUPS = 1
+PAAS_USER = "chulai"
+MEMORY_LIMIT = 512
+# admit any number of fake instances
+MEMORY_OVERCOMMIT_RATIO = 1000000
+# keep background work out of the measurements, the benchmark samples
+# metrics itself
+HEALTH_CHECK_INTERVAL = 0
+METRICS_INTERVAL = 3600
+REAPER_INTERVAL = 3600
+"""
+POLL_INTERVAL = 0.005
+# requests at once of concurrent operations, as threads of one worker
+CONCURRENCY = 32
+
+
+def percentile(values, q):
+    values = sorted(values)
+    if not values:
+        return 0.0
+    return values[min(len(values) - 1, int(round(q * (len(values) - 1))))]
+
+
+def make_app(tmp_dir, host, docker_url, supervisor_url):
+    from chulai_agent import create_app
+
+    playground = os.path.join(tmp_dir, "playground")
+    os.makedirs(playground)
+    config_path = os.path.join(tmp_dir, "config.cfg")
+    with open(config_path, "wt") as config_f:
+        config_f.write(CONFIG.format(
+            docker_url=docker_url,
+            supervisor_url=supervisor_url,
+            conf_dir=host.conf_dir,
+            playground=playground
+        ))
+    return create_app(config_path)
+
+
+def seed(host, instance_ids):
+    """deploy ``instance_ids`` on the fake host, behind the agent's back"""
+    from chulai_agent.instance.docker_instance import DockerInstance
+    from chulai_agent.instance.registry import registry
+
+    for index, instance_id in enumerate(instance_ids):
+        instance = DockerInstance(instance_id)
+        for dir_path in instance.dirs_to_make:
+            os.makedirs(dir_path)
+        supervisor_conf, _ = instance.make_supervisor_conf(
+            "app-{0}".format(index % 10), "c0ffee", IMAGE, {}, "rails", 0
+        )
+        with open(instance.conf_path, "wt") as conf_f:
+            conf_f.write(supervisor_conf)
+    host.populate(instance_ids, IMAGE)
+    registry.rebuild()
+
+
+def spec(instance_id, app_id="bench"):
+    return {
+        "instance-id": instance_id,
+        "app-id": app_id,
+        "commit": "c0ffee",
+        "image-tag": IMAGE,
+        "environments": {},
+        "worker": "rails",
+        "port": 0
+    }
+
+
+def wait_job(client, response):
+    """Returns the finished job of a 202 ``response``"""
+    if response.status_code != 202:
+        raise RuntimeError(response.data)
+    location = response.headers["Location"]
+    while True:
+        job = json.loads(client.get(location).data.decode("utf-8"))["job"]
+        if job["state"] in ("success", "error"):
+            if job["state"] == "error":
+                raise RuntimeError(job["error"])
+            return job
+        time.sleep(POLL_INTERVAL)
+
+
+def measure(host, size, operation, runs, call):
+    """
+    Run ``call(run)`` ``runs`` times, Returns a result row
+    """
+    latencies = []
+    host.reset_calls()
+    started = time.time()
+    for run in range(runs):
+        begin = time.time()
+        call(run)
+        latencies.append(time.time() - begin)
+    elapsed = time.time() - started
+    calls = host.reset_calls()
+    docker_calls = sum(
+        hits for name, hits in calls.items() if name.startswith("docker.")
+    )
+    return dict(
+        instances=size,
+        operation=operation,
+        runs=runs,
+        throughput=runs / elapsed if elapsed else 0.0,
+        p50=percentile(latencies, 0.5),
+        p99=percentile(latencies, 0.99),
+        docker_calls=docker_calls / runs,
+        supervisor_calls=calls["supervisor"] / runs,
+        calls={name: hits / runs for name, hits in sorted(calls.items())}
+    )
+
+
+def bench_host(size, repeat, deploys, latency):
+    """
+    Benchmark one host of ``size`` instances, Returns result rows
+    """
+    tmp_dir = tempfile.mkdtemp(prefix="chulai-bench-")
+    conf_dir = os.path.join(tmp_dir, "supervisor.d")
+    os.makedirs(conf_dir)
+    host = fakes.FakeHost(conf_dir, latency)
+    docker_daemon = fakes.FakeDocker(host)
+    supervisor_daemon = fakes.FakeSupervisor(host)
+    docker_daemon.start()
+    supervisor_daemon.start()
+
+    app = make_app(tmp_dir, host, docker_daemon.url, supervisor_daemon.url)
+    from chulai_agent.instance.sampler import metrics_sampler
+
+    instance_ids = ["bench-{0:04d}".format(index) for index in range(size)]
+    seed(host, instance_ids)
+    client = app.test_client()
+    pool = concurrent.futures.ThreadPoolExecutor(CONCURRENCY)
+
+    def get(url):
+        response = client.get(url)
+        if response.status_code != 200:
+            raise RuntimeError(response.data)
+        return response
+
+    def put(instance_id, body):
+        response = client.put(
+            "/instances/{0}".format(instance_id), data=json.dumps(body),
+            content_type="application/json"
+        )
+        if response.status_code != 200:
+            raise RuntimeError(response.data)
+        return response
+
+    # warm up the worker: clients, container index and sampler, which
+    # needs a priming pass before its first sample
+    get("/instances?per_page=1000")
+    metrics_sampler.sample_all()
+    metrics_sampler.sample_all()
+
+    rows = [
+        measure(host, size, "list", repeat, lambda run: get(
+            "/instances?per_page=1000"
+        )),
+        measure(host, size, "list (stats=0)", repeat, lambda run: get(
+            "/instances?per_page=1000&stats=0"
+        )),
+        measure(host, size, "stats", repeat, lambda run: get(
+            "/instances/{0}".format(instance_ids[run % size])
+        )),
+        measure(host, size, "stats x{0}".format(CONCURRENCY), repeat,
+                lambda run: list(pool.map(get, [
+                    "/instances/{0}".format(instance_ids[index % size])
+                    for index in range(CONCURRENCY)
+                ]))),
+        measure(host, size, "metrics", repeat, lambda run: get("/metrics")),
+        measure(host, size, "capacity", repeat, lambda run: get(
+            "/host/capacity"
+        )),
+        measure(host, size, "apply unchanged", repeat, lambda run: put(
+            instance_ids[run % size],
+            spec(instance_ids[run % size], "app-{0}".format(run % size % 10))
+        )),
+    ]
+
+    new_ids = ["bench-new-{0:04d}".format(index) for index in range(deploys)]
+    rows.append(measure(host, size, "deploy", deploys, lambda run: wait_job(
+        client, client.post(
+            "/instances/{0}".format(new_ids[run]),
+            data=json.dumps(spec(new_ids[run])),
+            content_type="application/json"
+        )
+    )))
+    rows.append(measure(host, size, "teardown", deploys, lambda run: wait_job(
+        client, client.delete("/instances/{0}".format(new_ids[run]))
+    )))
+
+    def batch(method, body):
+        response = client.open(
+            "/instances:batch", method=method, data=json.dumps(body),
+            content_type="application/json"
+        )
+        results = json.loads(response.data.decode("utf-8"))["results"]
+        failed = [
+            result for result in results if result["status"] != "success"
+        ]
+        if failed:
+            raise RuntimeError(failed)
+
+    rows.append(measure(host, size, "batch deploy", 1, lambda run: batch(
+        "POST", dict(instances=[spec(instance_id) for instance_id in new_ids])
+    )))
+    rows.append(measure(host, size, "batch teardown", 1, lambda run: batch(
+        "DELETE", dict(ids=new_ids)
+    )))
+
+    docker_daemon.stop()
+    supervisor_daemon.stop()
+    return rows
+
+
+def report(rows):
+    header = (
+        "{0:>9} {1:<16} {2:>5} {3:>10} {4:>9} {5:>9} {6:>8} {7:>8}".format(
+            "instances", "operation", "runs", "ops/s", "p50 ms", "p99 ms",
+            "docker", "superv"
+        )
+    )
+    print(header)
+    print("-" * len(header))
+    for row in rows:
+        print(
+            "{instances:>9} {operation:<16} {runs:>5} {throughput:>10.1f} "
+            "{p50_ms:>9.2f} {p99_ms:>9.2f} {docker_calls:>8.1f} "
+            "{supervisor_calls:>8.1f}".format(
+                p50_ms=row["p50"] * 1000, p99_ms=row["p99"] * 1000, **row
+            )
+        )
+    print("\ndocker / superv: backend round trips per operation")
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__.split("\n\n")[0])
+    parser.add_argument("--sizes", default="10,100,1000",
+                        help="comma separated instance counts")
+    parser.add_argument("--repeat", type=int, default=50,
+                        help="runs of each read operation")
+    parser.add_argument("--deploys", type=int, default=5,
+                        help="instances deployed and torn down per host")
+    parser.add_argument("--latency-ms", type=float, default=0,
+                        help="latency of every fake backend round trip")
+    parser.add_argument("--json", help="also write result rows here")
+    parser.add_argument("--size", type=int, help=argparse.SUPPRESS)
+    args = parser.parse_args()
+
+    if args.size is not None:
+        # one host, in a fresh process
+        rows = bench_host(
+            args.size, args.repeat, args.deploys, args.latency_ms / 1000.0
+        )
+        json.dump(rows, sys.stdout)
+        return
+
+    rows = []
+    for size in [int(size) for size in args.sizes.split(",") if size]:
+        output = subprocess.check_output([
+            sys.executable, os.path.realpath(__file__),
+            "--size", str(size),
+            "--repeat", str(args.repeat),
+            "--deploys", str(args.deploys),
+            "--latency-ms", str(args.latency_ms),
+        ])
+        rows.extend(json.loads(output.decode("utf-8")))
+    report(rows)
+    if args.json:
+        with open(args.json, "wt") as json_f:
+            json.dump(rows, json_f, indent=2, sort_keys=True)
+
+
+if __name__ == "__main__":
+    main()
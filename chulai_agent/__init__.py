@@ -4,7 +4,7 @@ from flask import Flask
 from flask import jsonify
 
 
-__all__ = ["create_app"]
+__all__ = ["create_app", "start_background"]
 logger = logging.getLogger(__name__)
 
 
@@ -15,13 +15,58 @@ def create_app(config_path):
     from .agent import agent
     agent.init_app(app)
 
+    from .timings import timings
+    timings.init_app(app)
+
     from .clients import docker_client, supervisor_client
     docker_client.init_app(app)
     supervisor_client.init_app(app)
 
+    from .instance.registry import registry
+    registry.init_app(app)
+
+    from .instance.counters import counters
+    counters.init_app(app)
+
+    from .instance.events import event_journal
+    event_journal.init_app(app)
+
+    from .instance.capacity import capacity
+    capacity.init_app(app)
+
+    from .instance.disk import disk_usage
+    disk_usage.init_app(app)
+
+    from .instance.cgroup import cgroup_stats
+    cgroup_stats.init_app(app)
+
+    from .instance.sampler import metrics_sampler
+    metrics_sampler.init_app(app)
+
+    from .instance.health import health_checker
+    health_checker.init_app(app)
+
+    from .instance.reaper import reaper
+    reaper.init_app(app)
+
+    from .instance.compactor import log_compactor
+    log_compactor.init_app(app)
+
+    from .instance.reloader import reloader
+    reloader.init_app(app)
+
+    from .job.manager import job_manager
+    job_manager.init_app(app)
+
     from .instance.api import instance_api
     app.register_blueprint(instance_api)
 
+    from .job.api import job_api
+    app.register_blueprint(job_api)
+
+    from .misc_api import misc_api
+    app.register_blueprint(misc_api)
+
     @app.errorhandler(400)
     def handle_400(error):
         message = "missing arguments: {0}".format(error.message)
@@ -33,4 +78,31 @@ def create_app(config_path):
         logger.error(message)
         return response
 
+    # servers without a post fork hook start it on the first request
+    app.before_first_request(start_background)
     return app
+
+
+def start_background():
+    """
+    Start the background work of this process, the singletons run it or
+    compete for the host lock to lead it, call it in every serving process
+    after fork
+    """
+    from .instance.reaper import reaper
+    reaper.ensure_started()
+
+    from .instance.disk import disk_usage
+    disk_usage.ensure_started()
+
+    from .instance.compactor import log_compactor
+    log_compactor.ensure_started()
+
+    from .instance.health import health_checker
+    health_checker.ensure_started()
+
+    from .instance.sampler import metrics_sampler
+    metrics_sampler.ensure_started()
+
+    from .instance.runtime import get_runtime
+    get_runtime().ensure_started()
@@ -1,5 +1,9 @@
+import contextlib
+import fcntl
 import os
 
+from .errors import AgentError
+
 
 class Agent(object):
     def __init__(self):
@@ -10,8 +14,12 @@ class Agent(object):
         self._log_backups = None
         self._start_timeout = None
         self._stop_timeout = None
+        self._start_retries = 3
         self._mem_limit = None
         self._playground = None
+        self._stats_backend = "psutil"
+        self._runtime = "supervisor"
+        self._lock_dir = None
 
     def init_app(self, app):
         self._hostname = app.config["HOSTNAME"]
@@ -21,9 +29,16 @@ class Agent(object):
         self._log_backups = app.config["LOG_BACKUPS"]
         self._start_timeout = app.config["START_TIMEOUT"]
         self._stop_timeout = app.config["STOP_TIMEOUT"]
+        self._start_retries = app.config.get("START_RETRIES", 3)
         self._mem_limit = app.config["MEMORY_LIMIT"]
         self._paas_user = app.config["PAAS_USER"]
         self.playground = app.config["PLAYGROUND"]
+        self._stats_backend = app.config.get("STATS_BACKEND", "psutil")
+        self._runtime = app.config.get("RUNTIME", "supervisor")
+        self._lock_dir = app.config.get(
+            "LOCK_DIR", os.path.join(self.playground, ".locks")
+        )
+        os.makedirs(self._lock_dir, exist_ok=True)
 
     @property
     def paas_user(self):
@@ -38,6 +53,14 @@ class Agent(object):
         self._playground = os.path.realpath(new_path)
         return self._playground
 
+    @property
+    def runtime(self):
+        return self._runtime
+
+    @property
+    def stats_backend(self):
+        return self._stats_backend
+
     @property
     def start_timeout(self):
         return self._start_timeout
@@ -46,6 +69,10 @@ class Agent(object):
     def stop_timeout(self):
         return self._stop_timeout
 
+    @property
+    def start_retries(self):
+        return self._start_retries
+
     @property
     def mem_limit(self):
         return self._mem_limit
@@ -70,5 +97,31 @@ class Agent(object):
     def log_backups(self):
         return self._log_backups
 
+    @property
+    def lock_dir(self):
+        return self._lock_dir
+
+    @contextlib.contextmanager
+    def host_lock(self, name, blocking=True):
+        """
+        Hold a lock shared by every agent process and thread on this host
+
+        :param name: lock name
+        :param blocking: if False, raise 409 when the lock is held
+        """
+        path = os.path.join(self._lock_dir, "{0}.lock".format(name))
+        with open(path, "a") as lock_f:
+            flags = fcntl.LOCK_EX
+            if not blocking:
+                flags |= fcntl.LOCK_NB
+            try:
+                fcntl.flock(lock_f, flags)
+            except BlockingIOError:
+                raise AgentError("{0} is locked".format(name), 409)
+            try:
+                yield
+            finally:
+                fcntl.flock(lock_f, fcntl.LOCK_UN)
+
 
 agent = Agent()
@@ -1,40 +1,150 @@
+import functools
+import http.client
 import os
 import logging
+import socket
+import threading
+import time
+import xmlrpc.client
 
 import shcmd
 import docker.client
 import supervisor.childutils
+import supervisor.xmlrpc
 
 from .errors import AgentError
+from .timings import timings
 
 
 __all__ = ["docker_client", "supervisor_client"]
 logger = logging.getLogger(__name__)
 
+# rpc calls after which the process state snapshot is outdated
+SUPERVISOR_MUTATING_CALLS = (
+    "startProcess",
+    "stopProcess",
+    "addProcessGroup",
+    "removeProcessGroup",
+    "reloadConfig",
+)
+
+# supervisor fault -> status code of the AgentError it maps to
+FAULT_STATUS = {
+    supervisor.xmlrpc.Faults.BAD_NAME: 404,
+    supervisor.xmlrpc.Faults.ALREADY_STARTED: 409,
+    supervisor.xmlrpc.Faults.NOT_RUNNING: 409,
+    supervisor.xmlrpc.Faults.ALREADY_ADDED: 409,
+    supervisor.xmlrpc.Faults.STILL_RUNNING: 409,
+}
+
+
+def connect_with_timeout(get_connection, timeout):
+    """
+    Returns ``get_connection`` of a supervisor transport making
+    connections whose socket operations time out after ``timeout``
+    """
+    def get_timeout_connection():
+        connection = get_connection()
+        connection.timeout = timeout
+        plain_connect = connection.connect
+
+        def connect():
+            plain_connect()
+            # unix socket connections ignore ``timeout``
+            connection.sock.settimeout(timeout)
+        connection.connect = connect
+        return connection
+    return get_timeout_connection
+
+
+def fault_error(method, args, fault):
+    """
+    Returns the ``AgentError`` of supervisor ``fault`` raised by a call
+    """
+    error = AgentError(
+        "{0}({1}) failed: {2}".format(
+            method, ", ".join(str(arg) for arg in args), fault.faultString
+        ),
+        FAULT_STATUS.get(fault.faultCode, 500),
+        payload=dict(fault_code=fault.faultCode)
+    )
+    error.fault_code = fault.faultCode
+    return error
+
 
 class DockerClient(object):
     def __init__(self):
         self._dc = None
+        self._config = None
+        self._pid = None
 
     def init_app(self, app):
-        docker_config = dict(
+        self._config = dict(
             base_url=app.config["DOCKER_URL"],
             version=app.config["DOCKER_VERSION"],
             timeout=app.config["DOCKER_TIMEOUT"]
         )
-        logger.debug("{0}".format(docker_config))
-        docker_client = docker.client.Client(**docker_config)
-        docker_client.info()
-        self._dc = docker_client
+        logger.debug("{0}".format(self._config))
+
+    @property
+    def client(self):
+        # connected lazily in every worker, its connection pool is kept
+        # alive across requests but must not be shared through fork
+        if self._pid != os.getpid():
+            self._dc = docker.client.Client(**self._config)
+            self._pid = os.getpid()
+        return self._dc
+
+    def check(self):
+        """raise ``AgentError`` if the docker daemon is not reachable"""
+        try:
+            self.info()
+        except BaseException as exc:
+            raise AgentError("docker not available [{0}]".format(exc), 503)
+
+    def follow_logs(self, container, since, stdout=True, stderr=True):
+        """
+        Yields timestamped output frames of ``container`` from unix time
+        ``since`` on, following it until the container stops
+
+        docker-py 1.2.3 ``logs`` takes no ``since``, daemons older than
+        api 1.19 ignore it and send the whole output
+        """
+        client = self.client
+        response = timings.wrap("docker.logs", client._get)(
+            client._url("/containers/{0}/logs".format(container)),
+            params=dict(
+                stdout=int(stdout),
+                stderr=int(stderr),
+                timestamps=1,
+                follow=1,
+                since=int(since),
+                tail="all"
+            ),
+            stream=True
+        )
+        return client._multiplexed_response_stream_helper(response)
 
     def __getattr__(self, attr):
-        return getattr(self._dc, attr)
+        method = getattr(self.client, attr)
+        if not callable(method):
+            return method
+        return timings.wrap("docker.{0}".format(attr), method)
 
 
 class SupervisorClient(object):
     def __init__(self):
-        self._supervisor = None
+        self._env = None
+        self._timeout = 60
+        self._pool = []
+        self._pool_pid = None
+        self._pool_lock = threading.Lock()
         self._conf_dir = None
+        self._state_ttl = 1.0
+        self._snapshot = None
+        self._snapshot_at = 0
+        self._snapshot_lock = threading.Lock()
+        self._generation = 0
 
     @property
     def conf_dir(self):
@@ -59,23 +169,163 @@ class SupervisorClient(object):
             if key.startswith("SUPERVISOR_")
         }
         env.update(os.environ.copy())
+        self._env = env
+        self.conf_dir = app.config["SUPERVISOR_CONF_DIR"]
+        self._state_ttl = app.config.get("SUPERVISOR_STATE_TTL", 1.0)
+        self._timeout = app.config.get("SUPERVISOR_TIMEOUT", 60)
+
+    def _connect(self):
+        # over http or a unix socket (``unix://`` SUPERVISOR_SERVER_URL)
+        transport = supervisor.childutils.getRPCTransport(self._env)
+        transport._get_connection = connect_with_timeout(
+            transport._get_connection, self._timeout
+        )
+        return xmlrpc.client.ServerProxy("http://127.0.0.1", transport)
 
-        state = None
+    def _acquire(self):
+        # rpc proxies are not thread safe, threads of a worker take turns
+        # on a pool of kept alive connections, as many as calls at once
+        with self._pool_lock:
+            if self._pool_pid != os.getpid():
+                # connections must not be shared through fork
+                self._pool = []
+                self._pool_pid = os.getpid()
+            if self._pool:
+                return self._pool.pop()
+        return self._connect()
+
+    def _release(self, proxy):
+        with self._pool_lock:
+            if self._pool_pid == os.getpid():
+                self._pool.append(proxy)
+
+    def call(self, method, *args, retry=True):
+        """
+        Call rpc ``method``, like ``supervisor.getState``
+
+        a kept alive connection supervisor closed in the meantime is
+        dropped, reads are retried once on a new one; a call supervisor
+        does not answer in ``SUPERVISOR_TIMEOUT`` seconds fails with 504
+
+        :param retry: False if ``method`` mutates state in ways its name
+                      does not tell, like a ``system.multicall`` batch
+        """
+        name = method.rpartition(".")[2]
+        retry = retry and name not in SUPERVISOR_MUTATING_CALLS
+        for reconnected in (False, True):
+            proxy = self._connect() if reconnected else self._acquire()
+            func = proxy
+            for attr in method.split("."):
+                func = getattr(func, attr)
+            try:
+                with timings.timed(method):
+                    result = func(*args)
+            except xmlrpc.client.Fault:
+                self._release(proxy)
+                raise
+            except socket.timeout:
+                raise AgentError(
+                    "{0} timed out after {1}s".format(method, self._timeout),
+                    504
+                )
+            except (http.client.HTTPException, ConnectionError):
+                # a broken connection is not put back
+                if reconnected or not retry:
+                    raise
+                logger.debug("supervisor connection lost, reconnecting")
+                continue
+            finally:
+                if name in SUPERVISOR_MUTATING_CALLS:
+                    self.invalidate()
+            self._release(proxy)
+            return result
+
+    def multicall(self, calls):
+        """
+        Run supervisor ``calls`` in one ``system.multicall`` round trip
+
+        :param calls: ``(method, args)`` pairs, like ``("stopProcess",
+                      ("name",))``, run in order
+        :returns: result of each call in order, with an ``AgentError`` in
+                  place of the result of each call that faulted
+        """
+        if not calls:
+            return []
+        mutating = any(
+            method in SUPERVISOR_MUTATING_CALLS for method, _ in calls
+        )
         try:
-            rpc = supervisor.childutils.getRPCInterface(env)
-            rpc.supervisor.getState()
-            state = rpc.supervisor.getState().get("statename")
+            # a batch supervisor may have run in part is never sent again
+            responses = self.call("system.multicall", [
+                dict(methodName="supervisor." + method, params=list(args))
+                for method, args in calls
+            ], retry=not mutating)
+        finally:
+            if mutating:
+                self.invalidate()
+
+        results = []
+        for (method, args), response in zip(calls, responses):
+            if isinstance(response, dict) and "faultCode" in response:
+                fault = xmlrpc.client.Fault(
+                    response["faultCode"], response["faultString"]
+                )
+                results.append(fault_error(method, args, fault))
+            else:
+                results.append(response[0])
+        return results
+
+    def check(self):
+        """raise ``AgentError`` if supervisor is not running"""
+        try:
+            state = self.call("supervisor.getState").get("statename")
         except BaseException as exc:
             state = exc
         if state != "RUNNING":
             raise AgentError(
-                "supervisor not in right state [{0}]".format(state)
+                "supervisor not in right state [{0}]".format(state), 503
             )
-        self._rpc = rpc.supervisor
-        self.conf_dir = app.config["SUPERVISOR_CONF_DIR"]
+
+    def all_process_info(self):
+        """
+        Returns ``{name: process info}`` of every process, from a snapshot
+        taken with one ``getAllProcessInfo`` call at most ``state_ttl`` ago
+
+        processes are keyed by ``group:name``, and also by ``name`` when
+        it is the only process of its group
+        """
+        with self._snapshot_lock:
+            expired = time.time() - self._snapshot_at > self._state_ttl
+            if self._snapshot is None or expired:
+                generation = self._generation
+                snapshot = {}
+                for info in self.call("supervisor.getAllProcessInfo"):
+                    snapshot["{group}:{name}".format(**info)] = info
+                    if info["group"] == info["name"]:
+                        snapshot[info["name"]] = info
+                if generation != self._generation:
+                    # invalidated while fetching, may predate the change
+                    return snapshot
+                self._snapshot = snapshot
+                self._snapshot_at = time.time()
+            return self._snapshot
+
+    def process_info(self, name):
+        """
+        Returns snapshotted info of process ``name``, None if not exists
+        """
+        return self.all_process_info().get(name)
+
+    def invalidate(self):
+        """drop the snapshot, the next read fetches a fresh one"""
+        self._generation += 1
+        self._snapshot = None
 
     def __getattr__(self, attr):
-        return getattr(self._rpc, attr)
+        # ``supervisor_client.stopProcess(name)`` and alike
+        if attr.startswith("_"):
+            raise AttributeError(attr)
+        return functools.partial(self.call, "supervisor.{0}".format(attr))
 
 
 docker_client = DockerClient()
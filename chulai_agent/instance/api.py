@@ -1,13 +1,21 @@
+import time
+
 from flask import Blueprint
+from flask import Response
 from flask import current_app
 from flask import g
 from flask import jsonify
 from flask import request
+from flask import url_for
 
 from .. import errors
 from .. import consts
+from ..job.manager import job_manager
 
 from . import docker_instance
+from .capacity import capacity, requested_memory
+from .health import health_checker
+from .sampler import metrics_sampler
 
 
 instance_api = Blueprint("instance_api", __name__)
@@ -16,8 +24,16 @@ instance_api = Blueprint("instance_api", __name__)
 OPERATION = dict(
     GET="get {0}'s stats",
     POST="pull {0} up",
+    PUT="apply {0}'s spec",
     DELETE="put {0} down"
 )
+MAX_LOG_LINES = 10000
+MAX_PER_PAGE = 1000
+# operations of endpoints that do not follow their method's
+ENDPOINT_OPERATION = {
+    "instance_api.show_logs": "tail {0}'s logs",
+    "instance_api.show_health": "get {0}'s health",
+}
 
 
 @instance_api.errorhandler(errors.AgentError)
@@ -29,40 +45,125 @@ def agent_error(error):
 
 
 @instance_api.url_value_preprocessor
-def set_g_instance(endpoint, value):
+def set_g_instance(endpoint, values):
     """set docker_instance to global variable"""
-    op_fmt = OPERATION.get(request.method)
+    if "instance_id" not in (values or {}):
+        # endpoints over many instances
+        return
+
+    op_fmt = ENDPOINT_OPERATION.get(endpoint, OPERATION.get(request.method))
     if op_fmt is None:
         raise errors.AgentError("unknown operation", 405)
 
-    instance_id = value.get("instance_id")
-    if instance_id is None:
+    instance_id = values["instance_id"]
+    if not instance_id:
         tip = "missing instance id"
-        raise errors.ChulaiError(tip, 400)
+        raise errors.AgentError(tip, 400)
 
     g.instance = docker_instance.DockerInstance(instance_id)
     current_app.logger.info(op_fmt.format(g.instance))
 
 
-@instance_api.route("/instances/<instance_id>", methods=["POST"])
-def pull_up(instance_id):
-    if g.instance.exists:
-        raise errors.AgentError("{0} already exists".format(g.instance), 409)
+def parse_time(value, name):
+    """
+    Returns the unix time of query argument ``name``, given as a unix
+    timestamp or a local ``YYYY-MM-DDTHH:MM:SS`` time
+    """
+    try:
+        return float(value)
+    except ValueError:
+        pass
+    for fmt in ("%Y-%m-%dT%H:%M:%S", "%Y-%m-%d %H:%M:%S", "%Y-%m-%d"):
+        try:
+            return time.mktime(time.strptime(value, fmt))
+        except ValueError:
+            continue
+    raise errors.AgentError("invalid {0} time {1}".format(name, value), 400)
 
+
+def parse_spec(spec):
+    """
+    Returns ``(args, kwargs)`` of ``DockerInstance.pull_up`` from a spec
+    """
     try:
-        message = g.instance.pull_up(
-            str(request.json["app-id"]),
-            request.json["commit"],
-            request.json["image-tag"],
-            request.json["environments"],
-            request.json["worker"],
-            int(request.json["port"])
+        args = (
+            str(spec["app-id"]),
+            spec["commit"],
+            spec["image-tag"],
+            spec["environments"],
+            spec["worker"],
+            int(spec["port"])
         )
     except KeyError as exc:
         raise errors.AgentError("missing {0}".format(exc), 400)
+    kwargs = dict(force_pull=bool(spec.get("force-pull", False)))
+    return args, kwargs
+
+
+def batch_concurrency(body):
+    max_concurrency = current_app.config.get("BATCH_CONCURRENCY", 8)
+    concurrency = int(body.get("concurrency", max_concurrency))
+    return max(1, min(concurrency, max_concurrency))
 
+
+def job_accepted(job):
+    res = jsonify(status=consts.SUCCESS, job=job.to_dict())
+    res.status_code = 202
+    res.headers["Location"] = url_for("job_api.show_job", job_id=job.job_id)
+    return res
+
+
+@instance_api.route("/instances/<instance_id>", methods=["POST"])
+def pull_up(instance_id):
+    """deploy a instance in background, poll ``/jobs/<job_id>`` for result
+
+    :<json bool force-pull: pull the image even if it is already local
+
+    :statuscode 202: deploy job accepted
+    :statuscode 400: missing arguments
+    :statuscode 409: instance already exists
+    :statuscode 507: not enough memory left on the host for the instance
+    """
+    if g.instance.exists:
+        raise errors.AgentError("{0} already exists".format(g.instance), 409)
+
+    args, kwargs = parse_spec(request.json)
+    capacity.check(g.instance.instance_id, requested_memory(args[3]))
     current_app.logger.info("going to deploy {0}".format(g.instance))
-    return jsonify(status=consts.SUCCESS, message=message)
+    job = job_manager.submit(
+        "pull up", g.instance.instance_id, g.instance.pull_up,
+        *args, **kwargs
+    )
+    return job_accepted(job)
+
+
+@instance_api.route("/instances/<instance_id>", methods=["PUT"])
+def apply(instance_id):
+    """bring a instance to a spec with the least work, the spec is the one
+    of ``POST /instances/<instance_id>``
+
+    a new instance is deployed, an instance whose rendered supervisor conf
+    is unchanged is left alone, else its conf is rewritten and it restarts
+    in place, keeping its playground
+
+    :statuscode 200: spec unchanged, nothing to do
+    :statuscode 202: deploy or update job accepted
+    :statuscode 400: missing arguments
+    :statuscode 507: not enough memory left on the host for the instance
+    """
+    args, kwargs = parse_spec(request.json)
+    exists = g.instance.exists
+    if exists and not g.instance.spec_changed(*args):
+        return jsonify(
+            status=consts.SUCCESS, result="{0} unchanged".format(g.instance)
+        )
+    if not exists:
+        capacity.check(g.instance.instance_id, requested_memory(args[3]))
+    current_app.logger.info("going to apply {0}".format(g.instance))
+    job = job_manager.submit(
+        "apply", g.instance.instance_id, g.instance.apply, *args, **kwargs
+    )
+    return job_accepted(job)
 
 
 @instance_api.route("/instances/<instance_id>")
@@ -70,6 +171,8 @@ def show_stats(instance_id):
     """show instance's stats [cpu, memory usage, etc.]
 
     :query instance_id: instance_id
+    :query since: also return samples taken since this unix timestamp
+    :query window: also return samples taken in the last ``window`` seconds
 
     :statuscode 200: show stats json
     :statuscode 404: instance not found
@@ -80,6 +183,7 @@ def show_stats(instance_id):
     :>json string status: ``success`` or ``failed``
     :>json string message: if status is ``failed``, error reason goes here
     :>json dict config: if status is ``success``, instance config goes here
+    :>json list history: sampled stats, only if ``since`` or ``window``
 
     **Example response**:
 
@@ -96,13 +200,96 @@ def show_stats(instance_id):
                 "vms_in_mb": 100,
                 "user_time": 30,
                 "system_time": 40,
-                "children": ["child-process-cmd-0", "child-process-cmd-1"]
+                "children": ["child-process-cmd-0", "child-process-cmd-1"],
+                "disk": {
+                    "chulai-log.d": 52428800,
+                    "stdout-log.d": 1048576,
+                    "share.d": 4096,
+                    "total": 53481472,
+                    "scanned_at": 1436757830.6
+                }
             }
         }
     """
+    since = request.args.get("since", type=float)
+    window = request.args.get("window", type=float)
+    if since is None and window is None:
+        return jsonify(status=consts.SUCCESS, stats=g.instance.stats)
+
+    if since is None:
+        since = time.time() - window
+    return jsonify(
+        status=consts.SUCCESS,
+        stats=g.instance.stats,
+        history=metrics_sampler.history(g.instance.instance_id, since)
+    )
+
+
+@instance_api.route("/instances")
+def list_instances():
+    """list instances with their spec, state and stats in one request
+
+    :query ids: comma separated instance ids
+    :query app-id: only instances of this app
+    :query commit: only instances of this commit
+    :query image-tag: only instances of this image
+    :query state: only instances in this supervisor state, like ``RUNNING``
+    :query stats: ``0`` to leave stats out
+    :query page: page number, starts from 1
+    :query per_page: instances per page, defaults to 100, at most 1000
+
+    :>header Content-Type: application/json
+
+    :>json string status: ``success`` or ``error``
+    :>json int total: number of instances matching the filters
+    :>json list instances: spec, state and stats of each instance,
+                           ``stats`` is null when it is not running,
+                           requested ids not on this host come with
+                           ``error`` set to ``not found``
+
+    **Example response**:
+
+    .. sourcecode:: http
+
+        {
+            "status": "success",
+            "total": 1,
+            "page": 1,
+            "per_page": 100,
+            "instances": [
+                {
+                    "instance_id": "instance-0",
+                    "state": "RUNNING",
+                    "stats": {"cpu_percent": 20, "threads": 2},
+                    "spec": {"app-id": "1", "commit": "c0ffee"}
+                }
+            ]
+        }
+    """
+    ids = request.args.get("ids")
+    if ids is not None:
+        ids = [instance_id for instance_id in ids.split(",") if instance_id]
+    page = max(request.args.get("page", 1, type=int), 1)
+    per_page = request.args.get("per_page", 100, type=int)
+    per_page = max(1, min(per_page, MAX_PER_PAGE))
+    state = request.args.get("state")
+
+    total, instances = docker_instance.list_instances(
+        ids=ids,
+        state=state.upper() if state else None,
+        offset=(page - 1) * per_page,
+        limit=per_page,
+        with_stats=request.args.get("stats") != "0",
+        app_id=request.args.get("app-id"),
+        commit=request.args.get("commit"),
+        image_tag=request.args.get("image-tag")
+    )
     return jsonify(
         status=consts.SUCCESS,
-        stats=g.instance.stats
+        total=total,
+        page=page,
+        per_page=per_page,
+        instances=instances
     )
 
 
@@ -110,17 +297,180 @@ def show_stats(instance_id):
 def put_down(instance_id):
     """destroy a instance, upload it's log, and cleanup the playground
 
+    runs in background, poll ``/jobs/<job_id>`` for the result
+
     :query instance_id: instance_id
 
+    :statuscode 202: teardown job accepted
+
     :header Content-Type: application/json
     :>json string status: ``success`` or ``error``
+    :>json dict job: the submitted job
     **Example Response:**
 
     .. sourcecode:: http
 
         {
-            "status": "success"
+            "status": "success",
+            "job": {
+                "job_id": "5f0c5b0e3c8b4c1f9d2f8ce9a4a2c1e7",
+                "state": "pending"
+            }
         }
     """
-    message = g.instance.put_down()
-    return jsonify(status=consts.SUCCESS, message=message)
+    job = job_manager.submit(
+        "put down", g.instance.instance_id, g.instance.put_down
+    )
+    return job_accepted(job)
+
+
+@instance_api.route("/instances/<instance_id>/logs")
+def show_logs(instance_id):
+    """tail a log of the instance, optionally following it, or read the
+    lines it logged in a time range
+
+    :query stream: ``stdout`` (default), ``stderr`` or ``app``
+    :query file: log file in ``chulai-log.d`` for ``app``, defaults to
+                 ``production.log``
+    :query lastn: number of lines to show, defaults to 100
+    :query follow: if ``1``, keep streaming appended lines
+    :query timeout: seconds to follow, capped by ``LOG_FOLLOW_TIMEOUT``
+    :query from: only show lines logged since, a unix timestamp or a local
+                 ``YYYY-MM-DDTHH:MM:SS`` time, archives included
+    :query to: only show lines logged until, defaults to now
+    :query limit: max lines of a ``from``/``to`` query, oldest first
+
+    :statuscode 200: log lines, as a chunked ``text/plain`` stream
+    :statuscode 400: unknown stream, invalid file or time
+    """
+    if "from" in request.args or "to" in request.args:
+        start = parse_time(request.args.get("from", "0"), "from")
+        end = parse_time(request.args.get("to", str(time.time())), "to")
+        limit = request.args.get("limit", MAX_LOG_LINES, type=int)
+        lines = g.instance.get_log_range(
+            request.args.get("stream", "stdout"),
+            start,
+            end,
+            max(0, min(limit, MAX_LOG_LINES)),
+            file_name=request.args.get("file")
+        )
+        return Response(lines, mimetype="text/plain")
+
+    lastn = request.args.get("lastn", 100, type=int)
+    max_timeout = current_app.config.get("LOG_FOLLOW_TIMEOUT", 60)
+    timeout = min(
+        request.args.get("timeout", max_timeout, type=float), max_timeout
+    )
+    lines = g.instance.get_log(
+        request.args.get("stream", "stdout"),
+        min(lastn, MAX_LOG_LINES),
+        follow=request.args.get("follow") == "1",
+        timeout=timeout,
+        file_name=request.args.get("file")
+    )
+    return Response(lines, mimetype="text/plain")
+
+
+@instance_api.route("/instances:batch", methods=["POST"])
+def pull_up_many():
+    """deploy many instances at once, with bounded parallelism
+
+    image pulls and supervisor reloads are shared between the instances
+
+    :<json list instances: specs as posted to ``/instances/<instance_id>``,
+                           plus their ``instance-id``
+    :<json int concurrency: max deploys at once, capped by
+                            ``BATCH_CONCURRENCY``
+
+    :statuscode 200: every deploy finished, see each result
+    :statuscode 400: missing arguments
+
+    **Example response**:
+
+    .. sourcecode:: http
+
+        {
+            "status": "success",
+            "results": [
+                {
+                    "instance_id": "instance-0",
+                    "job_id": "5f0c5b0e3c8b4c1f9d2f8ce9a4a2c1e7",
+                    "status": "success",
+                    "message": "started",
+                    "phases": [{"name": "pull image", "elapsed": 3.2}],
+                    "elapsed": 4.1
+                }
+            ]
+        }
+    """
+    body = request.json or {}
+    calls = []
+    for spec in body.get("instances", []):
+        if "instance-id" not in spec:
+            raise errors.AgentError("missing 'instance-id'", 400)
+        instance = docker_instance.DockerInstance(str(spec["instance-id"]))
+        args, kwargs = parse_spec(spec)
+        calls.append((instance.instance_id, instance.pull_up, args, kwargs))
+
+    current_app.logger.info("going to deploy {0} instances".format(len(calls)))
+    results = docker_instance.run_many(
+        "pull up", calls, batch_concurrency(body)
+    )
+    return jsonify(status=consts.SUCCESS, results=results)
+
+
+@instance_api.route("/instances:batch", methods=["DELETE"])
+def put_down_many():
+    """put many instances down at once, with bounded parallelism
+
+    :<json list ids: ids of instances to put down
+    :<json int concurrency: max teardowns at once, capped by
+                            ``BATCH_CONCURRENCY``
+
+    :statuscode 200: every teardown finished, see each result
+    """
+    body = request.get_json(silent=True) or {}
+    calls = []
+    for instance_id in body.get("ids", []):
+        instance = docker_instance.DockerInstance(str(instance_id))
+        calls.append((instance.instance_id, instance.put_down, (), {}))
+
+    current_app.logger.info("going to put {0} instances down".format(
+        len(calls)
+    ))
+    results = docker_instance.run_many(
+        "put down", calls, batch_concurrency(body)
+    )
+    return jsonify(status=consts.SUCCESS, results=results)
+
+
+@instance_api.route("/instances/<instance_id>/health")
+def show_health(instance_id):
+    """show the latest readiness and liveness check of the instance
+
+    never probes the instance, results come from the health checker
+
+    :statuscode 200: show health json, ``health`` is null if the instance
+                     has not been checked yet
+
+    **Example response**:
+
+    .. sourcecode:: http
+
+        {
+            "status": "success",
+            "health": {
+                "url": "http://10.0.0.1:3000/",
+                "ready": true,
+                "live": true,
+                "status_code": 200,
+                "latency": 0.004,
+                "checked_at": 1436000000.0,
+                "error": null
+            }
+        }
+    """
+    return jsonify(
+        status=consts.SUCCESS,
+        health=health_checker.result(g.instance.instance_id)
+    )
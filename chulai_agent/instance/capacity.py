@@ -0,0 +1,89 @@
+"""
+Host Capacity
+
+memory admission control: every instance commits its ``memory_limit``,
+and deploys are only admitted while the committed memory of the host
+fits in its RAM minus a reserve
+"""
+
+import contextlib
+import logging
+
+import psutil
+
+from .. import errors
+from .. import utils
+from ..agent import agent
+
+from .registry import registry
+
+
+__all__ = ["capacity", "requested_memory"]
+logger = logging.getLogger(__name__)
+
+
+def requested_memory(environments):
+    """
+    Returns the memory limit in MB an instance deployed with
+    ``environments`` gets
+    """
+    return int(environments.get("MEMORY_LIMIT", agent.mem_limit))
+
+
+class HostCapacity(object):
+    def __init__(self):
+        self._reserve_mb = 1024
+        self._overcommit = 1.0
+
+    def init_app(self, app):
+        self._reserve_mb = app.config.get("MEMORY_RESERVE_MB", 1024)
+        self._overcommit = app.config.get("MEMORY_OVERCOMMIT_RATIO", 1.0)
+
+    def summary(self):
+        """
+        Returns memory of the host, committed and free for new instances,
+        all in MB
+        """
+        memory = psutil.virtual_memory()
+        total_mb = int(utils.to_MB(memory.total))
+        budget_mb = int((total_mb - self._reserve_mb) * self._overcommit)
+        committed_mb, instances = registry.committed_memory()
+        return dict(
+            total_mb=total_mb,
+            available_mb=int(utils.to_MB(memory.available)),
+            reserve_mb=self._reserve_mb,
+            overcommit_ratio=self._overcommit,
+            budget_mb=budget_mb,
+            committed_mb=committed_mb,
+            free_mb=max(0, budget_mb - committed_mb),
+            instances=instances
+        )
+
+    def check(self, instance_id, memory_limit):
+        """
+        Raise 507 if ``memory_limit`` MB more would exceed the budget
+
+        :param memory_limit: memory limit of the new instance, in MB
+        """
+        summary = self.summary()
+        if memory_limit > summary["free_mb"]:
+            raise errors.AgentError(
+                "not enough memory for {0}: needs {1}MB, {2}MB free".format(
+                    instance_id, memory_limit, summary["free_mb"]
+                ),
+                507,
+                payload=dict(capacity=summary)
+            )
+
+    @contextlib.contextmanager
+    def admit(self, instance_id, memory_limit):
+        """
+        Check the budget and hold it until the block has registered the
+        instance, so concurrent deploys never commit the same memory
+        """
+        with agent.host_lock("admission"):
+            self.check(instance_id, memory_limit)
+            yield
+
+
+capacity = HostCapacity()
@@ -0,0 +1,181 @@
+"""
+Cgroup Stats
+
+reads whole-container resource usage straight from the container's
+cgroup files, supports both the v1 (per controller) and the v2 (unified)
+hierarchy
+"""
+
+import os
+
+from .. import errors
+from .. import utils
+
+
+__all__ = ["cgroup_stats"]
+
+USER_HZ = os.sysconf("SC_CLK_TCK")
+
+
+def read_int(path):
+    """
+    Returns integer content of ``path``, None if missing or unlimited
+    """
+    try:
+        with open(path) as cgroup_f:
+            content = cgroup_f.read().strip()
+    except FileNotFoundError:
+        return None
+    if content == "max":
+        return None
+    return int(content)
+
+
+def read_keyed(path):
+    """
+    Returns ``{key: int}`` from a flat keyed file like ``memory.stat``
+    """
+    result = {}
+    try:
+        with open(path) as cgroup_f:
+            for line in cgroup_f:
+                parts = line.split()
+                if len(parts) == 2:
+                    result[parts[0]] = int(parts[1])
+    except FileNotFoundError:
+        pass
+    return result
+
+
+class CgroupStats(object):
+    def __init__(self, root="/sys/fs/cgroup"):
+        self.root = root
+
+    def init_app(self, app):
+        self.root = app.config.get("CGROUP_ROOT", "/sys/fs/cgroup")
+
+    @property
+    def unified(self):
+        """whether the host runs the cgroup v2 unified hierarchy"""
+        return os.path.exists(os.path.join(self.root, "cgroup.controllers"))
+
+    def locate(self, cid, controller=None):
+        """
+        Returns the cgroup directory of container ``cid``
+
+        :param controller: v1 controller name, ignored for v2
+        """
+        base = self.root
+        if not self.unified:
+            base = os.path.join(self.root, controller)
+        scope = "docker-{0}.scope".format(cid)
+        candidates = [
+            os.path.join(base, "system.slice", scope),
+            os.path.join(base, "docker", cid),
+        ]
+        for candidate in candidates:
+            if os.path.isdir(candidate):
+                return candidate
+        raise errors.AgentError(
+            "can not find {0} cgroup of container {1}".format(
+                controller or "unified", cid
+            )
+        )
+
+    def stats(self, cid):
+        """
+        Returns resource usage of the whole container ``cid``
+        """
+        if self.unified:
+            metrics = self._stats_v2(cid)
+        else:
+            metrics = self._stats_v1(cid)
+
+        usage = metrics.pop("memory_usage") or 0
+        limit = metrics.pop("memory_limit")
+        metrics["memory_in_mb"] = utils.to_MB(usage)
+        metrics["memory_limit_in_mb"] = None
+        metrics["memroy_percent"] = None
+        if limit is not None:
+            metrics["memory_limit_in_mb"] = utils.to_MB(limit)
+            metrics["memroy_percent"] = utils.percentlize(usage / limit)
+        return metrics
+
+    def _stats_v2(self, cid):
+        cgroup = self.locate(cid)
+        cpu = read_keyed(os.path.join(cgroup, "cpu.stat"))
+        memory = read_keyed(os.path.join(cgroup, "memory.stat"))
+        read_bytes = write_bytes = 0
+        try:
+            with open(os.path.join(cgroup, "io.stat")) as io_f:
+                for line in io_f:
+                    fields = dict(
+                        field.split("=", 1) for field in line.split()[1:]
+                    )
+                    read_bytes += int(fields.get("rbytes", 0))
+                    write_bytes += int(fields.get("wbytes", 0))
+        except FileNotFoundError:
+            pass
+
+        return {
+            "cpu_time": cpu.get("usage_usec", 0) / 1e6,
+            "user_time": cpu.get("user_usec", 0) / 1e6,
+            "system_time": cpu.get("system_usec", 0) / 1e6,
+            "memory_usage": read_int(os.path.join(cgroup, "memory.current")),
+            "memory_limit": read_int(os.path.join(cgroup, "memory.max")),
+            "rss_in_mb": utils.to_MB(memory.get("anon", 0)),
+            "threads": read_int(os.path.join(cgroup, "pids.current")) or 0,
+            "io_read_bytes": read_bytes,
+            "io_write_bytes": write_bytes,
+        }
+
+    def _stats_v1(self, cid):
+        cpuacct = self.locate(cid, "cpuacct")
+        memory = self.locate(cid, "memory")
+        cpu = read_keyed(os.path.join(cpuacct, "cpuacct.stat"))
+        memory_stat = read_keyed(os.path.join(memory, "memory.stat"))
+
+        threads = 0
+        try:
+            pids = self.locate(cid, "pids")
+            threads = read_int(os.path.join(pids, "pids.current")) or 0
+        except errors.AgentError:
+            pass
+
+        read_bytes = write_bytes = 0
+        try:
+            blkio = self.locate(cid, "blkio")
+            io_path = os.path.join(blkio, "blkio.throttle.io_service_bytes")
+            with open(io_path) as io_f:
+                for line in io_f:
+                    parts = line.split()
+                    if len(parts) != 3:
+                        continue
+                    if parts[1] == "Read":
+                        read_bytes += int(parts[2])
+                    elif parts[1] == "Write":
+                        write_bytes += int(parts[2])
+        except (errors.AgentError, FileNotFoundError):
+            pass
+
+        limit = read_int(os.path.join(memory, "memory.limit_in_bytes"))
+        # v1 reports "no limit" as a huge page-aligned number
+        if limit is not None and limit >= 2 ** 62:
+            limit = None
+        usage_ns = read_int(os.path.join(cpuacct, "cpuacct.usage")) or 0
+        return {
+            "cpu_time": usage_ns / 1e9,
+            "user_time": cpu.get("user", 0) / USER_HZ,
+            "system_time": cpu.get("system", 0) / USER_HZ,
+            "memory_usage": read_int(
+                os.path.join(memory, "memory.usage_in_bytes")
+            ),
+            "memory_limit": limit,
+            "rss_in_mb": utils.to_MB(memory_stat.get("rss", 0)),
+            "threads": threads,
+            "io_read_bytes": read_bytes,
+            "io_write_bytes": write_bytes,
+        }
+
+
+cgroup_stats = CgroupStats()
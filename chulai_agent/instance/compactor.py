@@ -0,0 +1,188 @@
+"""
+Log Compactor
+
+compresses rotated logs of every instance into time-indexed archives, in
+background at idle io priority:
+
+* supervisor's (and the docker runtime's) ``stdout-log.d/*.log.N`` backups
+* ``chulai-log.d/*.N`` backups rotated by the app itself
+* ``chulai-log.d`` logs grown over ``LOG_MAX_MB``, which nobody rotates,
+  compressed up to their end and truncated right away, only lines written
+  between the last read and the truncate are lost
+
+every agent process runs a compactor from startup, only the one holding
+the ``log-compactor`` host lock compacts
+"""
+
+import logging
+import os
+import re
+import threading
+import time
+
+from ..agent import agent
+
+from . import logs
+from .reaper import lower_io_priority
+from .registry import registry
+
+
+__all__ = ["log_compactor"]
+logger = logging.getLogger(__name__)
+
+ROTATED_PATTERN = re.compile(r"^(?P<name>.+)\.(?P<index>\d+)$")
+
+
+def next_seq(path):
+    """Returns a sequence number after every archive of ``path``"""
+    seq = int(time.time() * 1000)
+    existing = logs.archives(path)
+    if existing:
+        last = logs.ARCHIVE_PATTERN.match(os.path.basename(existing[-1]))
+        seq = max(seq, int(last.group("seq")) + 1)
+    return seq
+
+
+def archive_path(path, seq, ext):
+    return os.path.join(
+        os.path.dirname(path), logs.ARCHIVE_DIR,
+        "{0}.{1}.{2}".format(os.path.basename(path), seq, ext)
+    )
+
+
+class LogCompactor(object):
+    def __init__(self):
+        self._interval = 300
+        self._keep = 100
+        self._wakeup = threading.Event()
+        self._lock = threading.Lock()
+        self._pid = None
+
+    def init_app(self, app):
+        self._interval = app.config.get("LOG_COMPACT_INTERVAL", 300)
+        self._keep = app.config.get("LOG_ARCHIVE_KEEP", 100)
+
+    def ensure_started(self):
+        # threads do not survive fork, every worker runs a compactor, only
+        # the one holding the host lock compacts
+        if not self._interval or self._pid == os.getpid():
+            return
+        with self._lock:
+            if self._pid == os.getpid():
+                return
+            self._pid = os.getpid()
+        runner = threading.Thread(target=self._run, name="log-compactor")
+        runner.daemon = True
+        runner.start()
+
+    def _run(self):
+        lower_io_priority()
+        while True:
+            try:
+                with agent.host_lock("log-compactor"):
+                    self._compact_forever()
+            except BaseException:
+                logger.warn("compacting logs failed", exc_info=True)
+            time.sleep(self._interval)
+
+    def _compact_forever(self):
+        while True:
+            self._wakeup.clear()
+            self.compact_all()
+            self._wakeup.wait(self._interval)
+
+    def compact_all(self):
+        for instance_id in registry.ids():
+            try:
+                self.compact(instance_id)
+            except OSError:
+                logger.warn("compact {0} failed".format(instance_id),
+                            exc_info=True)
+
+    def compact(self, instance_id):
+        playground = os.path.join(agent.playground, instance_id)
+        self.compact_dir(os.path.join(playground, "stdout-log.d"), False)
+        self.compact_dir(os.path.join(playground, "chulai-log.d"), True)
+
+    def compact_dir(self, log_dir, truncate):
+        """
+        :param truncate: also archive and truncate logs over ``LOG_MAX_MB``
+        """
+        try:
+            entries = os.listdir(log_dir)
+        except FileNotFoundError:
+            return
+        rotated = {}
+        for entry in entries:
+            match = ROTATED_PATTERN.match(entry)
+            if match is not None:
+                rotated.setdefault(match.group("name"), []).append(
+                    int(match.group("index"))
+                )
+        names = set(rotated)
+        if truncate:
+            names.update(
+                entry for entry in entries
+                if not entry.startswith(".") and entry != logs.ARCHIVE_DIR and
+                ROTATED_PATTERN.match(entry) is None
+            )
+
+        for name in sorted(names):
+            path = os.path.join(log_dir, name)
+            os.makedirs(os.path.join(log_dir, logs.ARCHIVE_DIR), exist_ok=True)
+            self.finish_claimed(path)
+            # oldest backup first, archives keep their order
+            for index in sorted(rotated.get(name, ()), reverse=True):
+                self.archive_backup(path, "{0}.{1}".format(path, index))
+            if truncate:
+                self.archive_truncate(path)
+            self.expire(path)
+
+    def finish_claimed(self, path):
+        """compress files claimed by a compaction that did not finish"""
+        for claimed in logs.archives(path):
+            if claimed.endswith(".log"):
+                self.compress(claimed, claimed[:-len(".log")] + ".gz")
+
+    def archive_backup(self, path, backup_path):
+        claimed = archive_path(path, next_seq(path), "log")
+        try:
+            # claim the backup before the next rotation renames it
+            os.rename(backup_path, claimed)
+        except FileNotFoundError:
+            return
+        self.compress(claimed, claimed[:-len(".log")] + ".gz")
+
+    def archive_truncate(self, path):
+        try:
+            size = os.stat(path).st_size
+        except FileNotFoundError:
+            return
+        if size < agent.log_max_mb * 1024 * 1024:
+            return
+        # apps write in append mode and go on at the new end
+        logs.compress(
+            path, archive_path(path, next_seq(path), "gz"), truncate=True
+        )
+        logger.info("archived and truncated {0}".format(path))
+
+    def compress(self, src_path, dest_path):
+        started = time.time()
+        index = logs.compress(src_path, dest_path)
+        os.remove(src_path)
+        logger.info("compressed {0} lines into {1} in {2:.2f}s".format(
+            index["lines"], dest_path, time.time() - started
+        ))
+
+    def expire(self, path):
+        """keep ``LOG_ARCHIVE_KEEP`` archives of ``path``"""
+        existing = logs.archives(path)
+        for expired in existing[:max(0, len(existing) - self._keep)]:
+            for victim in (expired, logs.index_path(expired)):
+                try:
+                    os.remove(victim)
+                except FileNotFoundError:
+                    pass
+
+
+log_compactor = LogCompactor()
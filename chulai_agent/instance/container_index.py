@@ -0,0 +1,160 @@
+"""
+Container Index
+
+keeps a per-process ``name -> container id`` map of every container on
+the host, seeded from one listing and kept current by the docker events
+stream, so looking up a container does not need to list all of them
+"""
+
+import json
+import logging
+import os
+import threading
+import time
+
+import docker
+import requests
+
+from ..clients import docker_client
+
+
+__all__ = ["container_index"]
+logger = logging.getLogger(__name__)
+
+# events that may introduce or rename a container
+REFRESH_EVENTS = ("create", "rename")
+# events after which the container is gone
+REMOVE_EVENTS = ("destroy",)
+
+
+def normalize_name(name):
+    return name.lstrip("/")
+
+
+class ContainerIndex(object):
+    def __init__(self, resync_interval=5):
+        self._resync_interval = resync_interval
+        self._lock = threading.Lock()
+        self._ids = {}
+        self._names = {}
+        # bumped by every event applied, see ``resync``
+        self._generation = 0
+        self._pid = None
+        self._live = False
+        self._since = None
+
+    @property
+    def live(self):
+        """whether the index is currently fed by the events stream"""
+        return self._live
+
+    def get(self, name):
+        """
+        Returns container id of container ``name``, or None
+        """
+        self._ensure_started()
+        cid = self._ids.get(normalize_name(name))
+        if cid is None and not self._live:
+            # the stream is down, the index may be stale
+            self.resync()
+            cid = self._ids.get(normalize_name(name))
+        return cid
+
+    def name_of(self, cid):
+        """
+        Returns name of container ``cid``, or None
+        """
+        self._ensure_started()
+        return self._names.get(cid)
+
+    def resync(self):
+        """rebuild the whole index from a single container listing"""
+        since = int(time.time())
+        generation = self._generation
+        ids = {}
+        for container in docker_client.containers(all=True):
+            for name in container.get("Names") or []:
+                ids[normalize_name(name)] = container["Id"]
+        with self._lock:
+            if generation != self._generation:
+                # events applied while listing, it may predate them
+                logger.debug("container index changed while syncing")
+                return
+            self._ids = ids
+            self._names = {cid: name for name, cid in ids.items()}
+            self._since = since
+        logger.info("container index synced, {0} names".format(len(ids)))
+
+    def _ensure_started(self):
+        # threads do not survive fork, so every worker runs its own watcher
+        if self._pid == os.getpid():
+            return
+        with self._lock:
+            if self._pid == os.getpid():
+                return
+            self._pid = os.getpid()
+            self._live = False
+        self.resync()
+        watcher = threading.Thread(
+            target=self._watch, name="container-index-watcher"
+        )
+        watcher.daemon = True
+        watcher.start()
+
+    def _watch(self):
+        while True:
+            try:
+                self._live = True
+                for event in docker_client.events(since=self._since):
+                    if not isinstance(event, dict):
+                        event = json.loads(event.decode("utf-8"))
+                    self._apply(event)
+            except requests.exceptions.Timeout:
+                # idle stream, reconnect and replay from the last event
+                logger.debug("docker events stream idle, reconnecting")
+                continue
+            except BaseException:
+                logger.warn("docker events stream dropped", exc_info=True)
+            self._live = False
+            time.sleep(self._resync_interval)
+            try:
+                self.resync()
+            except BaseException:
+                logger.warn("resync container index failed", exc_info=True)
+
+    def _apply(self, event):
+        if event.get("Type", "container") != "container":
+            return
+        status = event.get("status") or event.get("Action")
+        cid = event.get("id") or event.get("Actor", {}).get("ID")
+        if "time" in event:
+            self._since = event["time"]
+        if cid is None:
+            return
+
+        if status in REMOVE_EVENTS:
+            with self._lock:
+                name = self._names.pop(cid, None)
+                if name is not None and self._ids.get(name) == cid:
+                    del self._ids[name]
+                self._generation += 1
+        elif status in REFRESH_EVENTS:
+            attrs = event.get("Actor", {}).get("Attributes", {})
+            name = attrs.get("name")
+            if name is None:
+                try:
+                    name = docker_client.inspect_container(cid)["Name"]
+                except docker.errors.APIError:
+                    # already gone, its destroy event will follow
+                    return
+            name = normalize_name(name)
+            with self._lock:
+                old_name = self._names.get(cid)
+                if old_name is not None and self._ids.get(old_name) == cid:
+                    del self._ids[old_name]
+                self._ids[name] = cid
+                self._names[cid] = name
+                self._generation += 1
+
+
+container_index = ContainerIndex()
@@ -0,0 +1,115 @@
+"""
+Agent Counters
+
+monotonic counters and histograms of agent operations, kept next to the
+instance registry in sqlite so every worker adds to the same values
+"""
+
+import logging
+import sqlite3
+
+from .registry import registry
+
+
+__all__ = ["counters", "format_labels"]
+logger = logging.getLogger(__name__)
+
+SCHEMA = """
+CREATE TABLE IF NOT EXISTS counters (
+    name TEXT NOT NULL,
+    labels TEXT NOT NULL,
+    value REAL NOT NULL,
+    PRIMARY KEY (name, labels)
+);
+"""
+
+# upper bounds of pull duration buckets, in seconds
+PULL_BUCKETS = (1, 5, 10, 30, 60, 120, 300, 600)
+INF = float("inf")
+
+
+def escape_label(value):
+    return str(value).replace("\\", "\\\\").replace(
+        "\n", "\\n"
+    ).replace('"', '\\"')
+
+
+def format_labels(labels):
+    """
+    Returns ``labels`` in prometheus exposition format, without braces
+    """
+    return ",".join(
+        '{0}="{1}"'.format(name, escape_label(value))
+        for name, value in labels
+    )
+
+
+def format_bound(bound):
+    return "+Inf" if bound == INF else repr(float(bound))
+
+
+class AgentCounters(object):
+    def init_app(self, app):
+        with registry.conn:
+            registry.conn.executescript(SCHEMA)
+
+    def incr(self, name, amount=1, **labels):
+        """
+        Add ``amount`` to counter ``name`` with ``labels``
+        """
+        try:
+            with registry.conn:
+                self._add(
+                    name, format_labels(sorted(labels.items())), amount
+                )
+        except sqlite3.Error:
+            # accounting must never fail the operation it accounts for
+            logger.warn("update {0} failed".format(name), exc_info=True)
+
+    def observe(self, name, value, buckets, **labels):
+        """
+        Record ``value`` in histogram ``name``, as prometheus histograms
+        are stored: cumulative ``_bucket`` counters, ``_sum`` and ``_count``
+        """
+        labels = sorted(labels.items())
+        try:
+            with registry.conn:
+                # buckets below the value get 0, so every bucket is
+                # exposed from the first observation on
+                for bound in tuple(buckets) + (INF,):
+                    self._add(
+                        "{0}_bucket".format(name),
+                        format_labels(labels + [("le", format_bound(bound))]),
+                        1 if value <= bound else 0
+                    )
+                self._add(
+                    "{0}_sum".format(name), format_labels(labels), value
+                )
+                self._add("{0}_count".format(name), format_labels(labels), 1)
+        except sqlite3.Error:
+            logger.warn("update {0} failed".format(name), exc_info=True)
+
+    def _add(self, name, labels, amount):
+        conn = registry.conn
+        conn.execute(
+            "INSERT OR IGNORE INTO counters VALUES (?, ?, 0)",
+            (name, labels)
+        )
+        conn.execute(
+            "UPDATE counters SET value = value + ? "
+            "WHERE name = ? AND labels = ?",
+            (amount, name, labels)
+        )
+
+    def values(self, name):
+        """
+        Returns ``[(labels, value), ...]`` of counter ``name``
+        """
+        return registry.conn.execute(
+            "SELECT labels, value FROM counters WHERE name = ? "
+            "ORDER BY labels",
+            (name,)
+        ).fetchall()
+
+
+counters = AgentCounters()
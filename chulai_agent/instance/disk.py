@@ -0,0 +1,352 @@
+"""
+Disk Usage
+
+per-instance disk usage of the playground dirs, scanned in background by
+one worker per host and kept in sqlite next to the registry, so stats and
+the host summary never walk a playground
+
+scans are incremental: a directory whose mtime did not change since the
+last scan is not listed again, only the files it held are stat-ed, so a
+rescan costs a stat per file instead of a walk of every playground
+
+instances over the optional soft quota ``DISK_QUOTA_MB`` are reported,
+and with ``DISK_QUOTA_ACTION = "truncate"`` their logs are cut down:
+archives go first, oldest first, then rotated backups, then live logs are
+truncated, ``share.d`` is never touched
+"""
+
+import json
+import logging
+import os
+import threading
+import time
+
+import psutil
+
+from .. import errors
+from .. import utils
+from ..agent import agent
+
+from . import logs
+from .events import event_journal
+from .reaper import lower_io_priority
+from .registry import registry
+
+
+__all__ = ["disk_usage"]
+logger = logging.getLogger(__name__)
+
+SCHEMA = """
+CREATE TABLE IF NOT EXISTS disk_usage (
+    instance_id TEXT PRIMARY KEY,
+    usage TEXT NOT NULL,
+    total INTEGER NOT NULL,
+    scanned_at REAL NOT NULL
+);
+"""
+
+# playground dirs accounted, logs first, truncating cuts them in order
+DIRS = ("chulai-log.d", "stdout-log.d", "share.d")
+LOG_DIRS = ("chulai-log.d", "stdout-log.d")
+
+
+class DirCache(object):
+    """
+    Files and subdirs of a directory as of its last scan, with the mtime
+    of the directory then
+    """
+
+    def __init__(self, mtime_ns, files, subdirs):
+        self.mtime_ns = mtime_ns
+        self.files = files
+        self.subdirs = subdirs
+
+
+class DiskUsage(object):
+    def __init__(self):
+        self._interval = 60
+        self._quota_mb = 0
+        self._quota_action = "warn"
+        self._caches = {}
+        self._over_quota = set()
+        self._wakeup = threading.Event()
+        self._lock = threading.Lock()
+        self._pid = None
+
+    def init_app(self, app):
+        self._interval = app.config.get("DISK_SCAN_INTERVAL", 60)
+        self._quota_mb = app.config.get("DISK_QUOTA_MB", 0)
+        self._quota_action = app.config.get("DISK_QUOTA_ACTION", "warn")
+        if self._quota_action not in ("warn", "truncate"):
+            raise errors.AgentError(
+                "unknown DISK_QUOTA_ACTION {0}".format(self._quota_action)
+            )
+        with registry.conn:
+            registry.conn.executescript(SCHEMA)
+
+    def usage(self, instance_id):
+        """
+        Returns bytes used by each playground dir of ``instance_id`` as of
+        the last scan, None if not scanned yet
+        """
+        self.ensure_started()
+        row = registry.conn.execute(
+            "SELECT usage, total, scanned_at FROM disk_usage "
+            "WHERE instance_id = ?", (instance_id,)
+        ).fetchone()
+        if row is None:
+            return None
+        return self._to_dict(*row)
+
+    def usage_all(self):
+        """
+        Returns ``{instance_id: usage}`` of every scanned instance
+        """
+        self.ensure_started()
+        return {
+            row[0]: self._to_dict(*row[1:])
+            for row in registry.conn.execute(
+                "SELECT instance_id, usage, total, scanned_at FROM disk_usage"
+            )
+        }
+
+    def _to_dict(self, usage, total, scanned_at):
+        result = json.loads(usage)
+        result.update(total=total, scanned_at=scanned_at)
+        if self._quota_mb:
+            result["quota_mb"] = self._quota_mb
+        return result
+
+    def summary(self, top=10):
+        """
+        Returns usage of the playground filesystem and of the instances,
+        with the ``top`` biggest and the ones over quota
+        """
+        self.ensure_started()
+        fs = psutil.disk_usage(agent.playground)
+        rows = registry.conn.execute(
+            "SELECT instance_id, total FROM disk_usage ORDER BY total DESC"
+        ).fetchall()
+        quota = self._quota_mb * 1024 * 1024
+        return dict(
+            filesystem=dict(
+                total_mb=int(utils.to_MB(fs.total)),
+                used_mb=int(utils.to_MB(fs.used)),
+                free_mb=int(utils.to_MB(fs.free)),
+                percent=fs.percent
+            ),
+            instances_mb=int(utils.to_MB(sum(row[1] for row in rows))),
+            instances=len(rows),
+            quota_mb=self._quota_mb,
+            quota_action=self._quota_action,
+            top=[
+                dict(instance_id=instance_id, mb=int(utils.to_MB(total)))
+                for instance_id, total in rows[:top]
+            ],
+            over_quota=[
+                instance_id for instance_id, total in rows
+                if quota and total > quota
+            ]
+        )
+
+    def ensure_started(self):
+        # threads do not survive fork, every worker runs a scanner, only
+        # the one holding the host lock scans
+        if not self._interval or self._pid == os.getpid():
+            return
+        with self._lock:
+            if self._pid == os.getpid():
+                return
+            self._pid = os.getpid()
+            # caches of the parent process are stale
+            self._caches = {}
+        scanner = threading.Thread(target=self._run, name="disk-scanner")
+        scanner.daemon = True
+        scanner.start()
+
+    def _run(self):
+        lower_io_priority()
+        while True:
+            try:
+                with agent.host_lock("disk-scan"):
+                    self._scan_forever()
+            except BaseException:
+                logger.warn("scanning disk usage failed", exc_info=True)
+            time.sleep(self._interval)
+
+    def _scan_forever(self):
+        while True:
+            self._wakeup.clear()
+            self.scan_all()
+            self._wakeup.wait(self._interval)
+
+    def scan_all(self):
+        started = time.time()
+        instance_ids = registry.ids()
+        rows = []
+        for instance_id in instance_ids:
+            try:
+                usage, total = self.scan(instance_id)
+            except OSError:
+                logger.warn("scan {0} failed".format(instance_id),
+                            exc_info=True)
+                continue
+            rows.append((
+                instance_id, json.dumps(usage, sort_keys=True), total,
+                time.time()
+            ))
+        # one transaction for the whole host
+        with registry.conn:
+            registry.conn.execute("DELETE FROM disk_usage")
+            registry.conn.executemany(
+                "INSERT INTO disk_usage VALUES (?, ?, ?, ?)", rows
+            )
+        # forget dirs of removed instances
+        prefixes = tuple(
+            os.path.join(agent.playground, instance_id) + os.sep
+            for instance_id in instance_ids
+        )
+        self._caches = {
+            path: cache for path, cache in self._caches.items()
+            if path.startswith(prefixes)
+        }
+        logger.debug("scanned {0} playgrounds in {1:.2f}s".format(
+            len(instance_ids), time.time() - started
+        ))
+
+    def scan(self, instance_id):
+        """
+        Returns ``(bytes by dir, total bytes)`` used by ``instance_id``
+        """
+        playground = os.path.join(agent.playground, instance_id)
+        usage = dict(
+            (name, self.dir_size(os.path.join(playground, name)))
+            for name in DIRS
+        )
+        total = sum(usage.values())
+        quota = self._quota_mb * 1024 * 1024
+        if quota and total > quota:
+            total = self.over_quota(instance_id, playground, usage, quota)
+        else:
+            self._over_quota.discard(instance_id)
+        return usage, total
+
+    def dir_size(self, path):
+        """
+        Returns bytes used by the files under ``path``, listing only the
+        directories changed since the last scan
+        """
+        try:
+            mtime_ns = os.stat(path).st_mtime_ns
+        except FileNotFoundError:
+            self._caches.pop(path, None)
+            return 0
+        cache = self._caches.get(path)
+        if cache is None or cache.mtime_ns != mtime_ns:
+            files, subdirs = [], []
+            for entry in os.scandir(path):
+                if entry.is_dir(follow_symlinks=False):
+                    subdirs.append(entry.name)
+                elif entry.is_file(follow_symlinks=False):
+                    files.append(entry.name)
+            cache = self._caches[path] = DirCache(mtime_ns, files, subdirs)
+
+        size = 0
+        for name in cache.files:
+            try:
+                # files grow without changing the mtime of their dir
+                size += os.stat(os.path.join(path, name)).st_blocks * 512
+            except FileNotFoundError:
+                continue
+        for name in cache.subdirs:
+            size += self.dir_size(os.path.join(path, name))
+        return size
+
+    def over_quota(self, instance_id, playground, usage, quota):
+        """
+        Report ``instance_id`` over ``quota`` bytes, cut its logs down if
+        configured so
+
+        :returns: bytes used afterwards
+        """
+        total = sum(usage.values())
+        if instance_id not in self._over_quota:
+            self._over_quota.add(instance_id)
+            logger.warn("{0} uses {1}MB, over its {2}MB quota".format(
+                instance_id, int(utils.to_MB(total)), self._quota_mb
+            ))
+            event_journal.publish(
+                instance_id, "disk-quota-exceeded", source="agent",
+                used_mb=int(utils.to_MB(total)), quota_mb=self._quota_mb
+            )
+        if self._quota_action != "truncate":
+            return total
+
+        for path, truncate in self.log_victims(playground):
+            if total <= quota:
+                break
+            try:
+                size = os.stat(path).st_blocks * 512
+                if truncate:
+                    os.truncate(path, 0)
+                else:
+                    os.remove(path)
+            except FileNotFoundError:
+                continue
+            if path.endswith(".gz") and os.path.exists(logs.index_path(path)):
+                size += os.stat(logs.index_path(path)).st_blocks * 512
+                os.remove(logs.index_path(path))
+            total -= size
+            logger.warn("{0} over quota, {1} {2}".format(
+                instance_id, "truncated" if truncate else "removed", path
+            ))
+        for name in LOG_DIRS:
+            usage[name] = self.dir_size(os.path.join(playground, name))
+        return sum(usage.values())
+
+    def log_victims(self, playground):
+        """
+        Yields ``(path, truncate)`` of the logs to cut, archives oldest
+        first, then rotated backups, then live logs to truncate
+        """
+        archives, backups, live = [], [], []
+        for name in LOG_DIRS:
+            log_dir = os.path.join(playground, name)
+            archive_dir = os.path.join(log_dir, logs.ARCHIVE_DIR)
+            try:
+                # indexes go with their archive
+                archives.extend(
+                    os.path.join(archive_dir, entry)
+                    for entry in os.listdir(archive_dir)
+                    if logs.ARCHIVE_PATTERN.match(entry) is not None
+                )
+            except FileNotFoundError:
+                pass
+            try:
+                entries = os.listdir(log_dir)
+            except FileNotFoundError:
+                continue
+            for entry in entries:
+                path = os.path.join(log_dir, entry)
+                if not os.path.isfile(path):
+                    continue
+                if entry.rsplit(".", 1)[-1].isdigit():
+                    backups.append(path)
+                else:
+                    live.append(path)
+
+        def mtime(path):
+            try:
+                return os.stat(path).st_mtime
+            except FileNotFoundError:
+                return 0
+
+        for path in sorted(archives, key=mtime):
+            yield path, False
+        for path in sorted(backups, key=mtime):
+            yield path, False
+        for path in sorted(live, key=mtime):
+            yield path, True
+
+
+disk_usage = DiskUsage()
@@ -4,27 +4,41 @@ Docker Instance Class
 for high-level chulai app controlling
 """
 
-import configparser
-import functools
+import concurrent.futures
+import hashlib
+import itertools
 import json
 import logging
 import os
-import xmlrpc
-import xmlrpc.client
+import re
 import signal
+import threading
 import time
 
 import docker
 import psutil
-import requests
 import shcmd
 
 from .. import consts
 from .. import errors
 from .. import utils
 from ..agent import agent
-from ..clients import docker_client, supervisor_client
-
+from ..clients import docker_client
+from ..job.manager import SUCCESS, job_manager
+from ..timings import timings
+
+from . import logs
+from .capacity import capacity, requested_memory
+from .cgroup import cgroup_stats
+from .container_index import container_index
+from .counters import PULL_BUCKETS, counters
+from .disk import disk_usage
+from .events import event_journal
+from .health import health_checker
+from .reaper import reaper
+from .registry import parse_conf, registry
+from .runtime import get_runtime
+from .sampler import metrics_sampler
 from .template_loader import render_template
 
 
@@ -35,13 +49,269 @@ def get_repo_tag(image_tag):
     return image_tag.split(":", 1)
 
 
-def pull_image(image_tag):
+def conf_digest(supervisor_conf):
+    return hashlib.sha1(supervisor_conf.encode("utf-8")).hexdigest()
+
+
+class PullFlight(object):
+    """one in-progress pull, shared by every deploy waiting for it"""
+
+    def __init__(self):
+        self.done = threading.Event()
+        self.error = None
+
+
+_pulls_lock = threading.Lock()
+_pulls = {}
+
+
+def image_exists(image_tag):
+    try:
+        docker_client.inspect_image(image_tag)
+    except docker.errors.APIError as exc:
+        if exc.response.status_code != 404:
+            raise
+        return False
+    return True
+
+
+def stream_pull(image_tag):
+    """pull ``image_tag``, parsing progress as it arrives"""
     repo, tag = get_repo_tag(image_tag)
-    res = docker_client.pull(repo, tag, insecure_registry=True)
-    last_log = json.loads(res.splitlines()[-1])
-    msg = last_log.get("errorDetail", {}).get("message")
-    if msg:
-        raise errors.NotFoundError("pulling image error: {0}".format(msg))
+    stream = docker_client.pull(
+        repo, tag, insecure_registry=True, stream=True
+    )
+    for line in stream:
+        if isinstance(line, bytes):
+            line = line.decode("utf-8")
+        if not line.strip():
+            continue
+        progress = json.loads(line)
+        msg = progress.get("errorDetail", {}).get("message")
+        msg = msg or progress.get("error")
+        if msg:
+            raise errors.NotFoundError("pulling image error: {0}".format(msg))
+
+
+def pull_image(image_tag, force=False):
+    """
+    Make sure ``image_tag`` is available locally
+
+    concurrent pulls of one image, from any thread or worker on this host,
+    are done once, and the pull is skipped if the image is already local
+
+    :param force: pull even if the image is already local
+    """
+    with _pulls_lock:
+        flight = _pulls.get(image_tag)
+        leader = flight is None
+        if leader:
+            flight = _pulls[image_tag] = PullFlight()
+
+    if not leader:
+        logger.info("waiting for ongoing pull of {0}".format(image_tag))
+        flight.done.wait()
+        if flight.error is not None:
+            raise flight.error
+        return
+
+    try:
+        lock_name = "pull-{0}".format(re.sub(r"[^\w.-]", "_", image_tag))
+        with agent.host_lock(lock_name):
+            if force or not image_exists(image_tag):
+                logger.info("pulling {0}".format(image_tag))
+                started = time.time()
+                stream_pull(image_tag)
+                counters.observe(
+                    "chulai_pull_duration_seconds",
+                    time.time() - started,
+                    PULL_BUCKETS
+                )
+            else:
+                logger.info("{0} already pulled".format(image_tag))
+    except BaseException as exc:
+        flight.error = exc
+        raise
+    finally:
+        with _pulls_lock:
+            del _pulls[image_tag]
+        flight.done.set()
+
+
+def collect_metrics(proc):
+    """
+    Returns metrics of process ``proc``
+
+    :param proc: ``psutil.Process``, reuse the same object across calls to
+                 get a meaningful ``cpu_percent``
+    """
+    with timings.timed("psutil.collect_metrics"):
+        ctx_switches = proc.num_ctx_switches()
+        mem_info = proc.memory_info()
+        cpu_info = proc.cpu_times()
+
+        return {
+            "cpu_percent": proc.cpu_percent(),
+            "memroy_percent": proc.memory_percent(),
+            "voluntary_switches": ctx_switches.voluntary,
+            "involuntary_switches": ctx_switches.involuntary,
+            "threads": proc.num_threads(),
+            "rss_in_mb": utils.to_MB(mem_info.rss),
+            "vms_in_mb": utils.to_MB(mem_info.vms),
+            "user_time": cpu_info.user,
+            "system_time": cpu_info.system,
+            "children": [
+                " ".join(child.cmdline())
+                for child in proc.children()
+            ]
+        }
+
+
+def list_instance_ids():
+    """
+    Returns ids of all instances deployed on this host
+    """
+    return registry.ids()
+
+
+def gather_stats(instance_ids=None):
+    """
+    Returns state and stats of many instances in one pass
+
+    supervisor state comes from a single snapshot and containers are
+    resolved through the container index, so the cost grows with the
+    number of instances only
+
+    :param instance_ids: ids to report, all instances on host if None
+    """
+    if instance_ids is None:
+        instance_ids = list_instance_ids()
+    process_infos = get_runtime().all_process_info()
+
+    results = []
+    for instance_id in instance_ids:
+        entry = dict(instance_id=instance_id, state=None, stats=None)
+        results.append(entry)
+        info = process_infos.get(instance_id)
+        if info is None:
+            entry["error"] = "not found"
+            continue
+        entry["state"] = info["statename"]
+        if info["state"] not in consts.SUPERVISOR_RUNNING_STATES:
+            continue
+        try:
+            entry["stats"] = DockerInstance(instance_id).stats
+        except errors.AgentError as exc:
+            entry["error"] = exc.message
+        except psutil.Error as exc:
+            entry["error"] = "gathering metric failed: {0}".format(exc)
+    return results
+
+
+def list_instances(
+    ids=None,
+    state=None,
+    offset=0,
+    limit=None,
+    with_stats=True,
+    **filters
+):
+    """
+    Returns ``(total, instances)``, a page of the registered instances
+    matching the filters, with their spec, state and (optionally) stats
+
+    requested ``ids`` that are not deployed on this host are reported
+    on the first page as ``not found`` entries, outside of ``total``
+
+    :param state: supervisor state name, like ``RUNNING``
+    :param filters: ``app_id``, ``commit`` or ``image_tag`` of registry
+    """
+    if state is None:
+        total, specs = registry.query(ids, offset, limit, **filters)
+    else:
+        _, specs = registry.query(ids, **filters)
+        process_infos = get_runtime().all_process_info()
+        specs = [
+            (instance_id, spec) for instance_id, spec in specs
+            if process_infos.get(instance_id, {}).get("statename") == state
+        ]
+        total = len(specs)
+        end = None if limit is None else offset + limit
+        specs = specs[offset:end]
+
+    instance_ids = [instance_id for instance_id, _ in specs]
+    if with_stats:
+        instances = gather_stats(instance_ids)
+    else:
+        process_infos = get_runtime().all_process_info()
+        instances = [
+            dict(
+                instance_id=instance_id,
+                state=process_infos.get(instance_id, {}).get("statename")
+            )
+            for instance_id in instance_ids
+        ]
+    for instance, (_, spec) in zip(instances, specs):
+        instance["spec"] = spec
+
+    if ids is not None and offset == 0:
+        _, registered = registry.query(ids)
+        registered = set(instance_id for instance_id, _ in registered)
+        instances.extend(
+            dict(
+                instance_id=instance_id,
+                state=None,
+                stats=None,
+                error="not found"
+            )
+            for instance_id in ids if instance_id not in registered
+        )
+    return total, instances
+
+
+def run_many(operation, calls, concurrency):
+    """
+    Run operations on many instances with bounded parallelism
+
+    pulls of a shared image and supervisor reloads are shared between
+    the operations, each one is a job that waits for the other jobs of its
+    instance, like a single operation does
+
+    :param operation: name of the jobs
+    :param calls: ``(instance_id, func, args, kwargs)`` tuples, ``func``
+                  is called with an extra ``phase`` recorder
+    :param concurrency: max operations running at once
+    :returns: result of each call, in order
+    """
+    # calls made by the pool count for the request being debugged
+    calls_of_request = timings.current_calls()
+
+    def run_one(instance_id, func, args, kwargs):
+        with timings.collect_into(calls_of_request):
+            job = job_manager.run(
+                operation, instance_id, func, *args, **kwargs
+            )
+        result = dict(
+            instance_id=instance_id,
+            job_id=job.job_id,
+            phases=job.phases,
+            elapsed=job.finished_at - job.created_at
+        )
+        if job.state == SUCCESS:
+            result.update(status=consts.SUCCESS, message=job.result)
+        else:
+            result.update(
+                status=consts.ERROR,
+                message=job.error["message"],
+                status_code=job.error["status_code"]
+            )
+        return result
+
+    if not calls:
+        return []
+    with concurrent.futures.ThreadPoolExecutor(concurrency) as executor:
+        futures = [executor.submit(run_one, *call) for call in calls]
+        return [future.result() for future in futures]
 
 
 class DockerInstance(object):
@@ -60,36 +330,36 @@ class DockerInstance(object):
         return self._instance_id
 
     @property
-    def supervisor_conf_path(self):
-        return os.path.join(
-            supervisor_client.conf_dir, "{0}.ini".format(self.instance_id)
-        )
+    def conf_path(self):
+        return get_runtime().conf_path(self.instance_id)
 
     @property
     def config(self):
+        """
+        Returns the chulai config of this instance, from the registry when
+        possible, from the supervisor conf otherwise
+        """
+        config = registry.get(self.instance_id)
+        if config is not None:
+            return config
+
         try:
-            with open(self.supervisor_conf_path) as conf_f:
+            with open(self.conf_path) as conf_f:
                 supervisor_conf = conf_f.read()
         except (FileNotFoundError, PermissionError) as exc:
             raise errors.AgentError(
                 "error reading supervisor conf [{0}]| {1}".format(
-                    self.supervisor_conf_path, exc
+                    self.conf_path, exc
                 )
             )
-
-        ini = configparser.ConfigParser()
-        ini.read_string(supervisor_conf)
-        section_name = "chulai:{0}".format(self.instance_id)
-        if ini.has_section(section_name) is False:
-            raise errors.AgentError(
-                "config has no valid section:\n{0}\n".format(supervisor_conf)
-            )
-        return functools.partial(ini.get, section_name)
+        config = parse_conf(self.instance_id, supervisor_conf)
+        registry.put(self.instance_id, config)
+        return config
 
     def get_config(self, key, *args):
         try:
-            return self.config(key)
-        except configparser.NoOptionError:
+            return self.config[key]
+        except KeyError:
             # if we have an default value, return it
             # otherwise we raise exception
             if len(args) == 0:
@@ -109,11 +379,10 @@ class DockerInstance(object):
         """
         Returns container id of current project
         """
-        for container in docker_client.containers(all=True):
-            name = "/{0}".format(self.instance_id)
-            if name in (container.get("Names") or []):
-                return container["Id"]
-        raise errors.AgentError("can not find cid of {0}".format(self))
+        cid = container_index.get(self.instance_id)
+        if cid is None:
+            raise errors.AgentError("can not find cid of {0}".format(self))
+        return cid
 
     @property
     def pid(self):
@@ -121,8 +390,9 @@ class DockerInstance(object):
         Returns the pid of current project
         Raises running error when project is not running
         """
+        cid = self.cid
         try:
-            container_info = docker_client.inspect_container(self.cid)
+            container_info = docker_client.inspect_container(cid)
             state = container_info["State"]
             running = state["Running"]
             pid = state["Pid"]
@@ -130,7 +400,7 @@ class DockerInstance(object):
             if exc.response.status_code != 404:
                 raise
             raise errors.AgentError(
-                "can not find container with cid: [{0}]".format(self.cid)
+                "can not find container with cid: [{0}]".format(cid)
             )
         except KeyError:
             raise errors.AgentError(
@@ -156,9 +426,22 @@ class DockerInstance(object):
             "{0} invalid state: {1}".format(self, state), 500
         )
 
+    @property
+    def environments(self):
+        """environments passed to the container"""
+        environments = json.loads(self.get_config("envs", "{}"))
+        # runtime settings, they are not part of the app's environments
+        for key in ("START_TIMEOUT", "STOP_TIMEOUT", "MEMORY_LIMIT"):
+            environments.pop(key, None)
+        return environments
+
+    @property
+    def http_check_url(self):
+        return self.get_config("http-check-url", "")
+
     @property
     def is_http_app(self):
-        return False
+        return bool(self.http_check_url)
 
     @property
     def stats(self):
@@ -170,35 +453,77 @@ class DockerInstance(object):
                 "{0} not running, stats is meaningless".format(self)
             )
 
-        proc = psutil.Process(self.pid)
-        logger.info(
-            "gathering metric for {0}[{1}]".format(self.instance_id, self.pid)
-        )
-
-        ctx_switches = proc.num_ctx_switches()
-        mem_info = proc.memory_info()
-        cpu_info = proc.cpu_times()
+        metrics = metrics_sampler.latest(self.instance_id)
+        if metrics is None:
+            metrics = self._collect_stats()
+        # the sampler's dict is shared, usage is added to a copy
+        return dict(metrics, disk=disk_usage.usage(self.instance_id))
 
-        metrics = {
-            "cpu_percent": proc.cpu_percent(),
-            "memroy_percent": proc.memory_percent(),
-            "voluntary_switches": ctx_switches.voluntary,
-            "involuntary_switches": ctx_switches.involuntary,
-            "threads": proc.num_threads(),
-            "rss_in_mb": utils.to_MB(mem_info.rss),
-            "vms_in_mb": utils.to_MB(mem_info.vms),
-            "user_time": cpu_info.user,
-            "system_time": cpu_info.system,
-            "children": [
-                " ".join(child.cmdline())
-                for child in proc.children()
-            ]
-        }
+    def _collect_stats(self):
+        """
+        Returns metrics collected on the spot, until the sampler has a
+        primed sample: ``cpu_percent`` needs two readings, so it is None
+        and ``stale`` tells the sample is not the sampler's
+        """
+        if agent.stats_backend == "cgroup":
+            metrics = cgroup_stats.stats(self.cid)
+        else:
+            pid = self.pid
+            logger.info(
+                "gathering metric for {0}[{1}]".format(self.instance_id, pid)
+            )
+            metrics = collect_metrics(psutil.Process(pid))
+        metrics["cpu_percent"] = None
+        metrics["stale"] = True
         return metrics
 
-    def get_log(self, log_path, lastn, timeout):
-        real_path = self.playground, log_path.lstrip("/")
-        return shcmd.tailf(real_path, lastn=lastn, timeout=timeout)
+    def log_paths(self, stream, file_name=None):
+        """
+        Returns a log file, its rotated backups and archives, newest first
+
+        :param stream: ``stdout``, ``stderr`` or ``app``
+        :param file_name: file in ``chulai-log.d`` for the ``app`` stream
+        """
+        if stream in ("stdout", "stderr"):
+            path = os.path.join(self.stdlogs_dir, "{0}.log".format(stream))
+        elif stream == "app":
+            file_name = file_name or "production.log"
+            if os.path.basename(file_name) != file_name or \
+                    file_name.startswith("."):
+                raise errors.AgentError(
+                    "invalid log file {0}".format(file_name), 400
+                )
+            path = os.path.join(self.logs_dir, file_name)
+        else:
+            raise errors.AgentError(
+                "unknown log stream {0}".format(stream), 400
+            )
+        backups = [
+            "{0}.{1}".format(path, index)
+            for index in range(1, agent.log_backups + 1)
+        ]
+        return [path] + backups + list(reversed(logs.archives(path)))
+
+    def get_log(self, stream, lastn, follow=False, timeout=0,
+                file_name=None):
+        """
+        Returns an iterator over the last ``lastn`` lines of a log stream,
+        followed by the lines appended in the next ``timeout`` seconds if
+        ``follow``
+        """
+        paths = self.log_paths(stream, file_name)
+        lines = logs.tail(paths, lastn)
+        if not follow:
+            return iter(lines)
+        return itertools.chain(lines, logs.follow(paths[0], timeout))
+
+    def get_log_range(self, stream, start, end, limit, file_name=None):
+        """
+        Returns an iterator over at most ``limit`` lines of a log stream
+        logged from ``start`` to ``end``, unix timestamps
+        """
+        paths = self.log_paths(stream, file_name)
+        return itertools.islice(logs.read_range(paths, start, end), limit)
 
     def pull_up(
         self,
@@ -207,133 +532,264 @@ class DockerInstance(object):
         image_tag,
         environments,
         worker,
-        port
+        port,
+        force_pull=False,
+        phase=utils.null_phase
+    ):
+        try:
+            status = self._pull_up(
+                app_id, commit, image_tag, environments, worker, port,
+                force_pull, phase
+            )
+        except BaseException:
+            counters.incr("chulai_failures_total", operation="pull up")
+            raise
+        counters.incr("chulai_deploys_total")
+        event_journal.publish(
+            self.instance_id, "deployed", source="agent", app_id=app_id,
+            commit=commit
+        )
+        return status
+
+    def _pull_up(
+        self,
+        app_id,
+        commit,
+        image_tag,
+        environments,
+        worker,
+        port,
+        force_pull,
+        phase
     ):
         if self.state is not None:
             raise errors.AgentError("{0} ".format(self), 409)
         app_id = str(app_id)
+        # fail before a long pull, the memory is only committed at prepare
+        capacity.check(self.instance_id, requested_memory(environments))
         # prepare image
-        pull_image(image_tag)
-        # prepare dirs
-        for dir_path in self.dirs_to_make:
-            shcmd.mkdir(dir_path)
-        # prepare supervisor stuff
-        supervisor_conf, debug_script = self.make_supervisor_conf(
-            app_id,
-            commit,
-            image_tag,
-            environments,
-            worker,
-            port
-        )
-        with open(self.supervisor_conf_path, "wt") as conf_f:
-            conf_f.write(supervisor_conf)
+        with phase("pull image"):
+            pull_image(image_tag, force=force_pull)
+        with phase("prepare"):
+            # prepare dirs
+            for dir_path in self.dirs_to_make:
+                shcmd.mkdir(dir_path)
+            # prepare supervisor stuff
+            supervisor_conf, debug_script = self.make_supervisor_conf(
+                app_id,
+                commit,
+                image_tag,
+                environments,
+                worker,
+                port
+            )
+            self.write_conf(supervisor_conf, debug_script)
+        try:
+            with phase("add to runtime"):
+                # raises if the runtime could not add it
+                get_runtime().add(self)
+        except BaseException:
+            # the runtime doesn't know it, so a retry starts from scratch
+            # and must not find the memory committed already
+            shcmd.rm(self.conf_path)
+            registry.remove(self.instance_id)
+            raise
+        # done preparation
+
+        return self._start(phase, running=False)
+
+    def write_conf(self, supervisor_conf, debug_script, committed_mb=0):
+        """
+        Write and register the conf, once the host has memory for it
+
+        :param committed_mb: memory limit already committed to the instance
+        """
+        config = parse_conf(self.instance_id, supervisor_conf)
+        with capacity.admit(
+            self.instance_id,
+            max(0, int(config["memory_limit"]) - committed_mb)
+        ):
+            with open(self.conf_path, "wt") as conf_f:
+                conf_f.write(supervisor_conf)
+            registry.put(self.instance_id, config)
         # create symlink for debug, we can view all config in playground
         with shcmd.cd(self.playground, create=True):
-            shcmd.rm("supervisor.conf")
-            os.symlink(self.supervisor_conf_path, "supervisor.conf")
+            if os.path.dirname(self.conf_path) != self.playground:
+                shcmd.rm("supervisor.conf")
+                os.symlink(self.conf_path, "supervisor.conf")
             with open("go-to-docker.sh", "wt") as script_f:
                 script_f.write(debug_script)
+
+    def spec_changed(self, app_id, commit, image_tag, environments, worker,
+                     port):
+        """
+        Returns whether the conf rendered from the spec differs from the
+        applied one
+        """
+        supervisor_conf, _ = self.make_supervisor_conf(
+            str(app_id), commit, image_tag, dict(environments), worker, port
+        )
+        return conf_digest(supervisor_conf) != self.conf_digest
+
+    @property
+    def conf_digest(self):
+        """
+        Returns the digest of the applied conf, None if there is none
+        """
         try:
-            supervisor_client.reloadConfig()
-            supervisor_client.addProcessGroup(self.instance_id)
-            if self.state is None:
-                raise errors.AgentError(
-                    "add {0} to supervisor failed".format(self)
-                )
-        except xmlrpc.client.Fault as exc:
-            raise errors.AgentError(
-                "deploy {0} error: {1}".format(self.instance_id, exc)
+            with open(self.conf_path) as conf_f:
+                return conf_digest(conf_f.read())
+        except FileNotFoundError:
+            return None
+
+    def apply(
+        self,
+        app_id,
+        commit,
+        image_tag,
+        environments,
+        worker,
+        port,
+        force_pull=False,
+        phase=utils.null_phase
+    ):
+        """
+        Bring the instance to the spec with the least work: deploy it if it
+        does not exist, leave it if its conf is unchanged, else rewrite the
+        conf and restart it in place, keeping its playground
+        """
+        if not self.exists:
+            return self.pull_up(
+                app_id, commit, image_tag, environments, worker, port,
+                force_pull, phase
             )
-        # done preparation
+        try:
+            status = self._apply(
+                app_id, commit, image_tag, environments, worker, port,
+                force_pull, phase
+            )
+        except BaseException:
+            counters.incr("chulai_failures_total", operation="apply")
+            raise
+        return status
 
-        return self.start()
+    def _apply(
+        self,
+        app_id,
+        commit,
+        image_tag,
+        environments,
+        worker,
+        port,
+        force_pull,
+        phase
+    ):
+        app_id = str(app_id)
+        supervisor_conf, debug_script = self.make_supervisor_conf(
+            app_id, commit, image_tag, dict(environments), worker, port
+        )
+        if conf_digest(supervisor_conf) == self.conf_digest:
+            return "{0} unchanged".format(self)
+        with phase("pull image"):
+            pull_image(image_tag, force=force_pull)
+        running = self.running
+        with phase("update conf"):
+            committed = registry.get(self.instance_id) or {}
+            self.write_conf(
+                supervisor_conf, debug_script,
+                int(committed.get("memory_limit") or 0)
+            )
+        # supervisor only picks up a changed program by re-adding its group,
+        # docker by re-creating the container
+        with phase("stop and remove" if running else "remove"):
+            get_runtime().remove(self, stop=running)
+        with phase("add to runtime"):
+            get_runtime().add(self)
+        self._start(phase, running=False)
+        event_journal.publish(
+            self.instance_id, "updated", source="agent", app_id=app_id,
+            commit=commit
+        )
+        return "updated {0}".format(self)
 
-    def start(self):
+    def start(self, phase=utils.null_phase):
+        return self._start(phase, running=self.running)
+
+    def _start(self, phase, running):
         status = "already running"
-        if self.running is False:
+        if running is False:
             status = "started"
-            try:
-                supervisor_client.startProcess(self.instance_id)
-            except xmlrpc.client.Fault as exc:
-                raise errors.AgentError(
-                    "start instance {0} failed: {1}".format(self, exc)
-                )
+            with phase("start"):
+                get_runtime().start(self)
         if self.is_http_app:
-            self.check_http()
+            with phase("check http"):
+                self.check_http()
         return status
 
-    def put_down(self):
+    def put_down(self, phase=utils.null_phase):
+        try:
+            result = self._put_down(phase)
+        except BaseException:
+            counters.incr("chulai_failures_total", operation="put down")
+            raise
+        counters.incr("chulai_teardowns_total")
+        return result
+
+    def _put_down(self, phase):
         try:
             cid = None
             if not self.exists:
                 return "{0} not exists".format(self)
-            if self.running:
+            running = self.running
+            if running:
                 cid = self.cid
-                supervisor_client.stopProcess(self.instance_id)
-            supervisor_client.removeProcessGroup(self.instance_id)
-            supervisor_client.reloadConfig()
-            if self.exists:
-                raise errors.AgentError("put down {0} failed".format(self))
+            # raises if the runtime could not stop or remove it
+            with phase("stop and remove" if running else "remove"):
+                get_runtime().remove(self, stop=running)
+            event_journal.publish(self.instance_id, "removed", source="agent")
             return "put down {0} success".format(self)
-        except xmlrpc.client.Fault as exc:
-            raise errors.AgentError(
-                "stop {0} failed: {1}".format(self, exc), 409,
-                payload=dict(instance=str(self), operation="put down")
-            )
         finally:
-            self.cleanup(cid)
+            with phase("cleanup"):
+                self.cleanup(cid)
 
     def cleanup(self, cid):
         try:
             if cid is not None:
-                docker_client.kill(self.cid, signal.SIGKILL)
-        except errors.NotFoundError:
-            logger.info("container already quited")
+                docker_client.kill(cid, signal.SIGKILL)
+        except docker.errors.APIError as exc:
+            if exc.response.status_code == 404:
+                logger.info("container already quited")
+            else:
+                logger.warn(
+                    "trying to kill {0}, but failed".format(self.instance_id),
+                    exc_info=True
+                )
         except BaseException:
             logger.warn(
                 "trying to kill {0}, but failed".format(self.instance_id),
                 exc_info=True
             )
         # remove supervisor config
-        shcmd.rm(self.supervisor_conf_path)
-        # clean playground, TODO backup to object-storage
-        shcmd.rm(self.playground, isdir=True)
+        shcmd.rm(self.conf_path)
+        registry.remove(self.instance_id)
+        # playground is archived and deleted in background
+        reaper.trash(self.playground, self.instance_id)
 
     def check_http(self):
-        timedout = time.time() + self.start_timeout
-        check_interval = min(self.start_timeout / 10, 0.1)
-        tip = None
-        check_url = self.get_config("http-check-url")
-
-        while time.time() < timedout:
-            try:
-                logger.info("goging to check {0}".format(check_url))
-                res = requests.get(check_url, timeout=(timedout - time.time()))
-                logger.info("examing {0}: {1}".format(self, res.status_code))
-                break
-            except requests.RequestException as exc:
-                tip = "start {0} failed, timedout({1})s: {2}".format(
-                    self, self.start_timeout, exc
-                )
-                logger.debug(tip, exc_info=True)
-                time.sleep(check_interval)
-        else:
-            raise errors.AgentError(tip)
+        start_timeout = self.get_config("start_sec", agent.start_timeout)
+        health_checker.wait_ready(
+            self.instance_id, self.http_check_url, float(start_timeout)
+        )
 
     @property
     def state(self):
-        state = None
-        try:
-            state = supervisor_client.getProcessInfo(self.instance_id)["state"]
-        except xmlrpc.client.Fault as exc:
-            if exc.faultCode != 10:
-                raise errors.AgentError(
-                    "get {0} info error: {1}".format(self, exc),
-                    500
-                )
-        finally:
-            return state
+        """
+        Returns supervisor state of this instance, None if not exists
+        """
+        info = get_runtime().process_info(self)
+        if info is None:
+            return None
+        return info["state"]
 
     @property
     def playground(self):
@@ -0,0 +1,85 @@
+"""
+Supervisor Event Listener
+
+run by supervisor as an ``[eventlistener:x]`` subscribed to
+``PROCESS_STATE``, journals the state changes of instance processes into
+the agent's event journal, see ``deploy/chulai-events.conf``
+
+it only needs the journal storage, none of the agent's clients
+
+Usage::
+
+    python -m chulai_agent.instance.eventlistener /path/to/.registry.db
+"""
+
+import logging
+import sys
+
+from .journal import append, connect
+
+
+__all__ = ["main"]
+logger = logging.getLogger(__name__)
+
+EVENT_PREFIX = "PROCESS_STATE_"
+KEEP = 10000
+
+
+def parse_tokens(line):
+    """Returns ``key:value`` tokens of a header or payload line"""
+    return dict(token.split(":", 1) for token in line.split())
+
+
+def is_instance(conn, instance_id):
+    return conn.execute(
+        "SELECT 1 FROM instances WHERE instance_id = ?", (instance_id,)
+    ).fetchone() is not None
+
+
+def handle(conn, event_name, payload, keep=KEEP):
+    """journal a ``PROCESS_STATE_*`` event of an instance"""
+    if not event_name.startswith(EVENT_PREFIX):
+        return
+    tokens = parse_tokens(payload.split("\n", 1)[0])
+    # instances are groups of a single program named after them
+    instance_id = tokens.get("groupname")
+    if instance_id is None or not is_instance(conn, instance_id):
+        return
+    data = dict(source="supervisor", from_state=tokens.get("from_state"))
+    if "expected" in tokens:
+        data["expected"] = tokens["expected"] == "1"
+    append(
+        conn, instance_id, event_name[len(EVENT_PREFIX):].lower(), keep,
+        **data
+    )
+
+
+def main(argv=None):
+    argv = sys.argv[1:] if argv is None else argv
+    if len(argv) != 1:
+        sys.stderr.write(__doc__)
+        return 2
+    # stdout speaks the listener protocol, log to stderr
+    logging.basicConfig(stream=sys.stderr, level=logging.INFO)
+    conn = connect(argv[0])
+    stdin, stdout = sys.stdin, sys.stdout
+    while True:
+        stdout.write("READY\n")
+        stdout.flush()
+        line = stdin.readline()
+        if not line:
+            # supervisor closed our stdin, it is stopping us
+            return 0
+        header = parse_tokens(line)
+        payload = stdin.read(int(header["len"]))
+        try:
+            handle(conn, header["eventname"], payload)
+        except Exception:
+            # a lost event beats a listener supervisor keeps restarting
+            logger.exception("journal {0} failed".format(payload))
+        stdout.write("RESULT 2\nOK")
+        stdout.flush()
+
+
+if __name__ == "__main__":
+    sys.exit(main())
@@ -0,0 +1,248 @@
+"""
+Instance Events
+
+a journal of instance lifecycle transitions, kept next to the instance
+registry in sqlite with increasing sequence ids, so every worker streams
+the same events and clients resume from the last id they saw
+
+it is fed by:
+
+* the agent itself: ``deployed``, ``updated``, ``removed`` and
+  ``disk-quota-exceeded``
+* the docker events stream, followed by one worker per host, the one
+  holding the ``events`` host lock: ``running``, ``exited`` and
+  ``oom-killed`` of instance containers
+* the supervisor event listener (see ``eventlistener``): ``starting``,
+  ``running``, ``backoff``, ``stopping``, ``stopped``, ``exited`` and
+  ``fatal`` of instance processes
+"""
+
+import json
+import logging
+import os
+import sqlite3
+import threading
+import time
+
+import requests
+
+from ..agent import agent
+from ..clients import docker_client
+
+from .container_index import container_index
+from .journal import SCHEMA, append
+from .registry import registry
+
+
+__all__ = ["event_journal"]
+logger = logging.getLogger(__name__)
+
+# where the docker events follower stopped: the time of the last event
+# it applied and the events of that second, a reconnect replays them
+CURSOR_SCHEMA = """
+CREATE TABLE IF NOT EXISTS docker_events_cursor (
+    id INTEGER PRIMARY KEY CHECK (id = 0),
+    since INTEGER NOT NULL,
+    seen TEXT NOT NULL
+);
+"""
+
+# docker container event -> instance event
+DOCKER_EVENTS = {
+    "start": "running",
+    "die": "exited",
+    "oom": "oom-killed",
+}
+
+
+def format_event(seq, at, instance_id, event, data):
+    """Returns a journal row as a server-sent event"""
+    payload = json.loads(data)
+    payload.update(seq=seq, time=at, instance_id=instance_id, event=event)
+    return "id: {0}\ndata: {1}\n\n".format(
+        seq, json.dumps(payload, sort_keys=True)
+    )
+
+
+class EventJournal(object):
+    def __init__(self):
+        self._keep = 10000
+        self._poll_interval = 0.5
+        self._keepalive = 15
+        self._retry = 5
+        self._published = threading.Condition()
+        self._lock = threading.Lock()
+        self._pid = None
+
+    def init_app(self, app):
+        self._keep = app.config.get("EVENTS_KEEP", 10000)
+        self._poll_interval = app.config.get("EVENTS_POLL_INTERVAL", 0.5)
+        with registry.conn:
+            registry.conn.executescript(SCHEMA)
+            registry.conn.executescript(CURSOR_SCHEMA)
+
+    def publish(self, instance_id, event, **data):
+        """
+        Journal ``event`` of ``instance_id`` with ``data``
+        """
+        try:
+            append(registry.conn, instance_id, event, self._keep, **data)
+        except sqlite3.Error:
+            # events must never fail the operation they report
+            logger.warn("journal {0} of {1} failed".format(
+                event, instance_id
+            ), exc_info=True)
+            return
+        with self._published:
+            self._published.notify_all()
+
+    def last_seq(self):
+        row = registry.conn.execute("SELECT MAX(seq) FROM events").fetchone()
+        return row[0] or 0
+
+    def since(self, seq, instance_id=None, limit=1000):
+        """
+        Returns journal rows after ``seq``, oldest first
+        """
+        query = "SELECT seq, time, instance_id, event, data FROM events " \
+            "WHERE seq > ?"
+        args = [seq]
+        if instance_id is not None:
+            query += " AND instance_id = ?"
+            args.append(instance_id)
+        return registry.conn.execute(
+            query + " ORDER BY seq LIMIT ?", args + [limit]
+        ).fetchall()
+
+    def stream(self, last_id, timeout, instance_id=None):
+        """
+        Yields server-sent events after ``last_id`` for ``timeout``
+        seconds, then ends, the client reconnects with the id it saw last
+
+        :param last_id: last id seen, None for only new events
+        """
+        self.ensure_started()
+        yield "retry: {0}\n\n".format(int(self._retry * 1000))
+        if last_id is None:
+            last_id = self.last_seq()
+        else:
+            oldest = registry.conn.execute(
+                "SELECT MIN(seq) FROM events"
+            ).fetchone()[0]
+            if oldest is not None and last_id + 1 < oldest:
+                # events were trimmed, the client has to list instances
+                yield "event: reset\ndata: {0}\n\n".format(
+                    json.dumps(dict(oldest=oldest))
+                )
+        deadline = time.time() + timeout
+        idle_since = time.time()
+        while time.time() < deadline:
+            rows = self.since(last_id, instance_id)
+            for row in rows:
+                last_id = row[0]
+                yield format_event(*row)
+            if rows:
+                idle_since = time.time()
+                continue
+            if time.time() - idle_since >= self._keepalive:
+                # proxies drop connections idle for too long
+                yield ": keepalive\n\n"
+                idle_since = time.time()
+            # other processes journal too, only this one's wake us early
+            with self._published:
+                self._published.wait(
+                    min(self._poll_interval, max(0, deadline - time.time()))
+                )
+
+    def ensure_started(self):
+        # threads do not survive fork, every worker runs a follower, only
+        # the one holding the host lock follows docker
+        if self._pid == os.getpid():
+            return
+        with self._lock:
+            if self._pid == os.getpid():
+                return
+            self._pid = os.getpid()
+        follower = threading.Thread(
+            target=self._lead, name="docker-events-follower"
+        )
+        follower.daemon = True
+        follower.start()
+
+    def _lead(self):
+        while True:
+            try:
+                with agent.host_lock("events"):
+                    self._follow_docker()
+            except BaseException:
+                logger.warn("following docker events failed", exc_info=True)
+            time.sleep(self._retry)
+
+    def _follow_docker(self):
+        # resume where the last leader stopped, events missed while no
+        # one followed are replayed by docker
+        since, seen = self._load_cursor()
+        while True:
+            try:
+                for event in docker_client.events(since=since):
+                    if not isinstance(event, dict):
+                        event = json.loads(event.decode("utf-8"))
+                    at = event.get("time", since)
+                    key = json.dumps(event, sort_keys=True)
+                    if at < since or key in seen:
+                        continue
+                    if at > since:
+                        since, seen = at, set()
+                    seen.add(key)
+                    if self._apply(event):
+                        self._save_cursor(since, seen)
+            except requests.exceptions.Timeout:
+                # idle stream, reconnect and replay from the last event
+                continue
+
+    def _load_cursor(self):
+        """
+        Returns ``(since, seen)`` the follower stopped at, now if none
+        """
+        row = registry.conn.execute(
+            "SELECT since, seen FROM docker_events_cursor WHERE id = 0"
+        ).fetchone()
+        if row is None:
+            return int(time.time()), set()
+        return row[0], set(json.loads(row[1]))
+
+    def _save_cursor(self, since, seen):
+        with registry.conn:
+            registry.conn.execute(
+                "INSERT OR REPLACE INTO docker_events_cursor "
+                "(id, since, seen) VALUES (0, ?, ?)",
+                (since, json.dumps(sorted(seen)))
+            )
+
+    def _apply(self, event):
+        """
+        Journal a docker ``event`` of an instance container, returns
+        whether it did
+        """
+        if event.get("Type", "container") != "container":
+            return False
+        status = event.get("status") or event.get("Action")
+        if status not in DOCKER_EVENTS:
+            return False
+        attrs = event.get("Actor", {}).get("Attributes", {})
+        # events of old daemons only have the container id
+        name = attrs.get("name") or container_index.name_of(
+            event.get("id", "")
+        ) or ""
+        instance_id = name.lstrip("/")
+        # containers are named after their instance
+        if not instance_id or registry.get(instance_id) is None:
+            return False
+        data = dict(source="docker")
+        if status == "die" and "exitCode" in attrs:
+            data["exit_code"] = int(attrs["exitCode"])
+        self.publish(instance_id, DOCKER_EVENTS[status], **data)
+        return True
+
+
+event_journal = EventJournal()
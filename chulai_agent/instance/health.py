@@ -0,0 +1,266 @@
+"""
+Health Checker
+
+probes instances' http check urls on one asyncio event loop: readiness
+checks with exponential backoff after start, and periodic liveness
+checks of every running http instance
+
+liveness is probed by one worker per host, the one holding the ``health``
+host lock, results are kept in sqlite next to the registry so every worker
+reports the same ones
+"""
+
+import asyncio
+import json
+import logging
+import os
+import threading
+import time
+import urllib.parse
+
+from .. import consts
+from .. import errors
+from ..agent import agent
+
+from .registry import registry
+from .runtime import get_runtime
+
+
+__all__ = ["health_checker"]
+logger = logging.getLogger(__name__)
+
+SCHEMA = """
+CREATE TABLE IF NOT EXISTS health (
+    instance_id TEXT PRIMARY KEY,
+    result TEXT NOT NULL
+);
+"""
+
+MIN_BACKOFF = 0.05
+MAX_BACKOFF = 1.0
+
+
+async def probe(url, timeout):
+    """
+    Returns the http status code of ``GET url``
+
+    any http response counts, the check only tells whether the app serves
+    """
+    parsed = urllib.parse.urlsplit(url)
+    path = parsed.path or "/"
+    if parsed.query:
+        path = "{0}?{1}".format(path, parsed.query)
+    request = (
+        "GET {0} HTTP/1.0\r\n"
+        "Host: {1}\r\n"
+        "User-Agent: {2}\r\n"
+        "\r\n"
+    ).format(path, parsed.netloc, consts.UA["user-agent"])
+
+    async def get():
+        reader, writer = await asyncio.open_connection(
+            parsed.hostname, parsed.port or 80
+        )
+        try:
+            writer.write(request.encode("latin-1"))
+            status_line = await reader.readline()
+        finally:
+            writer.close()
+        parts = status_line.split()
+        if len(parts) < 2 or not parts[0].startswith(b"HTTP/"):
+            raise ValueError("invalid response {0!r}".format(status_line))
+        return int(parts[1])
+
+    return await asyncio.wait_for(get(), timeout)
+
+
+class HealthChecker(object):
+    def __init__(self):
+        self._interval = 10
+        self._probe_timeout = 2
+        self._loop = None
+        self._pid = None
+        self._lock = threading.Lock()
+
+    def init_app(self, app):
+        self._interval = app.config.get("HEALTH_CHECK_INTERVAL", 10)
+        self._probe_timeout = app.config.get("HEALTH_CHECK_TIMEOUT", 2)
+        with registry.conn:
+            registry.conn.executescript(SCHEMA)
+
+    def result(self, instance_id):
+        """
+        Returns the latest check result of ``instance_id``, None if it was
+        never checked
+        """
+        self.ensure_started()
+        row = registry.conn.execute(
+            "SELECT result FROM health WHERE instance_id = ?", (instance_id,)
+        ).fetchone()
+        return json.loads(row[0]) if row is not None else None
+
+    def forget(self, instance_id):
+        with registry.conn:
+            registry.conn.execute(
+                "DELETE FROM health WHERE instance_id = ?", (instance_id,)
+            )
+
+    def wait_ready(self, instance_id, url, timeout):
+        """
+        Block until ``url`` answers, raise ``AgentError`` after ``timeout``
+        """
+        self.ensure_started()
+        future = asyncio.run_coroutine_threadsafe(
+            self._wait_ready(instance_id, url, timeout), self._loop
+        )
+        return future.result()
+
+    def ensure_started(self):
+        # event loops do not survive fork, every worker runs its own, only
+        # the one holding the host lock checks liveness
+        if self._pid == os.getpid():
+            return
+        with self._lock:
+            if self._pid == os.getpid():
+                return
+            self._loop = asyncio.new_event_loop()
+            runner = threading.Thread(
+                target=self._run, name="health-checker"
+            )
+            runner.daemon = True
+            runner.start()
+            if self._interval > 0:
+                leader = threading.Thread(
+                    target=self._lead, name="liveness-checker"
+                )
+                leader.daemon = True
+                leader.start()
+            self._pid = os.getpid()
+
+    def _run(self):
+        asyncio.set_event_loop(self._loop)
+        self._loop.run_forever()
+
+    def _lead(self):
+        while True:
+            try:
+                with agent.host_lock("health"):
+                    asyncio.run_coroutine_threadsafe(
+                        self._check_liveness(), self._loop
+                    ).result()
+            except BaseException:
+                logger.warn("leading liveness checks failed", exc_info=True)
+            time.sleep(self._interval)
+
+    async def _check(self, url, timeout):
+        started = time.time()
+        result = dict(url=url, checked_at=started)
+        try:
+            result["status_code"] = await probe(url, timeout)
+            result["live"] = True
+            result["error"] = None
+        except (OSError, ValueError, asyncio.TimeoutError) as exc:
+            result["status_code"] = None
+            result["live"] = False
+            result["error"] = str(exc) or exc.__class__.__name__
+        result["latency"] = time.time() - started
+        return result
+
+    async def _wait_ready(self, instance_id, url, timeout):
+        loop = asyncio.get_event_loop()
+        deadline = time.time() + timeout
+        backoff = MIN_BACKOFF
+        await loop.run_in_executor(None, self.forget, instance_id)
+        while True:
+            remaining = deadline - time.time()
+            result = await self._check(
+                url, min(self._probe_timeout, remaining)
+            )
+            result["ready"] = result["live"]
+            remaining = deadline - time.time()
+            if result["live"] or remaining <= 0:
+                await loop.run_in_executor(
+                    None, self._store, {instance_id: result}
+                )
+            if result["live"]:
+                return result
+            if remaining <= 0:
+                raise errors.AgentError(
+                    "start {0} failed, timedout({1})s: {2}".format(
+                        instance_id, timeout, result["error"]
+                    )
+                )
+            await asyncio.sleep(min(backoff, remaining))
+            backoff = min(backoff * 2, MAX_BACKOFF)
+
+    async def _check_liveness(self):
+        loop = asyncio.get_event_loop()
+        while True:
+            started = time.time()
+            try:
+                targets = await loop.run_in_executor(None, self._targets)
+                results = await asyncio.gather(*[
+                    self._check(url, self._probe_timeout)
+                    for url in targets.values()
+                ])
+                await loop.run_in_executor(
+                    None, self._store, dict(zip(targets, results)), True
+                )
+            except Exception:
+                logger.warn("liveness checks failed", exc_info=True)
+            await asyncio.sleep(
+                max(0, self._interval - (time.time() - started))
+            )
+
+    def _store(self, results, expire=False):
+        """
+        Keep ``{instance_id: result}``, an instance once live stays ready
+
+        :param expire: also forget instances no longer registered, the
+                       ones not running keep the result of their last check
+        """
+        conn = registry.conn
+        with conn:
+            previous = {
+                row[0]: json.loads(row[1]) for row in conn.execute(
+                    "SELECT instance_id, result FROM health"
+                )
+            }
+            for instance_id, result in results.items():
+                result.setdefault("ready", previous.get(
+                    instance_id, {}
+                ).get("ready", False) or result["live"])
+            if expire:
+                conn.execute(
+                    "DELETE FROM health WHERE instance_id NOT IN "
+                    "(SELECT instance_id FROM instances)"
+                )
+            conn.executemany(
+                "INSERT OR REPLACE INTO health VALUES (?, ?)", [
+                    (instance_id, json.dumps(result, sort_keys=True))
+                    for instance_id, result in results.items()
+                ]
+            )
+
+    def _targets(self):
+        """
+        Returns ``{instance_id: check url}`` of running http instances
+        """
+        from .docker_instance import DockerInstance, list_instance_ids
+
+        process_infos = get_runtime().all_process_info()
+        targets = {}
+        for instance_id in list_instance_ids():
+            info = process_infos.get(instance_id)
+            if info is None or info["statename"] != "RUNNING":
+                continue
+            try:
+                url = DockerInstance(instance_id).http_check_url
+            except errors.AgentError:
+                continue
+            if url:
+                targets[instance_id] = url
+        return targets
+
+
+health_checker = HealthChecker()
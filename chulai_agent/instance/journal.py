@@ -0,0 +1,51 @@
+"""
+Event Journal Storage
+
+the ``events`` table of the registry database and its writes, shared by
+the agent and the supervisor event listener, so it must import nothing
+but the standard library
+"""
+
+import json
+import sqlite3
+import time
+
+
+__all__ = ["SCHEMA", "connect", "append"]
+
+SCHEMA = """
+CREATE TABLE IF NOT EXISTS events (
+    seq INTEGER PRIMARY KEY AUTOINCREMENT,
+    time REAL NOT NULL,
+    instance_id TEXT NOT NULL,
+    event TEXT NOT NULL,
+    data TEXT NOT NULL
+);
+"""
+
+# trim the journal every that many events
+TRIM_EVERY = 100
+
+
+def connect(path):
+    conn = sqlite3.connect(path, timeout=30)
+    conn.execute("PRAGMA journal_mode=WAL")
+    conn.executescript(SCHEMA)
+    return conn
+
+
+def append(conn, instance_id, event, keep, **data):
+    """
+    Journal ``event`` of ``instance_id``, keeping the last ``keep`` ones
+
+    :returns: sequence id of the event
+    """
+    with conn:
+        seq = conn.execute(
+            "INSERT INTO events (time, instance_id, event, data) "
+            "VALUES (?, ?, ?, ?)",
+            (time.time(), instance_id, event, json.dumps(data))
+        ).lastrowid
+        if seq % TRIM_EVERY == 0:
+            conn.execute("DELETE FROM events WHERE seq <= ?", (seq - keep,))
+    return seq
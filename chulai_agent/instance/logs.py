@@ -0,0 +1,398 @@
+"""
+Log Reading
+
+tails and follows log files without reading them as a whole, memory use
+only depends on the number of lines asked for
+
+rotated logs are compacted into ``archive/<name>.<seq>.gz``: gzip members
+of whole lines, each about ``ARCHIVE_BLOCK_SIZE`` uncompressed bytes, and
+a sparse index of the timestamp and offset of every member, so a time
+range is read by seeking straight to its first member
+
+lines without a timestamp count as logged at the timestamp of the line
+before them, leading ones at the first timestamp of their file, or at its
+modification time if the file has none
+"""
+
+import bisect
+import gzip
+import json
+import os
+import re
+import time
+
+
+__all__ = ["tail", "follow", "read_range", "archives", "compress"]
+
+BLOCK_SIZE = 8192
+ARCHIVE_DIR = "archive"
+ARCHIVE_BLOCK_SIZE = 256 * 1024
+COMPRESS_LEVEL = 6
+ARCHIVE_PATTERN = re.compile(r"^(?P<name>.+)\.(?P<seq>\d+)\.(?P<ext>gz|log)$")
+# local ``2015-07-01 14:02:03`` or ``2015-07-01T14:02:03`` near the start
+# of a line, as written by rails, sidekiq and most loggers
+TS_PATTERN = re.compile(
+    rb"(\d{4})-(\d\d)-(\d\d)[T ](\d\d):(\d\d):(\d\d)"
+)
+TS_SEARCH_BYTES = 64
+# bytes a time search probe reads for a timestamped line
+PROBE_BYTES = 64 * 1024
+# untimestamped leading lines buffered while waiting for a timestamp
+MAX_PENDING_LINES = 10000
+
+
+def parse_ts(line):
+    """
+    Returns the unix time of the timestamp at the head of ``line``, None
+    if it has none
+    """
+    match = TS_PATTERN.search(line, 0, TS_SEARCH_BYTES)
+    if match is None:
+        return None
+    try:
+        return time.mktime(
+            tuple(int(part) for part in match.groups()) + (0, 0, -1)
+        )
+    except (OverflowError, ValueError):
+        return None
+
+
+def tail_file(path, lastn, block_size=BLOCK_SIZE):
+    """
+    Returns the last ``lastn`` lines of ``path``, read backwards block by
+    block from the end of the file
+    """
+    if lastn <= 0:
+        return []
+    with open(path, "rb") as log_f:
+        log_f.seek(0, os.SEEK_END)
+        pos = log_f.tell()
+        data = b""
+        # one more newline than asked, so the first line is complete
+        while pos > 0 and data.count(b"\n") <= lastn:
+            size = min(block_size, pos)
+            pos -= size
+            log_f.seek(pos)
+            data = log_f.read(size) + data
+    lines = data.splitlines(True)
+    if pos > 0:
+        lines = lines[1:]
+    return lines[-lastn:]
+
+
+def tail_archive(path, lastn):
+    """
+    Returns the last ``lastn`` lines of archive ``path``, decompressing
+    its members backwards from the end
+    """
+    if lastn <= 0:
+        return []
+    offsets = [block[1] for block in load_index(path)["blocks"]]
+    lines = []
+    with open(path, "rb") as archive_f:
+        archive_f.seek(0, os.SEEK_END)
+        end = archive_f.tell()
+        for offset in reversed(offsets):
+            if len(lines) >= lastn:
+                break
+            archive_f.seek(offset)
+            member = gzip.decompress(archive_f.read(end - offset))
+            lines = member.splitlines(True) + lines
+            end = offset
+    return lines[-lastn:]
+
+
+def tail(paths, lastn):
+    """
+    Returns the last ``lastn`` lines over rotated files
+
+    :param paths: log file, its backups and archives, newest first,
+                  missing files are skipped
+    """
+    lines = []
+    for path in paths:
+        if len(lines) >= lastn:
+            break
+        try:
+            if path.endswith(".gz"):
+                older = tail_archive(path, lastn - len(lines))
+            else:
+                older = tail_file(path, lastn - len(lines))
+        except FileNotFoundError:
+            continue
+        lines = older + lines
+    return lines
+
+
+def archives(path):
+    """
+    Returns archives of log file ``path``, oldest first, with rotated
+    files claimed for compaction but not compressed yet
+    """
+    archive_dir = os.path.join(os.path.dirname(path), ARCHIVE_DIR)
+    name = os.path.basename(path)
+    try:
+        entries = os.listdir(archive_dir)
+    except FileNotFoundError:
+        return []
+    found = {}
+    for entry in entries:
+        match = ARCHIVE_PATTERN.match(entry)
+        if match is None or match.group("name") != name:
+            continue
+        seq = int(match.group("seq"))
+        # a compressed archive replaces its claimed file
+        if match.group("ext") == "gz" or seq not in found:
+            found[seq] = os.path.join(archive_dir, entry)
+    return [found[seq] for seq in sorted(found)]
+
+
+def index_path(path):
+    return "{0}.idx".format(path)
+
+
+def load_index(path):
+    with open(index_path(path)) as index_f:
+        return json.load(index_f)
+
+
+def compress(src_path, dest_path, limit=None,
+             block_size=ARCHIVE_BLOCK_SIZE, truncate=False):
+    """
+    Compress ``src_path`` into archive ``dest_path`` with its index
+
+    the index is renamed into place first, so every visible archive has
+    one
+
+    :param limit: only compress that many bytes of ``src_path``
+    :param truncate: truncate ``src_path`` as soon as it is read to its
+                     end, for logs apps still append to
+    :returns: the index
+    """
+    fallback = os.stat(src_path).st_mtime
+    blocks = []
+    first_ts = last_ts = None
+    lines = size = 0
+    tmp_path = "{0}.tmp".format(dest_path)
+    with open(src_path, "rb") as src_f, open(tmp_path, "wb") as dest_f:
+        while limit is None or size < limit:
+            want = block_size if limit is None else min(
+                block_size, limit - size
+            )
+            block = src_f.read(want)
+            if not block:
+                if truncate:
+                    # only lines written since the last read are lost
+                    os.truncate(src_path, 0)
+                break
+            if not block.endswith(b"\n") and len(block) == want:
+                # members hold whole lines
+                block += src_f.readline()
+            block_lines = block.splitlines(True)
+            head_ts = parse_ts(block_lines[0])
+            blocks.append([
+                head_ts if head_ts is not None else last_ts,
+                dest_f.tell()
+            ])
+            for line in block_lines:
+                ts = parse_ts(line)
+                if ts is not None:
+                    first_ts = ts if first_ts is None else first_ts
+                    last_ts = ts
+            dest_f.write(gzip.compress(block, COMPRESS_LEVEL))
+            lines += len(block_lines)
+            size += len(block)
+
+    # leading lines without timestamps, see the module doc
+    first_ts = first_ts if first_ts is not None else fallback
+    last_ts = last_ts if last_ts is not None else fallback
+    for block in blocks:
+        if block[0] is None:
+            block[0] = first_ts
+    index = dict(
+        first_ts=first_ts,
+        last_ts=last_ts,
+        lines=lines,
+        size=size,
+        blocks=blocks
+    )
+    with open(index_path(tmp_path), "wt") as index_f:
+        json.dump(index, index_f)
+    os.rename(index_path(tmp_path), index_path(dest_path))
+    os.rename(tmp_path, dest_path)
+    return index
+
+
+def timed_lines(lines, current, fallback):
+    """
+    Yields ``(timestamp, line)`` of ``lines``
+
+    :param current: timestamp of the line before the first one, if known
+    :param fallback: timestamp if no line has one
+    """
+    pending = []
+    for line in lines:
+        ts = parse_ts(line)
+        if ts is not None:
+            current = ts
+        if current is None:
+            # leading lines wait for the first timestamp
+            pending.append(line)
+            if len(pending) < MAX_PENDING_LINES:
+                continue
+            current = fallback
+        for pending_line in pending:
+            yield current, pending_line
+        pending = []
+        yield current, line
+    for pending_line in pending:
+        yield fallback, pending_line
+
+
+def read_archive_range(path, start, end):
+    """
+    Yields lines of archive ``path`` logged from ``start`` to ``end``
+    """
+    index = load_index(path)
+    if index["last_ts"] < start or index["first_ts"] > end:
+        return
+    blocks = index["blocks"]
+    keys = [block[0] for block in blocks]
+    first = max(bisect.bisect_left(keys, start) - 1, 0)
+    with open(path, "rb") as archive_f:
+        archive_f.seek(blocks[first][1])
+        with gzip.GzipFile(fileobj=archive_f) as lines:
+            for ts, line in timed_lines(lines, keys[first], keys[first]):
+                if ts > end:
+                    return
+                if ts >= start:
+                    yield line
+
+
+def probe(log_f, pos):
+    """
+    Returns ``(offset, timestamp)`` of the first timestamped line after
+    ``pos``, ``(None, None)`` if there is none nearby
+    """
+    log_f.seek(pos)
+    if pos > 0:
+        # skip the line ``pos`` is in
+        log_f.readline()
+    scanned = 0
+    while scanned < PROBE_BYTES:
+        offset = log_f.tell()
+        line = log_f.readline()
+        if not line:
+            break
+        scanned += len(line)
+        ts = parse_ts(line)
+        if ts is not None:
+            return offset, ts
+    return None, None
+
+
+def seek_time(log_f, start, size):
+    """
+    Returns the offset of a line start before every line logged at or
+    after ``start``, found by bisecting ``log_f`` on timestamps
+    """
+    low, high = 0, size
+    while high - low > BLOCK_SIZE:
+        middle = (low + high) // 2
+        offset, ts = probe(log_f, middle)
+        if ts is None or ts >= start or offset >= high:
+            high = middle
+        else:
+            low = offset
+    return low
+
+
+def read_file_range(path, start, end):
+    """
+    Yields lines of plain log ``path`` logged from ``start`` to ``end``
+    """
+    with open(path, "rb") as log_f:
+        stat = os.fstat(log_f.fileno())
+        if stat.st_mtime < start:
+            # nothing written since ``start``
+            return
+        offset = seek_time(log_f, start, stat.st_size)
+        log_f.seek(offset)
+        for ts, line in timed_lines(log_f, None, stat.st_mtime):
+            if ts > end:
+                return
+            if ts >= start:
+                yield line
+
+
+def read_range(paths, start, end):
+    """
+    Yields lines logged from ``start`` to ``end``, oldest first
+
+    :param paths: log file, its backups and archives, newest first,
+                  missing files are skipped
+    """
+    for path in reversed(paths):
+        if path.endswith(".gz"):
+            lines = read_archive_range(path, start, end)
+        else:
+            lines = read_file_range(path, start, end)
+        try:
+            for line in lines:
+                yield line
+        except FileNotFoundError:
+            # compacted or removed meanwhile
+            continue
+
+
+def follow(path, timeout, poll_interval=0.5, block_size=BLOCK_SIZE):
+    """
+    Yields lines appended to ``path`` until ``timeout`` seconds passed,
+    reopens the file when it is rotated or truncated
+    """
+    deadline = time.time() + timeout
+    log_f = None
+    from_start = False
+    partial = b""
+    try:
+        while time.time() < deadline:
+            if log_f is None:
+                try:
+                    log_f = open(path, "rb")
+                except FileNotFoundError:
+                    time.sleep(poll_interval)
+                    continue
+                if not from_start:
+                    log_f.seek(0, os.SEEK_END)
+
+            chunk = log_f.read(block_size)
+            if chunk:
+                lines = (partial + chunk).splitlines(True)
+                partial = b""
+                if not lines[-1].endswith(b"\n"):
+                    partial = lines.pop()
+                    # never buffer more than a few blocks of one line
+                    if len(partial) > 8 * block_size:
+                        lines.append(partial)
+                        partial = b""
+                for line in lines:
+                    yield line
+                continue
+
+            try:
+                stat = os.stat(path)
+            except FileNotFoundError:
+                stat = None
+            current = os.fstat(log_f.fileno())
+            rotated = stat is None or stat.st_ino != current.st_ino
+            if rotated or stat.st_size < log_f.tell():
+                # the rest of the old file was already read, the new one
+                # is read from its beginning
+                log_f.close()
+                log_f = None
+                from_start = True
+                continue
+            time.sleep(poll_interval)
+    finally:
+        if log_f is not None:
+            log_f.close()
@@ -0,0 +1,172 @@
+"""
+Prometheus Exposition
+
+renders metrics of every instance and of the agent itself in prometheus
+text format, from the sampler's cache and the shared counters, without
+touching docker or any instance process
+"""
+
+import http.client
+import logging
+import re
+import sqlite3
+
+from .. import errors
+
+from .counters import counters, format_labels
+from .disk import DIRS, disk_usage
+from .registry import registry
+from .runtime import get_runtime
+from .sampler import metrics_sampler
+
+
+__all__ = ["CONTENT_TYPE", "render", "families"]
+logger = logging.getLogger(__name__)
+
+CONTENT_TYPE = "text/plain; version=0.0.4; charset=utf-8"
+
+MB = 1024 * 1024
+
+# (metric name, type, sample field, scale, help), fields the configured
+# stats backend does not sample are skipped
+INSTANCE_METRICS = (
+    ("chulai_instance_cpu_percent", "gauge", "cpu_percent", 1,
+     "CPU usage of the instance in percent of one core"),
+    ("chulai_instance_memory_percent", "gauge", "memroy_percent", 1,
+     "Memory usage of the instance in percent"),
+    ("chulai_instance_memory_bytes", "gauge", "memory_in_mb", MB,
+     "Memory charged to the instance cgroup"),
+    ("chulai_instance_rss_bytes", "gauge", "rss_in_mb", MB,
+     "Resident memory of the instance"),
+    ("chulai_instance_vms_bytes", "gauge", "vms_in_mb", MB,
+     "Virtual memory of the instance"),
+    ("chulai_instance_threads", "gauge", "threads", 1,
+     "Threads of the instance"),
+    ("chulai_instance_cpu_user_seconds_total", "counter", "user_time", 1,
+     "User CPU time of the instance"),
+    ("chulai_instance_cpu_system_seconds_total", "counter", "system_time", 1,
+     "System CPU time of the instance"),
+    ("chulai_instance_voluntary_context_switches_total", "counter",
+     "voluntary_switches", 1, "Voluntary context switches of the instance"),
+    ("chulai_instance_involuntary_context_switches_total", "counter",
+     "involuntary_switches", 1,
+     "Involuntary context switches of the instance"),
+    ("chulai_instance_io_read_bytes_total", "counter", "io_read_bytes", 1,
+     "Bytes read by the instance"),
+    ("chulai_instance_io_write_bytes_total", "counter", "io_write_bytes", 1,
+     "Bytes written by the instance"),
+)
+
+# (metric name, type, help) of the agent's own counters
+AGENT_METRICS = (
+    ("chulai_deploys_total", "counter", "Instances pulled up"),
+    ("chulai_teardowns_total", "counter", "Instances put down"),
+    ("chulai_failures_total", "counter", "Failed operations"),
+    ("chulai_pull_duration_seconds", "histogram", "Image pull durations"),
+)
+
+LE_PATTERN = re.compile(r'le="([^"]+)"')
+
+
+def header(name, type_, help_):
+    return "# HELP {0} {1}\n# TYPE {0} {2}\n".format(name, help_, type_)
+
+
+def line(name, labels, value):
+    if labels:
+        return "{0}{{{1}}} {2!r}\n".format(name, labels, float(value))
+    return "{0} {1!r}\n".format(name, float(value))
+
+
+def render():
+    """
+    Returns the whole exposition, raise ``AgentError`` 503 when a backend
+    fails, so a scrape never gets a truncated body
+    """
+    try:
+        return "".join(families())
+    except errors.AgentError as exc:
+        raise errors.AgentError(
+            "render metrics failed: {0}".format(exc.message), 503
+        )
+    except (OSError, http.client.HTTPException, sqlite3.Error) as exc:
+        raise errors.AgentError("render metrics failed: {0}".format(exc), 503)
+
+
+def families():
+    """
+    Yields the exposition, one metric family at a time
+    """
+    configs = dict(registry.query()[1])
+    process_infos = get_runtime().all_process_info()
+    samples = metrics_sampler.latest_all()
+
+    labels = {
+        instance_id: format_labels((
+            ("instance_id", instance_id),
+            ("app_id", config.get("app-id", "")),
+            ("commit", config.get("commit", "")),
+        ))
+        for instance_id, config in configs.items()
+    }
+
+    chunk = [header(
+        "chulai_instance_state", "gauge",
+        "Runtime state of the instance, 1 for the current state"
+    )]
+    for instance_id in sorted(labels):
+        info = process_infos.get(instance_id)
+        statename = info["statename"] if info is not None else "MISSING"
+        chunk.append(line(
+            "chulai_instance_state",
+            "{0},{1}".format(
+                labels[instance_id], format_labels((("state", statename),))
+            ),
+            1
+        ))
+    yield "".join(chunk)
+
+    for name, type_, field, scale, help_ in INSTANCE_METRICS:
+        chunk = []
+        for instance_id in sorted(samples):
+            value = samples[instance_id].get(field)
+            if value is None or instance_id not in labels:
+                continue
+            chunk.append(line(name, labels[instance_id], value * scale))
+        if chunk:
+            yield header(name, type_, help_) + "".join(chunk)
+
+    usages = disk_usage.usage_all()
+    chunk = [header(
+        "chulai_instance_disk_bytes", "gauge",
+        "Disk used by the instance's playground dirs, as of the last scan"
+    )]
+    for instance_id in sorted(usages):
+        if instance_id not in labels:
+            continue
+        for dir_name in DIRS:
+            chunk.append(line(
+                "chulai_instance_disk_bytes",
+                "{0},{1}".format(
+                    labels[instance_id], format_labels((("dir", dir_name),))
+                ),
+                usages[instance_id].get(dir_name, 0)
+            ))
+    yield "".join(chunk)
+
+    for name, type_, help_ in AGENT_METRICS:
+        chunk = [header(name, type_, help_)]
+        if type_ == "histogram":
+            buckets = counters.values("{0}_bucket".format(name))
+            buckets.sort(key=lambda row: float(
+                LE_PATTERN.search(row[0]).group(1)
+            ))
+            for labels_, value in buckets:
+                chunk.append(line("{0}_bucket".format(name), labels_, value))
+            for suffix in ("_sum", "_count"):
+                for labels_, value in counters.values(name + suffix):
+                    chunk.append(line(name + suffix, labels_, value))
+        else:
+            for labels_, value in counters.values(name):
+                chunk.append(line(name, labels_, value))
+        yield "".join(chunk)
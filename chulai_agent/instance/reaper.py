@@ -0,0 +1,170 @@
+"""
+Playground Reaper
+
+teardown only renames an instance's playground into a trash dir, the
+reaper archives trashed playgrounds and deletes them in background, at
+idle io priority
+
+every agent process runs a reaper from startup, only the one holding the
+``reaper`` host lock reaps, so trash left by a previous run is drained too
+
+an entry failing ``REAP_ATTEMPTS`` times in a row is moved aside into
+``.poisoned`` in the trash dir, for an operator to look at, so it does
+not hold up the entries after it
+"""
+
+import logging
+import os
+import shutil
+import tarfile
+import threading
+import time
+
+import psutil
+
+from .. import errors
+from ..agent import agent
+
+
+__all__ = ["reaper"]
+logger = logging.getLogger(__name__)
+
+REAP_ATTEMPTS = 3
+POISONED_DIR = ".poisoned"
+
+
+def lower_io_priority():
+    """let the calling thread only use disk bandwidth nobody else needs"""
+    try:
+        thread = psutil.Process(threading.get_native_id())
+        thread.ionice(psutil.IOPRIO_CLASS_IDLE)
+    except (AttributeError, psutil.Error):
+        logger.warn("can not lower io priority of reaper", exc_info=True)
+
+
+class PlaygroundReaper(object):
+    def __init__(self):
+        self._trash_dir = None
+        self._archive_dir = None
+        self._interval = 60
+        self._failures = {}
+        self._wakeup = threading.Event()
+        self._lock = threading.Lock()
+        self._pid = None
+
+    def init_app(self, app):
+        # trash must be on the playground's filesystem for atomic renames
+        self._trash_dir = app.config.get(
+            "TRASH_DIR", os.path.join(agent.playground, ".trash")
+        )
+        self._archive_dir = app.config.get("ARCHIVE_DIR")
+        self._interval = app.config.get("REAPER_INTERVAL", 60)
+        os.makedirs(self._trash_dir, exist_ok=True)
+        if self._archive_dir is not None:
+            os.makedirs(self._archive_dir, exist_ok=True)
+
+    def trash(self, path, name):
+        """
+        Atomically move ``path`` into the trash, it is reaped later
+
+        :param name: prefix of the trash entry and its archive
+        """
+        if not os.path.exists(path):
+            return
+        entry = "{0}-{1}".format(name, int(time.time() * 1000))
+        try:
+            os.rename(path, os.path.join(self._trash_dir, entry))
+        except OSError as exc:
+            raise errors.AgentError(
+                "move {0} to trash failed: {1}".format(path, exc)
+            )
+        logger.info("{0} trashed as {1}".format(path, entry))
+        self.ensure_started()
+        # only wakes the reaper if this worker leads, others reap within
+        # ``REAPER_INTERVAL``
+        self._wakeup.set()
+
+    def ensure_started(self):
+        # threads do not survive fork, every worker runs a reaper, only
+        # the one holding the host lock reaps
+        if self._pid == os.getpid():
+            return
+        with self._lock:
+            if self._pid == os.getpid():
+                return
+            self._pid = os.getpid()
+        runner = threading.Thread(target=self._run, name="playground-reaper")
+        runner.daemon = True
+        runner.start()
+
+    def _run(self):
+        lower_io_priority()
+        while True:
+            try:
+                with agent.host_lock("reaper"):
+                    self._reap_forever()
+            except BaseException:
+                logger.warn("reaping trash failed", exc_info=True)
+            time.sleep(self._interval)
+
+    def _reap_forever(self):
+        while True:
+            self._wakeup.clear()
+            self.reap_all()
+            self._wakeup.wait(self._interval)
+
+    def reap_all(self):
+        for entry in sorted(os.listdir(self._trash_dir)):
+            path = os.path.join(self._trash_dir, entry)
+            if entry.startswith(".") or not os.path.exists(path):
+                continue
+            try:
+                self.reap(entry, path)
+            except (OSError, tarfile.TarError):
+                logger.warn("reap {0} failed".format(entry), exc_info=True)
+                self._failures[entry] = self._failures.get(entry, 0) + 1
+                if self._failures[entry] >= REAP_ATTEMPTS:
+                    self.put_aside(entry, path)
+            else:
+                self._failures.pop(entry, None)
+
+    def put_aside(self, entry, path):
+        poisoned_dir = os.path.join(self._trash_dir, POISONED_DIR)
+        try:
+            os.makedirs(poisoned_dir, exist_ok=True)
+            os.rename(path, os.path.join(poisoned_dir, entry))
+        except OSError:
+            logger.error("put {0} aside failed".format(entry), exc_info=True)
+            return
+        self._failures.pop(entry, None)
+        logger.error("reaping {0} failed {1} times, moved to {2}".format(
+            entry, REAP_ATTEMPTS, poisoned_dir
+        ))
+
+    def reap(self, entry, path):
+        started = time.time()
+        if self._archive_dir is not None:
+            self.archive(entry, path)
+        shutil.rmtree(path)
+        logger.info("reaped {0} in {1:.2f}s".format(
+            entry, time.time() - started
+        ))
+
+    def archive(self, entry, path):
+        """stream ``path`` into ``<archive dir>/<entry>.tar.gz``"""
+        archive_path = os.path.join(
+            self._archive_dir, "{0}.tar.gz".format(entry)
+        )
+        tmp_path = "{0}.tmp".format(archive_path)
+        try:
+            with tarfile.open(tmp_path, "w:gz") as archive_f:
+                archive_f.add(path, arcname=entry)
+            os.rename(tmp_path, archive_path)
+        except BaseException:
+            # a half written archive only eats the space it failed on
+            if os.path.exists(tmp_path):
+                os.remove(tmp_path)
+            raise
+
+
+reaper = PlaygroundReaper()
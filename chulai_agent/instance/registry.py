@@ -0,0 +1,197 @@
+"""
+Instance Registry
+
+an on-disk sqlite index of every instance's spec, written at deploy,
+removed at teardown and rebuilt from the instance confs at startup,
+so listing and config lookups need no conf file parsing
+"""
+
+import configparser
+import json
+import logging
+import os
+import sqlite3
+import threading
+import time
+
+from .. import errors
+from ..agent import agent
+
+from .runtime import get_runtime
+
+
+__all__ = ["registry", "parse_conf"]
+logger = logging.getLogger(__name__)
+
+SCHEMA = """
+CREATE TABLE IF NOT EXISTS instances (
+    instance_id TEXT PRIMARY KEY,
+    app_id TEXT,
+    commit_id TEXT,
+    image_tag TEXT,
+    memory_limit INTEGER,
+    config TEXT NOT NULL,
+    updated_at REAL NOT NULL
+);
+CREATE INDEX IF NOT EXISTS instances_app_id ON instances (app_id);
+CREATE INDEX IF NOT EXISTS instances_commit_id ON instances (commit_id);
+CREATE INDEX IF NOT EXISTS instances_image_tag ON instances (image_tag);
+"""
+
+# query filter -> indexed column
+FILTERS = dict(
+    app_id="app_id",
+    commit="commit_id",
+    image_tag="image_tag",
+)
+
+
+def parse_conf(instance_id, supervisor_conf):
+    """
+    Returns the ``[chulai:<instance_id>]`` section of a supervisor conf
+    """
+    ini = configparser.ConfigParser(interpolation=None)
+    ini.read_string(supervisor_conf)
+    section_name = "chulai:{0}".format(instance_id)
+    if ini.has_section(section_name) is False:
+        raise errors.AgentError(
+            "config has no valid section:\n{0}\n".format(supervisor_conf)
+        )
+    return dict(ini.items(section_name))
+
+
+class InstanceRegistry(object):
+    def __init__(self):
+        self._path = None
+        self._local = threading.local()
+
+    def init_app(self, app):
+        self._path = app.config.get(
+            "REGISTRY_PATH", os.path.join(agent.playground, ".registry.db")
+        )
+        with agent.host_lock("registry"):
+            self.conn.executescript(SCHEMA)
+            self.rebuild()
+
+    @property
+    def conn(self):
+        # sqlite connections are neither thread nor fork safe
+        local = self._local
+        if getattr(local, "pid", None) != os.getpid():
+            local.conn = sqlite3.connect(self._path, timeout=30)
+            local.conn.execute("PRAGMA journal_mode=WAL")
+            local.pid = os.getpid()
+        return local.conn
+
+    def put(self, instance_id, config):
+        """
+        Register (or update) ``instance_id`` with its chulai ``config``
+        """
+        with self.conn:
+            self._insert(instance_id, config)
+
+    def _insert(self, instance_id, config):
+        self.conn.execute(
+            "INSERT OR REPLACE INTO instances VALUES (?, ?, ?, ?, ?, ?, ?)",
+            (
+                instance_id,
+                config.get("app-id"),
+                config.get("commit"),
+                config.get("image-tag"),
+                int(config.get("memory_limit") or 0),
+                json.dumps(config),
+                time.time()
+            )
+        )
+
+    def remove(self, instance_id):
+        with self.conn:
+            self.conn.execute(
+                "DELETE FROM instances WHERE instance_id = ?", (instance_id,)
+            )
+
+    def get(self, instance_id):
+        """
+        Returns chulai config of ``instance_id``, None if not registered
+        """
+        row = self.conn.execute(
+            "SELECT config FROM instances WHERE instance_id = ?",
+            (instance_id,)
+        ).fetchone()
+        return json.loads(row[0]) if row is not None else None
+
+    def ids(self):
+        return [
+            row[0] for row in self.conn.execute(
+                "SELECT instance_id FROM instances ORDER BY instance_id"
+            )
+        ]
+
+    def committed_memory(self):
+        """
+        Returns ``(sum of memory limits in MB, number of instances)``
+        """
+        committed, instances = self.conn.execute(
+            "SELECT COALESCE(SUM(memory_limit), 0), COUNT(*) FROM instances"
+        ).fetchone()
+        return committed, instances
+
+    def query(self, ids=None, offset=0, limit=None, **filters):
+        """
+        Returns ``(total, [(instance_id, config), ...])`` of the instances
+        matching every filter, ordered by instance id
+
+        :param ids: only consider these instance ids
+        :param filters: ``app_id``, ``commit`` or ``image_tag``
+        """
+        clauses, params = [], []
+        for name, value in filters.items():
+            if value is None:
+                continue
+            if name not in FILTERS:
+                raise errors.AgentError(
+                    "unknown filter {0}".format(name), 400
+                )
+            clauses.append("{0} = ?".format(FILTERS[name]))
+            params.append(value)
+        if ids is not None:
+            clauses.append("instance_id IN ({0})".format(
+                ", ".join("?" * len(ids))
+            ))
+            params.extend(ids)
+        where = "WHERE {0}".format(" AND ".join(clauses)) if clauses else ""
+
+        total = self.conn.execute(
+            "SELECT COUNT(*) FROM instances {0}".format(where), params
+        ).fetchone()[0]
+        sql = (
+            "SELECT instance_id, config FROM instances {0} "
+            "ORDER BY instance_id LIMIT ? OFFSET ?"
+        ).format(where)
+        limit = -1 if limit is None else limit
+        rows = self.conn.execute(sql, params + [limit, offset])
+        return total, [
+            (instance_id, json.loads(config)) for instance_id, config in rows
+        ]
+
+    def rebuild(self):
+        """
+        Replace the registry content with the specs of the runtime's confs
+        """
+        configs = {}
+        for instance_id, path in get_runtime().conf_paths().items():
+            try:
+                with open(path) as conf_f:
+                    supervisor_conf = conf_f.read()
+                configs[instance_id] = parse_conf(instance_id, supervisor_conf)
+            except (OSError, configparser.Error, errors.AgentError) as exc:
+                logger.warn("skip invalid conf {0}: {1}".format(path, exc))
+
+        with self.conn:
+            self.conn.execute("DELETE FROM instances")
+            for instance_id, config in configs.items():
+                self._insert(instance_id, config)
+        logger.info("registry rebuilt, {0} instances".format(len(configs)))
+
+
+registry = InstanceRegistry()
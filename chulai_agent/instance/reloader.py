@@ -0,0 +1,131 @@
+"""
+Reload Coalescer
+
+batches the supervisor group changes of concurrent deploys and teardowns
+so a whole batch is applied in one ``system.multicall``, with a single
+``reloadConfig``
+
+a change made while a batch is being applied goes in the next one; a lone
+change is applied right away, only changes coming within
+``SUPERVISOR_RELOAD_WINDOW`` of the last batch wait that long for others
+"""
+
+import logging
+import threading
+import time
+
+from .. import errors
+from ..agent import agent
+from ..clients import supervisor_client
+
+
+__all__ = ["reloader"]
+logger = logging.getLogger(__name__)
+
+ADD = "add"
+REMOVE = "remove"
+
+
+class GroupChange(object):
+    def __init__(self, action, group):
+        self.action = action
+        self.group = group
+        self.done = threading.Event()
+        self.error = None
+
+    def __repr__(self):
+        return "<GroupChange {0} {1}>".format(self.action, self.group)
+
+
+class ReloadCoalescer(object):
+    def __init__(self):
+        self._window = 0.2
+        self._lock = threading.Lock()
+        self._pending = []
+        self._flushing = False
+        self._applied_at = 0
+
+    def init_app(self, app):
+        self._window = app.config.get("SUPERVISOR_RELOAD_WINDOW", 0.2)
+
+    def add(self, group):
+        """
+        Load the newly written config of ``group`` and add it to supervisor
+        """
+        self._submit(GroupChange(ADD, group))
+
+    def remove(self, group):
+        """
+        Remove the stopped ``group`` from supervisor
+        """
+        self._submit(GroupChange(REMOVE, group))
+
+    def _submit(self, change):
+        with self._lock:
+            self._pending.append(change)
+            leader = not self._flushing
+            self._flushing = True
+
+        if leader:
+            self._flush()
+        change.done.wait()
+        if change.error is not None:
+            raise change.error
+
+    def _flush(self):
+        """apply pending changes in batches until none is left"""
+        if time.time() - self._applied_at < self._window:
+            # a burst of deploys, wait for changes of concurrent callers
+            time.sleep(self._window)
+        while True:
+            with self._lock:
+                batch, self._pending = self._pending, []
+                if not batch:
+                    self._flushing = False
+                    return
+            self._apply(batch)
+            self._applied_at = time.time()
+
+    def _apply(self, batch):
+        logger.info("applying {0} supervisor changes".format(len(batch)))
+        calls = [("reloadConfig", ())]
+        for change in batch:
+            if change.action == ADD:
+                calls.append(("addProcessGroup", (change.group,)))
+            else:
+                calls.append(("removeProcessGroup", (change.group,)))
+        try:
+            # other workers reload too, never let them interleave
+            with agent.host_lock("supervisor-reload"):
+                results = supervisor_client.multicall(calls)
+            if isinstance(results[0], errors.AgentError):
+                # the batch ran against the stale config
+                raise errors.AgentError(
+                    "reload config error: {0}".format(results[0].message),
+                    results[0].status_code
+                )
+            for change, result in zip(batch, results[1:]):
+                if isinstance(result, errors.AgentError):
+                    change.error = errors.AgentError(
+                        "{0} {1} error: {2}".format(
+                            change.action, change.group, result.message
+                        ),
+                        result.status_code
+                    )
+        except errors.AgentError as exc:
+            for change in batch:
+                change.error = errors.AgentError(
+                    "reload supervisor failed: {0}".format(exc.message),
+                    exc.status_code
+                )
+        except BaseException as exc:
+            for change in batch:
+                change.error = errors.AgentError(
+                    "reload supervisor failed: {0}".format(exc)
+                )
+        finally:
+            for change in batch:
+                change.done.set()
+
+
+reloader = ReloadCoalescer()
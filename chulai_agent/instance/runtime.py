@@ -0,0 +1,510 @@
+"""
+Instance Runtimes
+
+how instance containers are run on this host, picked by ``RUNTIME``:
+
+- ``supervisor``: supervisor runs a foreground ``docker run`` per instance
+- ``docker``: containers are created and started through the docker api,
+  their output is pumped into the instance's ``stdout-log.d`` by the
+  worker that started them, and by the one holding the ``log-pumps`` host
+  lock for containers restarted by docker or abandoned by a dead worker
+"""
+
+import calendar
+import logging
+import os
+import shlex
+import threading
+import time
+import xmlrpc.client
+
+import docker
+from supervisor.xmlrpc import Faults
+
+from .. import errors
+from ..agent import agent
+from ..clients import docker_client, supervisor_client
+
+from .reloader import reloader
+from .template_loader import render_template
+
+
+__all__ = ["get_runtime"]
+logger = logging.getLogger(__name__)
+
+# docker container status prefix -> supervisor state, so both runtimes
+# report states the same way
+DOCKER_STATES = (
+    ("Up", 20, "RUNNING"),
+    ("Restarting", 30, "BACKOFF"),
+    ("Exited", 100, "EXITED"),
+    ("Created", 0, "STOPPED"),
+    ("Dead", 200, "FATAL"),
+)
+UNKNOWN_STATE = (1000, "UNKNOWN")
+# seconds between two looks for running containers nobody pumps
+PUMP_INTERVAL = 5
+# seconds between two saves of where a pump is, a pump killed with its
+# worker repeats at most that much output
+MARK_INTERVAL = 1
+
+
+class SupervisorRuntime(object):
+    """instances are supervisor programs running ``docker run``"""
+
+    name = "supervisor"
+
+    def conf_path(self, instance_id):
+        return os.path.join(
+            supervisor_client.conf_dir, "{0}.ini".format(instance_id)
+        )
+
+    def conf_paths(self):
+        """
+        Returns ``{instance_id: conf path}`` of every conf on this host
+        """
+        conf_dir = supervisor_client.conf_dir
+        return {
+            name[:-len(".ini")]: os.path.join(conf_dir, name)
+            for name in os.listdir(conf_dir)
+            if name.endswith(".ini")
+        }
+
+    def all_process_info(self):
+        try:
+            return supervisor_client.all_process_info()
+        except xmlrpc.client.Fault as exc:
+            raise errors.AgentError(
+                "get process infos error: {0}".format(exc)
+            )
+
+    def process_info(self, instance):
+        try:
+            return supervisor_client.process_info(instance.instance_id)
+        except xmlrpc.client.Fault as exc:
+            raise errors.AgentError(
+                "get {0} info error: {1}".format(instance, exc)
+            )
+
+    def add(self, instance):
+        reloader.add(instance.instance_id)
+
+    def start(self, instance):
+        try:
+            supervisor_client.startProcess(instance.instance_id)
+        except xmlrpc.client.Fault as exc:
+            raise errors.AgentError(
+                "start instance {0} failed: {1}".format(instance, exc)
+            )
+
+    def stop(self, instance):
+        try:
+            supervisor_client.stopProcess(instance.instance_id)
+        except xmlrpc.client.Fault as exc:
+            raise errors.AgentError(
+                "stop {0} failed: {1}".format(instance, exc), 409,
+                payload=dict(instance=str(instance), operation="put down")
+            )
+
+    def remove(self, instance, stop=False):
+        """
+        Remove the group of ``instance``, stopping it first if ``stop``
+
+        removing needs no ``reloadConfig``, so both are a single multicall
+        """
+        name = instance.instance_id
+        calls = [("removeProcessGroup", (name,))]
+        if stop:
+            calls.insert(0, ("stopProcess", (name,)))
+        try:
+            results = supervisor_client.multicall(calls)
+        except xmlrpc.client.Fault as exc:
+            raise errors.AgentError(
+                "remove {0} failed: {1}".format(instance, exc)
+            )
+        for (method, _), result in zip(calls, results):
+            if not isinstance(result, errors.AgentError):
+                continue
+            if method == "stopProcess":
+                if result.fault_code == Faults.NOT_RUNNING:
+                    continue
+                raise errors.AgentError(
+                    "stop {0} failed: {1}".format(instance, result.message),
+                    409,
+                    payload=dict(instance=str(instance), operation="put down")
+                )
+            raise result
+
+    def ensure_started(self):
+        """supervisor writes the logs itself"""
+
+
+class RotatingWriter(object):
+    """
+    Appends to ``path``, rotating it the way supervisor does: ``path.1``
+    is the newest backup, at most ``backups`` are kept
+    """
+
+    def __init__(self, path, max_bytes, backups):
+        self._path = path
+        self._max_bytes = max_bytes
+        self._backups = backups
+        self._log_f = open(path, "ab")
+
+    def write(self, data):
+        self._log_f.write(data)
+        self._log_f.flush()
+        if self._max_bytes and self._log_f.tell() >= self._max_bytes:
+            self.rotate()
+
+    def rotate(self):
+        self._log_f.close()
+        for index in range(self._backups - 1, 0, -1):
+            older = "{0}.{1}".format(self._path, index)
+            if os.path.exists(older):
+                os.rename(older, "{0}.{1}".format(self._path, index + 1))
+        if self._backups > 0:
+            os.rename(self._path, "{0}.1".format(self._path))
+        else:
+            os.remove(self._path)
+        self._log_f = open(self._path, "ab")
+
+    def close(self):
+        self._log_f.close()
+
+
+class DockerRuntime(object):
+    """instances are containers managed straight through the docker api"""
+
+    name = "docker"
+
+    def __init__(self, state_ttl=1.0):
+        self._state_ttl = state_ttl
+        self._snapshot = None
+        self._snapshot_at = 0
+        self._generation = 0
+        self._lock = threading.Lock()
+        self._pumps = {}
+        self._pid = None
+
+    def conf_path(self, instance_id):
+        # never in supervisor's conf dir, supervisor must not load it
+        return os.path.join(agent.playground, instance_id, "chulai.ini")
+
+    def conf_paths(self):
+        paths = {}
+        for instance_id in os.listdir(agent.playground):
+            path = self.conf_path(instance_id)
+            if os.path.isfile(path):
+                paths[instance_id] = path
+        return paths
+
+    def all_process_info(self):
+        """
+        Returns supervisor-like process infos of every container, from a
+        listing taken at most ``state_ttl`` seconds ago
+        """
+        with self._lock:
+            expired = time.time() - self._snapshot_at > self._state_ttl
+            if self._snapshot is None or expired:
+                generation = self._generation
+                snapshot = {}
+                for container in docker_client.containers(all=True):
+                    info = self._info(container.get("Status") or "")
+                    for name in container.get("Names") or []:
+                        snapshot[name.lstrip("/")] = info
+                if generation != self._generation:
+                    # invalidated while listing, may predate the change
+                    return snapshot
+                self._snapshot = snapshot
+                self._snapshot_at = time.time()
+            return self._snapshot
+
+    def process_info(self, instance):
+        # the docker api accepts container names wherever it takes ids,
+        # so this runtime never waits for the container index
+        try:
+            state = docker_client.inspect_container(
+                instance.instance_id
+            )["State"]
+        except docker.errors.APIError as exc:
+            if exc.response.status_code != 404:
+                raise
+            return None
+        if state.get("Restarting"):
+            return self._info("Restarting")
+        if state.get("Running"):
+            return self._info("Up")
+        if state.get("FinishedAt", "").startswith("0001"):
+            return self._info("Created")
+        return self._info("Exited")
+
+    def _info(self, status):
+        for prefix, state, statename in DOCKER_STATES:
+            if status.startswith(prefix):
+                return dict(state=state, statename=statename)
+        state, statename = UNKNOWN_STATE
+        return dict(state=state, statename=statename)
+
+    def invalidate(self):
+        self._generation += 1
+        self._snapshot = None
+
+    def container_spec(self, instance):
+        """
+        Returns ``(create kwargs, start kwargs)`` of the instance's
+        container, the same settings ``templates/supervisor.conf`` passes
+        to ``docker run``
+        """
+        config = instance.config
+        app_id = config["app-id"]
+        port = int(config.get("port") or 0)
+        work_dir = os.path.join("/home", agent.paas_user, app_id)
+        # FIXME: remove hardcodeed assets_dir
+        assets_dir = os.path.join(
+            "/mnt/data/chulai/central-perk/app-assets", app_id
+        )
+        command = render_template(
+            "cmds/{0}".format(config["worker"]),
+            instance=dict(port=port)
+        )
+        binds = {
+            instance.logs_dir: dict(
+                bind=os.path.join(work_dir, "log"), ro=False
+            ),
+            assets_dir: dict(
+                bind=os.path.join(work_dir, "public/assets"), ro=True
+            ),
+            "/etc/localtime": dict(bind="/etc/localtime", ro=True),
+        }
+        create_kwargs = dict(
+            image=config["image-tag"],
+            command=shlex.split(command),
+            hostname="{0}.{1}".format(agent.host_name, agent.paas_domain),
+            name=instance.instance_id,
+            environment=instance.environments,
+            mem_limit="{0}m".format(config["memory_limit"]),
+            memswap_limit=-1,
+            volumes=[bind["bind"] for bind in binds.values()],
+            ports=[port] if port else None,
+            detach=True
+        )
+        start_kwargs = dict(
+            binds=binds,
+            port_bindings={port: (agent.host_ip, port)} if port else None,
+            # a count of 0 would restart forever
+            restart_policy=dict(
+                Name="on-failure", MaximumRetryCount=agent.start_retries
+            )
+        )
+        return create_kwargs, start_kwargs
+
+    def add(self, instance):
+        create_kwargs, _ = self.container_spec(instance)
+        try:
+            docker_client.create_container(**create_kwargs)
+        except docker.errors.APIError as exc:
+            raise errors.AgentError(
+                "create container of {0} failed: {1}".format(instance, exc)
+            )
+        finally:
+            self.invalidate()
+
+    def start(self, instance):
+        _, start_kwargs = self.container_spec(instance)
+        try:
+            docker_client.start(instance.instance_id, **start_kwargs)
+        except docker.errors.APIError as exc:
+            raise errors.AgentError(
+                "start instance {0} failed: {1}".format(instance, exc)
+            )
+        finally:
+            self.invalidate()
+        self._pump_logs(instance.instance_id)
+
+    def stop(self, instance):
+        stop_sec = int(instance.get_config("stop_sec", agent.stop_timeout))
+        try:
+            docker_client.stop(instance.instance_id, timeout=stop_sec)
+        except docker.errors.APIError as exc:
+            raise errors.AgentError(
+                "stop {0} failed: {1}".format(instance, exc), 409,
+                payload=dict(instance=str(instance), operation="put down")
+            )
+        finally:
+            self.invalidate()
+
+    def remove(self, instance, stop=False):
+        if stop:
+            self.stop(instance)
+        try:
+            docker_client.remove_container(instance.instance_id, force=True)
+        except docker.errors.APIError as exc:
+            if exc.response.status_code != 404:
+                raise errors.AgentError(
+                    "remove container of {0} failed: {1}".format(
+                        instance, exc
+                    )
+                )
+        finally:
+            self.invalidate()
+
+    def ensure_started(self):
+        """
+        Start looking for running containers whose output nobody pumps,
+        every worker competes for the ``log-pumps`` host lock to lead it
+        """
+        if self._pid == os.getpid():
+            return
+        with self._lock:
+            if self._pid == os.getpid():
+                return
+            self._pid = os.getpid()
+        leader = threading.Thread(target=self._lead, name="log-pumps")
+        leader.daemon = True
+        leader.start()
+
+    def _lead(self):
+        while True:
+            try:
+                with agent.host_lock("log-pumps"):
+                    self._pump_forever()
+            except BaseException:
+                logger.warn("pumping container logs failed", exc_info=True)
+            time.sleep(PUMP_INTERVAL)
+
+    def _pump_forever(self):
+        while True:
+            self.pump_all()
+            time.sleep(PUMP_INTERVAL)
+
+    def pump_all(self):
+        """
+        Pump the output of every running instance container, the ones
+        pumped by another worker already are left to it
+        """
+        for instance_id, info in self.all_process_info().items():
+            if info["statename"] != "RUNNING":
+                continue
+            # containers of other tools run on this host too
+            if os.path.isfile(self.conf_path(instance_id)):
+                self._pump_logs(instance_id)
+
+    def _pump_logs(self, instance_id):
+        with self._lock:
+            pump = self._pumps.get(instance_id)
+            if pump is not None and pump[0] == os.getpid() and \
+                    pump[1].is_alive():
+                return
+            runner = threading.Thread(
+                target=self._pump, args=(instance_id,),
+                name="log-pump-{0}".format(instance_id)
+            )
+            runner.daemon = True
+            self._pumps[instance_id] = (os.getpid(), runner)
+            runner.start()
+
+    def _pump(self, instance_id):
+        try:
+            # only one worker on the host pumps a container
+            with agent.host_lock("logs-{0}".format(instance_id), False):
+                streams = [
+                    threading.Thread(
+                        target=self._pump_stream,
+                        args=(instance_id, stream)
+                    )
+                    for stream in ("stdout", "stderr")
+                ]
+                for stream in streams:
+                    stream.start()
+                for stream in streams:
+                    stream.join()
+        except errors.AgentError:
+            pass
+
+    def _pump_stream(self, instance_id, stream):
+        """
+        Append the output of ``stream`` to its log, from where the last
+        pump of it stopped until the container stops
+        """
+        playground = os.path.join(agent.playground, instance_id)
+        path = os.path.join(
+            playground, "stdout-log.d", "{0}.log".format(stream)
+        )
+        # in the playground, the log dirs are truncated over quota
+        mark_path = os.path.join(playground, ".{0}.pumped".format(stream))
+        pumped = marked = read_mark(mark_path)
+        marked_at = time.time()
+        writer = RotatingWriter(
+            path, agent.log_max_mb * 1024 * 1024, agent.log_backups
+        )
+        try:
+            output = docker_client.follow_logs(
+                instance_id,
+                since=timestamp_seconds(pumped),
+                stdout=stream == "stdout",
+                stderr=stream == "stderr"
+            )
+            for frame in output:
+                at, _, data = frame.partition(b" ")
+                at = timestamp_key(at.decode("ascii", "replace"))
+                # ``since`` has a second granularity, or is not supported
+                if at <= pumped:
+                    continue
+                writer.write(data)
+                pumped = at
+                if time.time() - marked_at >= MARK_INTERVAL:
+                    write_mark(mark_path, pumped)
+                    marked, marked_at = pumped, time.time()
+        except BaseException:
+            logger.warn("pumping {0} {1} failed".format(
+                instance_id, stream
+            ), exc_info=True)
+        finally:
+            writer.close()
+            if pumped != marked:
+                write_mark(mark_path, pumped)
+
+
+def timestamp_key(timestamp):
+    """
+    Returns a docker RFC 3339 nano timestamp that sorts as a string,
+    docker trims the trailing zeros of its fraction
+    """
+    timestamp = timestamp.rstrip("Z")
+    seconds, _, fraction = timestamp.partition(".")
+    return "{0}.{1:0<9}".format(seconds, fraction)
+
+
+def timestamp_seconds(key):
+    """Returns the unix time of a ``timestamp_key``, 0 for an empty one"""
+    if not key:
+        return 0
+    return calendar.timegm(time.strptime(
+        key.partition(".")[0], "%Y-%m-%dT%H:%M:%S"
+    ))
+
+
+def read_mark(path):
+    """Returns the ``timestamp_key`` pumped last, empty if none"""
+    try:
+        with open(path) as mark_f:
+            return mark_f.read().strip()
+    except FileNotFoundError:
+        return ""
+
+
+def write_mark(path, key):
+    with open(path, "w") as mark_f:
+        mark_f.write(key)
+
+
+RUNTIMES = dict(
+    supervisor=SupervisorRuntime(),
+    docker=DockerRuntime(),
+)
+
+
+def get_runtime():
+    """Returns the runtime configured for this host"""
+    return RUNTIMES[agent.runtime]
@@ -0,0 +1,272 @@
+"""
+Metrics Sampler
+
+samples metrics of every running instance on a fixed interval and keeps
+a short history of them in sqlite next to the registry
+
+one worker per host samples, the one holding the ``metrics`` host lock,
+every worker reads the samples it published
+"""
+
+import json
+import logging
+import os
+import threading
+import time
+
+import psutil
+
+from .. import consts
+from .. import errors
+from .. import utils
+from ..agent import agent
+from ..timings import timings
+
+from .cgroup import cgroup_stats
+from .registry import registry
+from .runtime import get_runtime
+
+
+__all__ = ["metrics_sampler"]
+logger = logging.getLogger(__name__)
+
+SCHEMA = """
+CREATE TABLE IF NOT EXISTS metrics (
+    instance_id TEXT NOT NULL,
+    ts REAL NOT NULL,
+    sample TEXT NOT NULL
+);
+CREATE INDEX IF NOT EXISTS metrics_instance_ts ON metrics (instance_id, ts);
+CREATE INDEX IF NOT EXISTS metrics_ts ON metrics (ts);
+"""
+
+# seconds between priming new processes and their first sample
+PRIME_INTERVAL = 1.0
+
+# numeric fields kept in history, per stats backend
+FIELDS = dict(
+    psutil=(
+        "ts",
+        "cpu_percent",
+        "memroy_percent",
+        "voluntary_switches",
+        "involuntary_switches",
+        "threads",
+        "rss_in_mb",
+        "vms_in_mb",
+        "user_time",
+        "system_time",
+    ),
+    cgroup=(
+        "ts",
+        "cpu_percent",
+        "cpu_time",
+        "memory_in_mb",
+        "rss_in_mb",
+        "threads",
+        "user_time",
+        "system_time",
+        "io_read_bytes",
+        "io_write_bytes",
+    ),
+)
+
+
+class MetricsSampler(object):
+    def __init__(self):
+        self._interval = 5
+        self._capacity = 360
+        self._lock = threading.Lock()
+        self._published = set()
+        self._procs = {}
+        self._cpu_times = {}
+        self._pid = None
+
+    def init_app(self, app):
+        self._interval = app.config.get("METRICS_INTERVAL", 5)
+        self._capacity = app.config.get("METRICS_HISTORY", 360)
+        with registry.conn:
+            registry.conn.executescript(SCHEMA)
+
+    @property
+    def interval(self):
+        return self._interval
+
+    def latest(self, instance_id):
+        """
+        Returns the latest metrics of ``instance_id``, None if there is no
+        sample fresher than two intervals
+        """
+        self.ensure_started()
+        row = registry.conn.execute(
+            "SELECT sample FROM metrics WHERE instance_id = ? AND ts >= ? "
+            "ORDER BY ts DESC LIMIT 1",
+            (instance_id, time.time() - 2 * self._interval)
+        ).fetchone()
+        return json.loads(row[0]) if row is not None else None
+
+    def latest_all(self):
+        """
+        Returns ``{instance_id: latest metrics}`` of every instance with a
+        sample fresher than two intervals
+        """
+        self.ensure_started()
+        # oldest first, the latest sample of an instance wins
+        return {
+            instance_id: json.loads(sample)
+            for instance_id, sample in registry.conn.execute(
+                "SELECT instance_id, sample FROM metrics WHERE ts >= ? "
+                "ORDER BY ts", (time.time() - 2 * self._interval,)
+            )
+        }
+
+    def history(self, instance_id, since):
+        """
+        Returns samples of ``instance_id`` taken at or after ``since``
+        """
+        self.ensure_started()
+        fields = FIELDS[agent.stats_backend]
+        rows = []
+        for sample, in registry.conn.execute(
+            "SELECT sample FROM metrics WHERE instance_id = ? AND ts >= ? "
+            "ORDER BY ts", (instance_id, since)
+        ):
+            sample = json.loads(sample)
+            rows.append({field: sample.get(field) for field in fields})
+        return rows
+
+    def ensure_started(self):
+        # threads do not survive fork, every worker runs a sampler, only
+        # the one holding the host lock samples
+        if self._pid == os.getpid():
+            return
+        with self._lock:
+            if self._pid == os.getpid():
+                return
+            self._pid = os.getpid()
+            self._published = set()
+            self._procs = {}
+            self._cpu_times = {}
+        sampler = threading.Thread(target=self._run, name="metrics-sampler")
+        sampler.daemon = True
+        sampler.start()
+
+    def _run(self):
+        while True:
+            try:
+                with agent.host_lock("metrics"):
+                    self._sample_forever()
+            except BaseException:
+                logger.warn("sampling metrics failed", exc_info=True)
+            time.sleep(self._interval)
+
+    def _sample_forever(self):
+        while True:
+            started = time.time()
+            interval = self._interval
+            if self.sample_all():
+                # new processes get their first sample soon after startup
+                interval = min(interval, PRIME_INTERVAL)
+            time.sleep(max(0, interval - (time.time() - started)))
+
+    def sample_all(self):
+        """
+        Sample every running instance and publish the samples
+
+        :returns: whether some instance was only primed, not sampled
+        """
+        from .docker_instance import DockerInstance, list_instance_ids
+
+        process_infos = get_runtime().all_process_info()
+        running = set()
+        rows = []
+        primed = False
+        for instance_id in list_instance_ids():
+            info = process_infos.get(instance_id)
+            if info is None:
+                continue
+            if info["state"] not in consts.SUPERVISOR_RUNNING_STATES:
+                continue
+            running.add(instance_id)
+            try:
+                with timings.timed("sampler.sample"):
+                    metrics = self._sample(DockerInstance(instance_id))
+            except (errors.AgentError, psutil.Error) as exc:
+                logger.debug("sampling {0} failed: {1}".format(
+                    instance_id, exc
+                ))
+                continue
+            if metrics is None:
+                primed = True
+                continue
+            rows.append((
+                instance_id, metrics["ts"],
+                json.dumps(metrics, sort_keys=True)
+            ))
+
+        for instance_id in set(self._procs) - running:
+            del self._procs[instance_id]
+        for instance_id in set(self._cpu_times) - running:
+            del self._cpu_times[instance_id]
+        gone = self._published - running
+        self._published = running
+        # one transaction for the whole host
+        with registry.conn:
+            registry.conn.executemany(
+                "INSERT INTO metrics VALUES (?, ?, ?)", rows
+            )
+            registry.conn.executemany(
+                "DELETE FROM metrics WHERE instance_id = ?",
+                [(instance_id,) for instance_id in gone]
+            )
+            registry.conn.execute(
+                "DELETE FROM metrics WHERE ts < ?",
+                (time.time() - self._capacity * self._interval,)
+            )
+        return primed
+
+    def _sample(self, instance):
+        if agent.stats_backend == "cgroup":
+            return self._sample_cgroup(instance)
+        return self._sample_psutil(instance)
+
+    def _sample_psutil(self, instance):
+        from .docker_instance import collect_metrics
+
+        instance_id = instance.instance_id
+        cid = instance.cid
+        cached_cid, proc = self._procs.get(instance_id, (None, None))
+        primed = cached_cid == cid and proc is not None and proc.is_running()
+        if not primed:
+            # cpu_percent of a new process object is a meaningless 0.0,
+            # the first call only records the cpu times to diff against
+            with timings.timed("psutil.prime"):
+                proc = psutil.Process(instance.pid)
+                proc.cpu_percent()
+            self._procs[instance_id] = (cid, proc)
+            return None
+
+        metrics = collect_metrics(proc)
+        metrics["ts"] = time.time()
+        return metrics
+
+    def _sample_cgroup(self, instance):
+        instance_id = instance.instance_id
+        cid = instance.cid
+        with timings.timed("cgroup.stats"):
+            metrics = cgroup_stats.stats(cid)
+        metrics["ts"] = time.time()
+
+        now, cpu_time = metrics["ts"], metrics["cpu_time"]
+        last = self._cpu_times.get(instance_id)
+        self._cpu_times[instance_id] = (cid, now, cpu_time)
+        if last is None or last[0] != cid:
+            return None
+        _, last_ts, last_cpu_time = last
+        metrics["cpu_percent"] = utils.percentlize(
+            (cpu_time - last_cpu_time) / (now - last_ts)
+        )
+        return metrics
+
+
+metrics_sampler = MetricsSampler()
@@ -0,0 +1,62 @@
+from flask import Blueprint
+from flask import jsonify
+
+from .. import consts
+from .. import errors
+
+from .manager import job_manager
+
+
+job_api = Blueprint("job_api", __name__)
+
+
+@job_api.errorhandler(errors.AgentError)
+def agent_error(error):
+    res = jsonify(error.to_dict())
+    res.status_code = error.status_code
+    return res
+
+
+@job_api.route("/jobs/<job_id>")
+def show_job(job_id):
+    """show progress of a background job
+
+    :query job_id: job id returned by deploy or teardown
+
+    :statuscode 200: show job json
+    :statuscode 404: job not found or expired
+
+    :>json string status: ``success`` or ``error``
+    :>json dict job: state (``pending``, ``running``, ``success`` or
+                     ``error``), current phase, per-phase timings and
+                     the result or error of the job
+
+    **Example response**:
+
+    .. sourcecode:: http
+
+        {
+            "status": "success",
+            "job": {
+                "job_id": "5f0c5b0e3c8b4c1f9d2f8ce9a4a2c1e7",
+                "operation": "pull up",
+                "instance_id": "instance-0",
+                "state": "running",
+                "phase": "start",
+                "phases": [
+                    {"name": "pull image", "elapsed": 12.3},
+                    {"name": "prepare", "elapsed": 0.01},
+                    {"name": "add to supervisor", "elapsed": 0.2}
+                ],
+                "result": null,
+                "error": null,
+                "created_at": 1436000000.0,
+                "started_at": 1436000000.1,
+                "finished_at": null
+            }
+        }
+    """
+    job = job_manager.get(job_id)
+    if job is None:
+        raise errors.AgentError("job {0} not found".format(job_id), 404)
+    return jsonify(status=consts.SUCCESS, job=job)
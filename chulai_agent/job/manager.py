@@ -0,0 +1,233 @@
+"""
+Job Manager
+
+runs long operations (deploy, teardown) on a bounded thread pool, and
+keeps each job's progress in a json file so any worker can report it
+
+jobs of an instance are queued and run one at a time in submission order,
+jobs submitted by other workers wait for the instance lock
+"""
+
+import collections
+import concurrent.futures
+import contextlib
+import json
+import logging
+import os
+import re
+import threading
+import time
+import uuid
+
+from .. import errors
+from ..agent import agent
+from ..timings import timings
+
+
+__all__ = ["job_manager"]
+logger = logging.getLogger(__name__)
+
+JOB_ID_PATTERN = re.compile(r"^[0-9a-f]{32}$")
+
+PENDING = "pending"
+RUNNING = "running"
+SUCCESS = "success"
+ERROR = "error"
+
+
+class Job(object):
+    def __init__(self, job_id, operation, instance_id, jobs_dir):
+        self.job_id = job_id
+        self.operation = operation
+        self.instance_id = instance_id
+        self.state = PENDING
+        self.current_phase = None
+        self.phases = []
+        self.result = None
+        self.error = None
+        self.created_at = time.time()
+        self.started_at = None
+        self.finished_at = None
+        self._jobs_dir = jobs_dir
+
+    def __repr__(self):
+        return "<Job {0} {1} {2}>".format(
+            self.job_id, self.operation, self.instance_id
+        )
+
+    @property
+    def path(self):
+        return os.path.join(self._jobs_dir, "{0}.json".format(self.job_id))
+
+    @contextlib.contextmanager
+    def phase(self, name):
+        """record the timing of one phase of this job"""
+        self.current_phase = name
+        self.save()
+        started = time.time()
+        try:
+            with timings.timed("phase.{0}".format(name)):
+                yield
+        finally:
+            self.phases.append(dict(name=name, elapsed=time.time() - started))
+            self.current_phase = None
+            self.save()
+
+    def to_dict(self):
+        return dict(
+            job_id=self.job_id,
+            operation=self.operation,
+            instance_id=self.instance_id,
+            state=self.state,
+            phase=self.current_phase,
+            phases=self.phases,
+            result=self.result,
+            error=self.error,
+            created_at=self.created_at,
+            started_at=self.started_at,
+            finished_at=self.finished_at
+        )
+
+    def save(self):
+        # write then rename, readers never see a half written file
+        tmp_path = "{0}.{1}.tmp".format(self.path, os.getpid())
+        with open(tmp_path, "wt") as job_f:
+            json.dump(self.to_dict(), job_f)
+        os.rename(tmp_path, self.path)
+
+
+class JobManager(object):
+    def __init__(self):
+        self._jobs_dir = None
+        self._max_workers = 4
+        self._ttl = 3600
+        self._executor = None
+        # instance_id -> deque of jobs waiting behind the running one
+        self._chains = {}
+        self._chains_lock = threading.Lock()
+        self._pid = None
+
+    def init_app(self, app):
+        self._jobs_dir = app.config.get(
+            "JOBS_DIR", os.path.join(agent.playground, ".jobs")
+        )
+        self._max_workers = app.config.get("JOB_WORKERS", 4)
+        self._ttl = app.config.get("JOB_TTL", 3600)
+        os.makedirs(self._jobs_dir, exist_ok=True)
+
+    @property
+    def executor(self):
+        # pools do not survive fork, every worker has its own
+        if self._pid != os.getpid():
+            self._pid = os.getpid()
+            self._executor = concurrent.futures.ThreadPoolExecutor(
+                self._max_workers
+            )
+            self._chains = {}
+        return self._executor
+
+    def submit(self, operation, instance_id, func, *args, **kwargs):
+        """
+        Run ``func(*args, phase=job.phase, **kwargs)`` in background
+
+        jobs of an instance run one at a time, in submission order
+        :returns: the submitted ``Job``
+        """
+        self.purge()
+        executor = self.executor
+        job = Job(uuid.uuid4().hex, operation, instance_id, self._jobs_dir)
+        job.save()
+        with self._chains_lock:
+            chain = self._chains.get(instance_id)
+            if chain is None:
+                chain = self._chains[instance_id] = collections.deque()
+                executor.submit(self._run_chain, instance_id)
+            chain.append((job, func, args, kwargs))
+        logger.info("{0} submitted".format(job))
+        return job
+
+    def run(self, operation, instance_id, func, *args, **kwargs):
+        """
+        Run ``func(*args, phase=job.phase, **kwargs)`` as a job in the
+        calling thread, after the jobs running on the instance
+
+        :returns: the finished ``Job``
+        """
+        self.purge()
+        job = Job(uuid.uuid4().hex, operation, instance_id, self._jobs_dir)
+        job.save()
+        self._run(job, func, args, kwargs)
+        return job
+
+    def get(self, job_id):
+        """
+        Returns the dict of job ``job_id``, None if not exists
+        """
+        if JOB_ID_PATTERN.match(job_id) is None:
+            return None
+        path = os.path.join(self._jobs_dir, "{0}.json".format(job_id))
+        try:
+            with open(path) as job_f:
+                return json.load(job_f)
+        except FileNotFoundError:
+            return None
+
+    def purge(self):
+        """remove jobs finished more than ``JOB_TTL`` seconds ago"""
+        deadline = time.time() - self._ttl
+        for name in os.listdir(self._jobs_dir):
+            path = os.path.join(self._jobs_dir, name)
+            try:
+                if os.path.getmtime(path) >= deadline:
+                    continue
+                with open(path) as job_f:
+                    job = json.load(job_f)
+                # queued or running jobs may take longer than the ttl
+                if job.get("state") in (SUCCESS, ERROR):
+                    os.remove(path)
+            except FileNotFoundError:
+                pass
+            except ValueError:
+                # tmp file of a worker killed while saving
+                with contextlib.suppress(FileNotFoundError):
+                    os.remove(path)
+
+    def _run_chain(self, instance_id):
+        """run the jobs of ``instance_id`` until none is left"""
+        while True:
+            with self._chains_lock:
+                chain = self._chains[instance_id]
+                if not chain:
+                    del self._chains[instance_id]
+                    return
+                job, func, args, kwargs = chain.popleft()
+            self._run(job, func, args, kwargs)
+
+    def _run(self, job, func, args, kwargs):
+        try:
+            # wait for jobs of the instance run by other workers
+            lock_name = "instance-{0}".format(job.instance_id)
+            with agent.host_lock(lock_name):
+                job.state = RUNNING
+                job.started_at = time.time()
+                job.save()
+                job.result = func(*args, phase=job.phase, **kwargs)
+            job.state = SUCCESS
+        except errors.AgentError as exc:
+            logger.error("{0} failed: {1}".format(job, exc))
+            job.state = ERROR
+            job.error = dict(exc.to_dict(), status_code=exc.status_code)
+        except BaseException as exc:
+            logger.exception("{0} failed".format(job))
+            job.state = ERROR
+            job.error = dict(
+                status="error", message=str(exc), status_code=500
+            )
+        finally:
+            job.current_phase = None
+            job.finished_at = time.time()
+            job.save()
+            logger.info("{0} {1}".format(job, job.state))
+
+
+job_manager = JobManager()
@@ -1,19 +1,41 @@
 from flask import Blueprint
+from flask import Response
+from flask import current_app
 from flask import jsonify
+from flask import request
 
 from . import consts
+from .clients import docker_client, supervisor_client
+from .errors import AgentError
+from .instance import prometheus
+from .instance.capacity import capacity
+from .instance.disk import disk_usage
+from .instance.events import event_journal
+from .timings import timings
 
 
 misc_api = Blueprint('misc_api', __name__)
 
 
+@misc_api.errorhandler(AgentError)
+def agent_error(error):
+    current_app.logger.error(error)
+    res = jsonify(error.to_dict())
+    res.status_code = error.status_code
+    return res
+
+
 @misc_api.route('/status')
 def show_status():
     """
-    show server status
+    show server status, checking docker and supervisor are reachable
+
+    :statuscode 200: agent is ready
+    :statuscode 503: docker or supervisor not available
 
     :>json string status: ``success`` or ``failed``
     :>json string host: hostname of the server
+    :>json string message: if status is ``failed``, error reason goes here
 
     **Example Response:**
 
@@ -24,4 +46,176 @@ def show_status():
             "host": "host-name"
         }
     """
+    try:
+        docker_client.check()
+        supervisor_client.check()
+    except AgentError as exc:
+        res = jsonify(status='failed', host=consts.HOSTNAME,
+                      message=exc.message)
+        res.status_code = exc.status_code
+        return res
     return jsonify(status='success', host=consts.HOSTNAME)
+
+
+@misc_api.route('/host/capacity')
+def show_capacity():
+    """
+    memory committed to instances versus the memory deploys may commit
+
+    every instance commits its memory limit; the budget is the host's RAM
+    minus ``MEMORY_RESERVE_MB``, times ``MEMORY_OVERCOMMIT_RATIO``, and a
+    deploy needing more than ``free_mb`` is rejected with 507
+
+    **Example Response:**
+
+    .. sourcecode:: http
+
+        {
+            "status": "success",
+            "capacity": {
+                "total_mb": 16048,
+                "available_mb": 9210,
+                "reserve_mb": 1024,
+                "overcommit_ratio": 1.0,
+                "budget_mb": 15024,
+                "committed_mb": 12288,
+                "free_mb": 2736,
+                "instances": 24
+            }
+        }
+    """
+    return jsonify(status='success', capacity=capacity.summary())
+
+
+@misc_api.route('/host/disk')
+def show_disk():
+    """
+    disk usage of the playground filesystem and of the instances, as of
+    the last background scan, with the biggest instances and the ones over
+    ``DISK_QUOTA_MB``
+
+    **Example Response:**
+
+    .. sourcecode:: http
+
+        {
+            "status": "success",
+            "disk": {
+                "filesystem": {
+                    "total_mb": 102400,
+                    "used_mb": 61440,
+                    "free_mb": 40960,
+                    "percent": 60.0
+                },
+                "instances_mb": 52100,
+                "instances": 24,
+                "quota_mb": 4096,
+                "quota_action": "warn",
+                "top": [{"instance_id": "i-1", "mb": 5120}],
+                "over_quota": ["i-1"]
+            }
+        }
+    """
+    return jsonify(status='success', disk=disk_usage.summary())
+
+
+@misc_api.route('/metrics')
+def show_metrics():
+    """
+    metrics of every instance and of the agent, in prometheus text format
+
+    instance metrics come from the sampler's latest samples, labelled with
+    ``instance_id``, ``app_id`` and ``commit``; agent counters are shared
+    by all workers
+
+    :statuscode 503: docker, supervisor or the registry not available
+
+    **Example Response:**
+
+    .. sourcecode:: http
+
+        # HELP chulai_instance_cpu_percent CPU usage of the instance ...
+        # TYPE chulai_instance_cpu_percent gauge
+        chulai_instance_cpu_percent{instance_id="i-1",app_id="app",...} 1.5
+    """
+    return Response(prometheus.render(), mimetype=prometheus.CONTENT_TYPE)
+
+
+@misc_api.route('/events')
+def stream_events():
+    """
+    server-sent events of instance lifecycle transitions: ``deployed``,
+    ``updated``, ``starting``, ``running``, ``backoff``, ``stopping``,
+    ``stopped``, ``exited``, ``fatal``, ``oom-killed``, ``removed`` and
+    ``disk-quota-exceeded``
+
+    the stream ends after ``EVENTS_STREAM_TIMEOUT`` seconds, clients
+    reconnect with the ``Last-Event-ID`` header and get the events they
+    missed; a ``reset`` event tells them some were already dropped
+
+    :query instance_id: only events of this instance
+    :query since: last event id seen, if not sent as ``Last-Event-ID``,
+                  defaults to only new events
+    :query timeout: seconds to stream, capped by ``EVENTS_STREAM_TIMEOUT``
+
+    **Example Response:**
+
+    .. sourcecode:: http
+
+        id: 42
+        data: {"event": "backoff", "from_state": "STARTING",
+               "instance_id": "i-1", "seq": 42, "source": "supervisor",
+               "time": 1436757830.6}
+    """
+    last_id = request.headers.get("Last-Event-ID", request.args.get("since"))
+    try:
+        last_id = int(last_id) if last_id else None
+    except ValueError:
+        raise AgentError("invalid event id {0}".format(last_id), 400)
+    max_timeout = current_app.config.get("EVENTS_STREAM_TIMEOUT", 300)
+    timeout = min(
+        request.args.get("timeout", max_timeout, type=float), max_timeout
+    )
+    response = Response(
+        event_journal.stream(
+            last_id, timeout, request.args.get("instance_id")
+        ),
+        mimetype="text/event-stream"
+    )
+    response.headers["Cache-Control"] = "no-cache"
+    # keep proxies from buffering the stream
+    response.headers["X-Accel-Buffering"] = "no"
+    return response
+
+
+@misc_api.route('/debug/timings')
+def show_timings():
+    """
+    latency histograms and call counts of docker, supervisor and psutil
+    calls and of deploy phases, as seen by the worker serving the request
+
+    send any request with the ``X-Chulai-Debug: 1`` header to get the calls
+    it made in its ``X-Chulai-Timings`` response header
+
+    **Example Response:**
+
+    .. sourcecode:: http
+
+        {
+            "pid": 4242,
+            "since": 1436757830.6,
+            "operations": {
+                "supervisor.reloadConfig": {
+                    "count": 3,
+                    "sum": 0.42,
+                    "mean": 0.14,
+                    "max": 0.2,
+                    "p50": 0.1,
+                    "p90": 0.2,
+                    "p99": 0.2,
+                    "buckets": {"0.1": 1, "0.25": 2}
+                }
+            }
+        }
+    """
+    return jsonify(timings.snapshot())
@@ -0,0 +1,190 @@
+"""
+Timings
+
+latency histograms and call counts of every external call (docker,
+supervisor, psutil) and deploy phase, kept per worker process
+
+requests sent with the ``X-Chulai-Debug`` header also collect the calls
+they made, and get them back in the ``X-Chulai-Timings`` header
+"""
+
+import bisect
+import contextlib
+import json
+import os
+import threading
+import time
+
+from flask import request
+
+
+__all__ = ["timings", "DEBUG_HEADER", "TIMINGS_HEADER"]
+
+DEBUG_HEADER = "X-Chulai-Debug"
+TIMINGS_HEADER = "X-Chulai-Timings"
+
+# upper bounds of latency buckets, in seconds
+BUCKETS = (
+    0.001, 0.0025, 0.005, 0.01, 0.025, 0.05, 0.1, 0.25, 0.5,
+    1, 2.5, 5, 10, 30, 60, 120, 300, float("inf")
+)
+QUANTILES = (0.5, 0.9, 0.99)
+
+
+class Histogram(object):
+    def __init__(self):
+        self.count = 0
+        self.total = 0.0
+        self.max = 0.0
+        self.buckets = [0] * len(BUCKETS)
+
+    def observe(self, elapsed):
+        self.count += 1
+        self.total += elapsed
+        self.max = max(self.max, elapsed)
+        self.buckets[bisect.bisect_left(BUCKETS, elapsed)] += 1
+
+    def quantile(self, q):
+        """
+        Returns the upper bound of the bucket holding quantile ``q``,
+        capped by the slowest call seen
+        """
+        rank = q * self.count
+        seen = 0
+        for bound, hits in zip(BUCKETS, self.buckets):
+            seen += hits
+            if seen >= rank:
+                return min(bound, self.max)
+        return self.max
+
+    def to_dict(self):
+        result = dict(
+            count=self.count,
+            sum=self.total,
+            mean=self.total / self.count if self.count else 0.0,
+            max=self.max,
+            buckets={
+                str(bound): hits
+                for bound, hits in zip(BUCKETS, self.buckets) if hits
+            }
+        )
+        for q in QUANTILES:
+            result["p{0:g}".format(q * 100)] = self.quantile(q)
+        return result
+
+
+class Timings(object):
+    def __init__(self):
+        self._lock = threading.Lock()
+        self._histograms = {}
+        self._local = threading.local()
+        self._pid = os.getpid()
+        self._since = time.time()
+
+    @contextlib.contextmanager
+    def timed(self, operation):
+        """time the block as one call of ``operation``"""
+        started = time.time()
+        try:
+            yield
+        finally:
+            self.record(operation, time.time() - started)
+
+    def wrap(self, operation, func):
+        """Returns ``func`` timed as ``operation``"""
+        # no functools.wraps, xml-rpc method proxies fake every attribute
+        def wrapper(*args, **kwargs):
+            with self.timed(operation):
+                return func(*args, **kwargs)
+        return wrapper
+
+    def record(self, operation, elapsed):
+        with self._lock:
+            if self._pid != os.getpid():
+                # counts of the parent process are not ours
+                self._histograms = {}
+                self._pid = os.getpid()
+                self._since = time.time()
+            histogram = self._histograms.get(operation)
+            if histogram is None:
+                histogram = self._histograms[operation] = Histogram()
+            histogram.observe(elapsed)
+        calls = getattr(self._local, "calls", None)
+        if calls is not None:
+            calls.append((operation, elapsed))
+
+    def snapshot(self):
+        """Returns histograms of this worker, by operation"""
+        with self._lock:
+            if self._pid != os.getpid():
+                return dict(pid=os.getpid(), since=time.time(), operations={})
+            return dict(
+                pid=self._pid,
+                since=self._since,
+                operations={
+                    operation: histogram.to_dict()
+                    for operation, histogram in self._histograms.items()
+                }
+            )
+
+    def start_request(self):
+        """collect the calls this thread makes until ``finish_request``"""
+        self._local.calls = []
+        self._local.started = time.time()
+
+    def finish_request(self):
+        """
+        Returns the breakdown of the calls since ``start_request``, None
+        if the current request is not collecting
+        """
+        calls = getattr(self._local, "calls", None)
+        if calls is None:
+            return None
+        self._local.calls = None
+        breakdown = {}
+        for operation, elapsed in calls:
+            entry = breakdown.setdefault(operation, dict(calls=0, elapsed=0))
+            entry["calls"] += 1
+            entry["elapsed"] += elapsed
+        return dict(
+            elapsed=time.time() - self._local.started,
+            operations=breakdown
+        )
+
+    def current_calls(self):
+        """Returns the call list the current thread collects into"""
+        return getattr(self._local, "calls", None)
+
+    @contextlib.contextmanager
+    def collect_into(self, calls):
+        """
+        collect calls of this thread into ``calls``, a list returned by
+        ``current_calls`` in the thread serving the request
+        """
+        previous = getattr(self._local, "calls", None)
+        self._local.calls = calls
+        try:
+            yield
+        finally:
+            self._local.calls = previous
+
+    def init_app(self, app):
+        @app.before_request
+        def start_timing():
+            if request.headers.get(DEBUG_HEADER):
+                self.start_request()
+            else:
+                # a request that failed before after_request left its list
+                self._local.calls = None
+
+        @app.after_request
+        def attach_timings(response):
+            breakdown = self.finish_request()
+            if breakdown is not None:
+                response.headers[TIMINGS_HEADER] = json.dumps(
+                    breakdown, sort_keys=True
+                )
+            return response
+
+
+timings = Timings()
@@ -1,5 +1,8 @@
+import contextlib
 import logging
 
+from .timings import timings
+
 logger = logging.getLogger(__name__)
 
 
@@ -18,3 +21,15 @@ def percentlize(float_percent):
 
 def to_MB(bytes_):
     return bytes_ / 1024.0 / 1024
+
+
+@contextlib.contextmanager
+def null_phase(name):
+    """
+    Default phase recorder of long operations, only feeds the timings
+
+    long operations take a ``phase`` callable and run each step inside
+    ``with phase(step_name):`` so callers can track their progress
+    """
+    with timings.timed("phase.{0}".format(name)):
+        yield
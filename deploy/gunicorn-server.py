@@ -3,5 +3,19 @@ import os
 
 __curdir__ = os.path.dirname(os.path.realpath(__file__))
 
-workers = multiprocessing.cpu_count() * 2 + 1
+# requests mostly wait on docker, supervisor and instances, so every worker
+# serves them on a pool of threads: a slow or stuck daemon call, a log
+# follow or an event stream only holds a thread, not a whole process
+worker_class = "gthread"
+threads = 64
+workers = multiprocessing.cpu_count() + 1
+# load the app once in master, workers fork from it and connect to docker
+# and supervisor lazily, so restarts and recycles do not block on daemons
+preload_app = True
 logconfig = os.path.join(__curdir__, "gunicorn-log.conf")
+
+
+def post_worker_init(worker):
+    # threads do not survive fork, start background work in every worker
+    from chulai_agent import start_background
+    start_background()
@@ -8,6 +8,8 @@ import shcmd
 
 
 from chulai_agent import create_app
+from chulai_agent.clients import docker_client, supervisor_client
+from chulai_agent.errors import AgentError
 
 __curdir__ = os.path.realpath(os.path.dirname(__file__))
 
@@ -15,5 +17,17 @@ app = create_app(os.path.join(__curdir__, "config.cfg"))
 manager = flask.ext.script.Manager(app)
 
 
+@manager.command
+def check():
+    """check docker and supervisor are reachable"""
+    try:
+        docker_client.check()
+        supervisor_client.check()
+    except AgentError as exc:
+        print(exc.message)
+        raise SystemExit(1)
+    print("ok")
+
+
 if __name__ == "__main__":
     manager.run()
@@ -0,0 +1,70 @@
+import itertools
+import os
+import sys
+import time
+
+import pytest
+
+__curdir__ = os.path.dirname(os.path.realpath(__file__))
+sys.path.insert(0, os.path.join(os.path.dirname(__curdir__), "benchmarks"))
+
+import fakes  # noqa
+import run  # noqa
+
+from chulai_agent.job.manager import job_manager  # noqa
+
+JOB_TIMEOUT = 30
+
+# the agent's singletons are configured once per process, every test
+# shares one app and uses instance ids of its own
+_ids = itertools.count()
+
+
+class Agent(object):
+    def __init__(self, app, host, tmp_dir):
+        self.app = app
+        self.host = host
+        self.tmp_dir = tmp_dir
+        self.client = app.test_client()
+
+    def new_id(self):
+        return "test-{0:04d}".format(next(_ids))
+
+    def wait_job(self, response):
+        """Returns the finished job of a 202 ``response``"""
+        assert response.status_code == 202, response.data
+        return self.job(response.headers["Location"].rpartition("/")[2])
+
+    def job(self, job_id, state=None):
+        """
+        Returns job ``job_id`` once finished, fail after ``JOB_TIMEOUT``
+
+        :param state: expected state, ``success`` by default
+        """
+        deadline = time.time() + JOB_TIMEOUT
+        while True:
+            job = job_manager.get(job_id)
+            if job["state"] in ("success", "error"):
+                break
+            assert time.time() < deadline, "job {0} stuck".format(job)
+            time.sleep(run.POLL_INTERVAL)
+        assert job["state"] == (state or "success"), job
+        return job
+
+
+@pytest.fixture(scope="session")
+def agent(tmp_path_factory):
+    tmp_dir = str(tmp_path_factory.mktemp("agent"))
+    conf_dir = os.path.join(tmp_dir, "supervisor.d")
+    os.makedirs(conf_dir)
+    host = fakes.FakeHost(conf_dir)
+    docker_daemon = fakes.FakeDocker(host)
+    supervisor_daemon = fakes.FakeSupervisor(host)
+    docker_daemon.start()
+    supervisor_daemon.start()
+    app = run.make_app(
+        tmp_dir, host, docker_daemon.url, supervisor_daemon.url
+    )
+    yield Agent(app, host, tmp_dir)
+    docker_daemon.stop()
+    supervisor_daemon.stop()
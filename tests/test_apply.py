@@ -0,0 +1,84 @@
+import json
+import os
+
+from chulai_agent.instance.capacity import capacity
+from chulai_agent.instance.registry import registry
+from chulai_agent.instance.runtime import get_runtime
+
+import run
+
+
+def put(agent, instance_id, **changes):
+    spec = run.spec(instance_id)
+    spec.update(changes)
+    return agent.client.put(
+        "/instances/{0}".format(instance_id),
+        data=json.dumps(spec),
+        content_type="application/json"
+    )
+
+
+def test_put_deploys_a_new_instance(agent):
+    instance_id = agent.new_id()
+    response = put(agent, instance_id)
+    assert response.status_code == 202
+    job = agent.wait_job(response)
+    assert job["operation"] == "apply"
+    assert registry.get(instance_id) is not None
+
+
+def test_put_of_the_same_spec_is_a_no_op(agent):
+    instance_id = agent.new_id()
+    agent.wait_job(put(agent, instance_id))
+    agent.host.reset_calls()
+
+    response = put(agent, instance_id)
+    assert response.status_code == 200
+    assert json.loads(response.data.decode("utf-8"))["result"] == \
+        "<DockerInstance {0}> unchanged".format(instance_id)
+    calls = agent.host.reset_calls()
+    assert not any(
+        hits for name, hits in calls.items()
+        if name.endswith(("Process", "ProcessGroup", "reloadConfig"))
+    )
+
+
+def test_put_of_a_changed_spec_restarts_in_place(agent):
+    instance_id = agent.new_id()
+    agent.wait_job(put(agent, instance_id))
+    kept = os.path.join(
+        agent.tmp_dir, "playground", instance_id, "share.d", "kept"
+    )
+    os.makedirs(os.path.dirname(kept), exist_ok=True)
+    with open(kept, "wt") as kept_f:
+        kept_f.write("kept")
+
+    response = put(agent, instance_id, environments=dict(FEATURE="on"))
+    assert response.status_code == 202
+    job = agent.wait_job(response)
+    assert job["result"] == "updated <DockerInstance {0}>".format(
+        instance_id
+    )
+    assert os.path.exists(kept)
+    assert json.loads(registry.get(instance_id)["envs"])["FEATURE"] == "on"
+
+    response = put(agent, instance_id, environments=dict(FEATURE="on"))
+    assert response.status_code == 200
+
+
+def test_failed_deploy_releases_its_memory(agent, monkeypatch):
+    instance_id = agent.new_id()
+    committed = capacity.summary()["committed_mb"]
+
+    def add(instance):
+        raise RuntimeError("add failed")
+
+    monkeypatch.setattr(get_runtime(), "add", add)
+    response = put(agent, instance_id)
+    agent.job(response.headers["Location"].rpartition("/")[2], "error")
+    assert registry.get(instance_id) is None
+    assert capacity.summary()["committed_mb"] == committed
+
+    monkeypatch.undo()
+    agent.wait_job(put(agent, instance_id))
+    assert registry.get(instance_id) is not None
@@ -0,0 +1,132 @@
+import os
+
+import pytest
+
+from chulai_agent import errors
+from chulai_agent.instance.cgroup import USER_HZ, CgroupStats
+
+CID = "c0ffee"
+MB = 1024 * 1024
+
+
+def write(path, content):
+    os.makedirs(os.path.dirname(path), exist_ok=True)
+    with open(path, "wt") as cgroup_f:
+        cgroup_f.write(content)
+
+
+@pytest.fixture
+def v2(tmp_path):
+    root = str(tmp_path)
+    write(os.path.join(root, "cgroup.controllers"), "cpu io memory pids\n")
+    cgroup = os.path.join(
+        root, "system.slice", "docker-{0}.scope".format(CID)
+    )
+    write(os.path.join(cgroup, "cpu.stat"),
+          "usage_usec 3000000\nuser_usec 2000000\nsystem_usec 1000000\n")
+    write(os.path.join(cgroup, "memory.stat"),
+          "anon {0}\nfile 4096\n".format(64 * MB))
+    write(os.path.join(cgroup, "memory.current"), "{0}\n".format(128 * MB))
+    write(os.path.join(cgroup, "memory.max"), "{0}\n".format(512 * MB))
+    write(os.path.join(cgroup, "pids.current"), "7\n")
+    write(os.path.join(cgroup, "io.stat"),
+          "8:0 rbytes=100 wbytes=200 rios=1 wios=2\n"
+          "8:16 rbytes=10 wbytes=20 rios=1 wios=2\n")
+    return CgroupStats(root), cgroup
+
+
+@pytest.fixture
+def v1(tmp_path):
+    root = str(tmp_path)
+
+    def controller(name):
+        return os.path.join(root, name, "docker", CID)
+
+    write(os.path.join(controller("cpuacct"), "cpuacct.stat"),
+          "user {0}\nsystem {1}\n".format(2 * USER_HZ, USER_HZ))
+    write(os.path.join(controller("cpuacct"), "cpuacct.usage"),
+          "3000000000\n")
+    write(os.path.join(controller("memory"), "memory.stat"),
+          "cache 4096\nrss {0}\n".format(64 * MB))
+    write(os.path.join(controller("memory"), "memory.usage_in_bytes"),
+          "{0}\n".format(128 * MB))
+    write(os.path.join(controller("memory"), "memory.limit_in_bytes"),
+          "{0}\n".format(512 * MB))
+    write(os.path.join(controller("pids"), "pids.current"), "7\n")
+    write(os.path.join(controller("blkio"), "blkio.throttle.io_service_bytes"),
+          "8:0 Read 100\n8:0 Write 200\n8:0 Total 300\n"
+          "8:16 Read 10\n8:16 Write 20\nTotal 330\n")
+    return CgroupStats(root), controller
+
+
+def check_stats(stats):
+    assert stats["cpu_time"] == 3.0
+    assert stats["user_time"] == 2.0
+    assert stats["system_time"] == 1.0
+    assert stats["memory_in_mb"] == 128
+    assert stats["memory_limit_in_mb"] == 512
+    assert stats["memroy_percent"] == 25.0
+    assert stats["rss_in_mb"] == 64
+    assert stats["threads"] == 7
+    assert stats["io_read_bytes"] == 110
+    assert stats["io_write_bytes"] == 220
+
+
+def test_v2_stats(v2):
+    cgroup_stats, _ = v2
+    assert cgroup_stats.unified
+    check_stats(cgroup_stats.stats(CID))
+
+
+def test_v2_unlimited_memory(v2):
+    cgroup_stats, cgroup = v2
+    write(os.path.join(cgroup, "memory.max"), "max\n")
+    stats = cgroup_stats.stats(CID)
+    assert stats["memory_limit_in_mb"] is None
+    assert stats["memroy_percent"] is None
+
+
+def test_v2_missing_files(v2):
+    cgroup_stats, cgroup = v2
+    for name in ("io.stat", "pids.current"):
+        os.remove(os.path.join(cgroup, name))
+    stats = cgroup_stats.stats(CID)
+    assert stats["threads"] == 0
+    assert stats["io_read_bytes"] == stats["io_write_bytes"] == 0
+
+
+def test_v1_stats(v1):
+    cgroup_stats, _ = v1
+    assert not cgroup_stats.unified
+    check_stats(cgroup_stats.stats(CID))
+
+
+def test_v1_unlimited_memory(v1):
+    cgroup_stats, controller = v1
+    write(os.path.join(controller("memory"), "memory.limit_in_bytes"),
+          "9223372036854771712\n")
+    stats = cgroup_stats.stats(CID)
+    assert stats["memory_limit_in_mb"] is None
+    assert stats["memroy_percent"] is None
+
+
+def test_v1_without_pids_and_blkio(v1, tmp_path):
+    cgroup_stats, _ = v1
+    for name in ("pids", "blkio"):
+        os.rename(str(tmp_path / name), str(tmp_path / (name + ".off")))
+    stats = cgroup_stats.stats(CID)
+    assert stats["threads"] == 0
+    assert stats["io_read_bytes"] == stats["io_write_bytes"] == 0
+
+
+def test_locate_docker_dir(v2, tmp_path):
+    cgroup_stats, cgroup = v2
+    os.makedirs(str(tmp_path / "docker"))
+    os.rename(cgroup, str(tmp_path / "docker" / CID))
+    assert cgroup_stats.locate(CID) == str(tmp_path / "docker" / CID)
+
+
+def test_locate_unknown_container(v2):
+    cgroup_stats, _ = v2
+    with pytest.raises(errors.AgentError):
+        cgroup_stats.locate("unknown")
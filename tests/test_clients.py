@@ -0,0 +1,44 @@
+import pytest
+
+from chulai_agent import errors
+from chulai_agent.clients import supervisor_client
+
+
+class DroppedProxy(object):
+    """a kept alive connection supervisor closed in the meantime"""
+
+    def __getattr__(self, name):
+        return self
+
+    def __call__(self, *args):
+        raise ConnectionResetError("connection reset by peer")
+
+
+@pytest.fixture
+def dropped(agent):
+    # the next call takes the dropped connection from the pool
+    supervisor_client._acquire()
+    supervisor_client._release(DroppedProxy())
+    agent.host.reset_calls()
+    yield
+    supervisor_client._pool = []
+
+
+def test_reads_are_retried(agent, dropped):
+    results = supervisor_client.multicall([("getProcessInfo", ("nope",))])
+    assert isinstance(results[0], errors.AgentError)
+    assert agent.host.reset_calls()["supervisor"] == 1
+
+
+def test_mutating_batches_are_not_retried(agent, dropped):
+    with pytest.raises(ConnectionResetError):
+        supervisor_client.multicall([
+            ("getProcessInfo", ("nope",)), ("stopProcess", ("nope",))
+        ])
+    assert agent.host.reset_calls()["supervisor"] == 0
+
+
+def test_mutating_calls_are_not_retried(agent, dropped):
+    with pytest.raises(ConnectionResetError):
+        supervisor_client.call("supervisor.stopProcess", "nope")
+    assert agent.host.reset_calls()["supervisor"] == 0
@@ -0,0 +1,34 @@
+import os
+
+from chulai_agent.clients import docker_client
+from chulai_agent.instance.container_index import ContainerIndex
+
+
+def test_resync_does_not_undo_newer_events(agent, monkeypatch):
+    index = ContainerIndex()
+    # no watcher, events are applied by hand
+    index._pid = os.getpid()
+
+    def containers(all=False):
+        listing = [dict(Id="c1", Names=["/gone"])]
+        # destroyed after docker answered, before the listing is applied
+        index._apply(dict(status="destroy", id="c1", time=1))
+        return listing
+
+    index._ids, index._names = dict(gone="c1"), dict(c1="gone")
+    monkeypatch.setattr(docker_client, "containers", containers)
+    index.resync()
+    assert "gone" not in index._ids
+    assert index.name_of("c1") is None
+
+
+def test_resync(agent, monkeypatch):
+    index = ContainerIndex()
+    index._pid = os.getpid()
+    monkeypatch.setattr(
+        docker_client, "containers",
+        lambda all=False: [dict(Id="c2", Names=["/there"])]
+    )
+    index.resync()
+    assert index._ids == dict(there="c2")
+    assert index.name_of("c2") == "there"
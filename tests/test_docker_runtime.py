@@ -0,0 +1,150 @@
+import os
+import time
+
+import pytest
+
+from chulai_agent import errors
+from chulai_agent.agent import agent as chulai
+from chulai_agent.instance.runtime import DockerRuntime
+
+TIMEOUT = 30
+
+
+class Instance(object):
+    """the parts of ``DockerInstance`` the runtime reads"""
+
+    def __init__(self, instance_id, port=0):
+        self.instance_id = instance_id
+        self.config = {
+            "app-id": "test",
+            "worker": "rails",
+            "image-tag": "registry.test.local/test/app:c0ffee",
+            "memory_limit": 256,
+            "port": port,
+        }
+        self.environments = dict(RAILS_ENV="production")
+        self.logs_dir = os.path.join(
+            chulai.playground, instance_id, "chulai-log.d"
+        )
+        os.makedirs(os.path.join(chulai.playground, instance_id,
+                                 "stdout-log.d"))
+
+    def __str__(self):
+        return "<Instance {0}>".format(self.instance_id)
+
+    def get_config(self, key, default):
+        return self.config.get(key, default)
+
+
+@pytest.fixture
+def runtime(agent):
+    return DockerRuntime(state_ttl=60)
+
+
+def read_log(instance, stream):
+    path = os.path.join(
+        chulai.playground, instance.instance_id, "stdout-log.d",
+        "{0}.log".format(stream)
+    )
+    with open(path, "rb") as log_f:
+        return log_f.read()
+
+
+def statename(runtime, instance):
+    info = runtime.process_info(instance)
+    return info["statename"] if info is not None else None
+
+
+def test_lifecycle(agent, runtime):
+    instance = Instance(agent.new_id())
+    assert statename(runtime, instance) is None
+
+    runtime.add(instance)
+    assert statename(runtime, instance) == "STOPPED"
+    runtime.start(instance)
+    assert statename(runtime, instance) == "RUNNING"
+    assert runtime.all_process_info()[instance.instance_id] == dict(
+        state=20, statename="RUNNING"
+    )
+    runtime.stop(instance)
+    assert statename(runtime, instance) == "EXITED"
+    runtime.remove(instance)
+    assert statename(runtime, instance) is None
+    assert instance.instance_id not in runtime.all_process_info()
+    # already gone
+    runtime.remove(instance)
+
+
+def test_add_twice_fails(agent, runtime):
+    instance = Instance(agent.new_id())
+    runtime.add(instance)
+    with pytest.raises(errors.AgentError):
+        runtime.add(instance)
+    runtime.remove(instance)
+
+
+def test_listing_is_cached_until_invalidated(agent, runtime):
+    runtime.all_process_info()
+    agent.host.reset_calls()
+    runtime.all_process_info()
+    assert agent.host.reset_calls()["docker.containers"] == 0
+
+    instance = Instance(agent.new_id())
+    runtime.add(instance)
+    assert instance.instance_id in runtime.all_process_info()
+    assert agent.host.reset_calls()["docker.containers"] == 1
+    runtime.remove(instance)
+
+
+def test_container_spec(agent, runtime):
+    instance = Instance(agent.new_id(), port=8000)
+    create_kwargs, start_kwargs = runtime.container_spec(instance)
+    assert create_kwargs["name"] == instance.instance_id
+    assert create_kwargs["image"] == instance.config["image-tag"]
+    assert create_kwargs["mem_limit"] == "256m"
+    assert create_kwargs["environment"] == instance.environments
+    assert create_kwargs["ports"] == [8000]
+    assert start_kwargs["port_bindings"] == {
+        8000: (chulai.host_ip, 8000)
+    }
+    assert start_kwargs["binds"][instance.logs_dir]["ro"] is False
+    policy = start_kwargs["restart_policy"]
+    assert policy["MaximumRetryCount"] == chulai.start_retries > 0
+
+
+def test_output_is_pumped_once(agent, runtime):
+    instance = Instance(agent.new_id())
+    runtime.add(instance)
+    at = time.time()
+    agent.host.write_output(instance.instance_id, "stdout", b"booting\n", at)
+    agent.host.write_output(
+        instance.instance_id, "stderr", b"warning\n", at + 0.5
+    )
+    runtime.start(instance)
+    runtime._pumps[instance.instance_id][1].join(TIMEOUT)
+
+    agent.host.write_output(
+        instance.instance_id, "stdout", b"ready\n", at + 0.75
+    )
+    # the next pump replays from the second the last one stopped in
+    runtime._pump(instance.instance_id)
+    assert read_log(instance, "stdout") == b"booting\nready\n"
+    assert read_log(instance, "stderr") == b"warning\n"
+    runtime.remove(instance)
+
+
+def test_containers_nobody_pumps_are_pumped(agent, runtime):
+    instance = Instance(agent.new_id())
+    open(runtime.conf_path(instance.instance_id), "w").close()
+    runtime.add(instance)
+    agent.host.write_output(instance.instance_id, "stdout", b"restarted\n")
+    # started by docker's restart policy, not by the runtime
+    agent.host.find_container(instance.instance_id)["State"].update(
+        Running=True
+    )
+    runtime.invalidate()
+
+    runtime.pump_all()
+    runtime._pumps[instance.instance_id][1].join(TIMEOUT)
+    assert read_log(instance, "stdout") == b"restarted\n"
+    runtime.remove(instance)
@@ -0,0 +1,63 @@
+import io
+import sys
+import time
+
+from chulai_agent.clients import docker_client
+from chulai_agent.instance import eventlistener
+from chulai_agent.instance.events import event_journal
+
+import run
+
+
+class Disconnected(Exception):
+    pass
+
+
+def docker_event(instance_id, status, at):
+    return dict(
+        status=status,
+        id=instance_id,
+        time=at,
+        Type="container",
+        Action=status,
+        Actor=dict(ID=instance_id, Attributes=dict(name=instance_id))
+    )
+
+
+def test_follower_resumes_after_a_hand_over(agent, monkeypatch):
+    instance_id = agent.new_id()
+    run.seed(agent.host, [instance_id])
+    at = int(time.time())
+    history = [
+        docker_event(instance_id, "start", at),
+        docker_event(instance_id, "die", at + 1),
+    ]
+    connects = []
+
+    def events(since):
+        connects.append(since)
+        for event in history:
+            if event["time"] >= since:
+                yield event
+        raise Disconnected()
+
+    monkeypatch.setattr(docker_client, "events", events)
+    last_seq = event_journal.last_seq()
+    for _ in range(2):
+        # a leader drops, the next one takes over
+        try:
+            event_journal._follow_docker()
+        except Disconnected:
+            pass
+
+    assert connects[1] == at + 1
+    journaled = [
+        row[3] for row in event_journal.since(last_seq, instance_id)
+    ]
+    assert journaled == ["running", "exited"]
+
+
+def test_listener_stops_on_eof(tmp_path, monkeypatch):
+    monkeypatch.setattr(sys, "stdin", io.StringIO(""))
+    monkeypatch.setattr(sys, "stdout", io.StringIO())
+    assert eventlistener.main([str(tmp_path / "registry.db")]) == 0
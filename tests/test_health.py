@@ -0,0 +1,71 @@
+import threading
+from http.server import BaseHTTPRequestHandler, HTTPServer
+
+import pytest
+
+from chulai_agent import errors
+from chulai_agent.instance.health import health_checker
+
+import run
+
+
+class Handler(BaseHTTPRequestHandler):
+    def do_GET(self):
+        self.send_response(204)
+        self.end_headers()
+
+    def log_message(self, *args):
+        pass
+
+
+@pytest.fixture
+def url():
+    server = HTTPServer(("127.0.0.1", 0), Handler)
+    runner = threading.Thread(target=server.serve_forever)
+    runner.daemon = True
+    runner.start()
+    yield "http://127.0.0.1:{0}/check".format(server.server_address[1])
+    server.shutdown()
+    server.server_close()
+
+
+def test_ready_result_is_shared(agent, url):
+    instance_id = agent.new_id()
+    health_checker.wait_ready(instance_id, url, 5)
+
+    results = []
+    reader = threading.Thread(
+        target=lambda: results.append(health_checker.result(instance_id))
+    )
+    reader.start()
+    reader.join()
+    assert results[0]["ready"] and results[0]["live"]
+    assert results[0]["status_code"] == 204
+
+
+def test_ready_stays_after_a_failed_probe(agent, url):
+    instance_id = agent.new_id()
+    health_checker.wait_ready(instance_id, url, 5)
+    health_checker._store({instance_id: dict(url=url, live=False)})
+    result = health_checker.result(instance_id)
+    assert result["ready"] and not result["live"]
+
+
+def test_not_ready_in_time(agent):
+    instance_id = agent.new_id()
+    with pytest.raises(errors.AgentError):
+        health_checker.wait_ready(instance_id, "http://127.0.0.1:1/", 0.2)
+    result = health_checker.result(instance_id)
+    assert not result["ready"] and not result["live"]
+
+
+def test_liveness_round_keeps_starting_instances(agent, url):
+    starting, gone = agent.new_id(), agent.new_id()
+    run.seed(agent.host, [starting])
+    for instance_id in (starting, gone):
+        health_checker.wait_ready(instance_id, url, 5)
+
+    # a liveness round of running instances, neither is one yet
+    health_checker._store({}, expire=True)
+    assert health_checker.result(starting)["ready"]
+    assert health_checker.result(gone) is None
@@ -0,0 +1,25 @@
+import json
+
+from chulai_agent.clients import supervisor_client
+
+import run
+
+
+def test_unknown_ids_are_reported(agent):
+    instance_id = agent.new_id()
+    missing = agent.new_id()
+    run.seed(agent.host, [instance_id])
+    supervisor_client.invalidate()
+
+    response = agent.client.get(
+        "/instances?stats=0&ids={0},{1}".format(instance_id, missing)
+    )
+    assert response.status_code == 200
+    body = json.loads(response.data.decode())
+    assert body["total"] == 1
+    entries = {
+        entry["instance_id"]: entry for entry in body["instances"]
+    }
+    assert entries[instance_id]["state"] == "RUNNING"
+    assert entries[missing]["error"] == "not found"
+    assert entries[missing]["state"] is None
@@ -0,0 +1,117 @@
+import concurrent.futures
+import json
+import threading
+import time
+
+from chulai_agent.instance.docker_instance import run_many
+from chulai_agent.instance.registry import registry
+from chulai_agent.job.manager import job_manager
+
+import run
+
+TIMEOUT = 30
+
+
+def post(agent, instance_id):
+    return agent.client.post(
+        "/instances/{0}".format(instance_id),
+        data=json.dumps(run.spec(instance_id)),
+        content_type="application/json"
+    )
+
+
+def test_delete_right_after_post_waits_for_the_deploy(agent):
+    instance_id = agent.new_id()
+    deploy = post(agent, instance_id)
+    teardown = agent.client.delete("/instances/{0}".format(instance_id))
+    assert deploy.status_code == teardown.status_code == 202
+
+    deployed = agent.wait_job(deploy)
+    removed = agent.wait_job(teardown)
+    assert deployed["finished_at"] <= removed["started_at"]
+    assert registry.get(instance_id) is None
+
+
+def test_second_post_fails_as_a_conflict(agent):
+    instance_id = agent.new_id()
+    first = post(agent, instance_id)
+    second = post(agent, instance_id)
+    assert first.status_code == second.status_code == 202
+
+    agent.wait_job(first)
+    job = agent.job(
+        second.headers["Location"].rpartition("/")[2], state="error"
+    )
+    assert job["error"]["status_code"] == 409
+
+
+def test_jobs_of_an_instance_run_in_order(agent):
+    instance_id = agent.new_id()
+    order = []
+
+    def record(index, phase):
+        order.append(index)
+
+    jobs = [
+        job_manager.submit("record", instance_id, record, index)
+        for index in range(10)
+    ]
+    for job in jobs:
+        agent.job(job.job_id)
+    assert order == list(range(10))
+
+
+def test_purge_keeps_unfinished_jobs(agent, monkeypatch):
+    started, release = threading.Event(), threading.Event()
+
+    def block(phase):
+        started.set()
+        release.wait(TIMEOUT)
+
+    instance_id = agent.new_id()
+    running = job_manager.submit("block", instance_id, block)
+    queued = job_manager.submit("block", instance_id, block)
+    done = job_manager.submit("record", agent.new_id(), lambda phase: None)
+    agent.job(done.job_id)
+    assert started.wait(TIMEOUT)
+
+    # every job file is older than the ttl
+    monkeypatch.setattr(job_manager, "_ttl", -1)
+    job_manager.purge()
+    assert job_manager.get(done.job_id) is None
+    assert job_manager.get(running.job_id)["state"] == "running"
+    assert job_manager.get(queued.job_id)["state"] == "pending"
+    release.set()
+    agent.job(queued.job_id)
+
+
+def test_batch_waits_for_running_jobs(agent):
+    started, release = threading.Event(), threading.Event()
+    order = []
+
+    def block(phase):
+        started.set()
+        release.wait(TIMEOUT)
+        order.append("single")
+
+    def record(phase):
+        order.append("batch")
+        return "recorded"
+
+    instance_id = agent.new_id()
+    single = job_manager.submit("block", instance_id, block)
+    assert started.wait(TIMEOUT)
+    batch = concurrent.futures.ThreadPoolExecutor(1).submit(
+        run_many, "record", [(instance_id, record, (), {})], 1
+    )
+    time.sleep(0.1)
+    assert not batch.done()
+    release.set()
+
+    result, = batch.result(TIMEOUT)
+    assert order == ["single", "batch"]
+    assert result["status"] == "success" and result["message"] == "recorded"
+    agent.job(single.job_id)
+    response = agent.client.get("/jobs/{0}".format(result["job_id"]))
+    job = json.loads(response.data.decode("utf-8"))["job"]
+    assert job["state"] == "success" and job["operation"] == "record"
@@ -0,0 +1,94 @@
+import gzip
+import os
+import time
+
+from chulai_agent.instance import logs
+from chulai_agent.instance.compactor import log_compactor
+
+import run
+
+START = time.mktime((2015, 7, 1, 10, 0, 0, 0, 0, -1))
+
+
+def log_line(index, text="line"):
+    stamp = time.strftime(
+        "%Y-%m-%d %H:%M:%S", time.localtime(START + index)
+    )
+    return "{0} {1} {2} {3}\n".format(stamp, text, index, "x" * 64)
+
+
+def seed_app_log(agent, lines):
+    instance_id = agent.new_id()
+    run.seed(agent.host, [instance_id])
+    path = os.path.join(
+        agent.tmp_dir, "playground", instance_id, "chulai-log.d",
+        "production.log"
+    )
+    with open(path, "wt") as log_f:
+        log_f.writelines(log_line(index) for index in range(lines))
+    return instance_id, path
+
+
+def get_lines(agent, instance_id, **query):
+    query = "&".join(
+        "{0}={1}".format(key, value) for key, value in query.items()
+    )
+    response = agent.client.get(
+        "/instances/{0}/logs?stream=app&{1}".format(instance_id, query)
+    )
+    assert response.status_code == 200
+    return response.data.decode("utf-8").splitlines(True)
+
+
+def test_compress_and_read_back(tmp_path):
+    src = str(tmp_path / "app.log")
+    with open(src, "wt") as log_f:
+        log_f.writelines(log_line(index) for index in range(1000))
+    dest = str(tmp_path / "app.log.1.gz")
+    index = logs.compress(src, dest, block_size=4096)
+    assert index["lines"] == 1000
+    assert len(index["blocks"]) > 1
+    assert index["first_ts"] == START and index["last_ts"] == START + 999
+
+    assert logs.tail([dest], 2) == [
+        log_line(998).encode(), log_line(999).encode()
+    ]
+    lines = list(logs.read_range([dest], START + 500, START + 502))
+    assert lines == [log_line(index).encode() for index in (500, 501, 502)]
+
+
+def test_truncate_keeps_lines_written_while_compressing(agent, monkeypatch):
+    # over the 1MB LOG_MAX_MB of the test config
+    instance_id, path = seed_app_log(agent, 16000)
+    compress = gzip.compress
+    late = log_line(20000, "late")
+
+    def compress_while_logging(data, *args):
+        with open(path, "at") as log_f:
+            log_f.write(late)
+        monkeypatch.setattr(gzip, "compress", compress)
+        return compress(data, *args)
+
+    monkeypatch.setattr(gzip, "compress", compress_while_logging)
+    log_compactor.compact(instance_id)
+
+    assert os.path.getsize(path) == 0
+    assert len(logs.archives(path)) == 1
+    assert get_lines(agent, instance_id, lastn=2) == [
+        log_line(15999), late
+    ]
+
+
+def test_range_over_archives_and_live_log(agent):
+    instance_id, path = seed_app_log(agent, 16000)
+    log_compactor.compact(instance_id)
+    with open(path, "at") as log_f:
+        log_f.writelines(log_line(index) for index in range(16000, 16010))
+
+    lines = get_lines(
+        agent, instance_id, **{"from": START + 15998, "to": START + 16001}
+    )
+    assert lines == [log_line(index) for index in range(15998, 16002)]
+    assert get_lines(agent, instance_id, lastn=12) == [
+        log_line(index) for index in range(15998, 16010)
+    ]
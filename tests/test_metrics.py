@@ -0,0 +1,28 @@
+from chulai_agent.instance import prometheus
+
+
+class BrokenRuntime(object):
+    def all_process_info(self):
+        raise ConnectionRefusedError("supervisor is down")
+
+
+def test_metrics(agent):
+    response = agent.client.get("/metrics")
+    assert response.status_code == 200
+    body = response.data.decode("utf-8")
+    assert "# TYPE chulai_instance_state gauge" in body
+    assert "# TYPE chulai_pull_duration_seconds histogram" in body
+
+
+def test_backend_failure_is_503(agent, monkeypatch):
+    monkeypatch.setattr(prometheus, "get_runtime", BrokenRuntime)
+    response = agent.client.get("/metrics")
+    assert response.status_code == 503
+    assert b"supervisor is down" in response.data
+    assert b"# TYPE" not in response.data
+
+
+def test_invalid_event_id(agent):
+    response = agent.client.get("/events?since=nope")
+    assert response.status_code == 400
+    assert b"invalid event id" in response.data
@@ -0,0 +1,44 @@
+import os
+import tarfile
+
+from chulai_agent.instance.reaper import (
+    POISONED_DIR, REAP_ATTEMPTS, PlaygroundReaper
+)
+
+
+def make_entry(trash_dir, entry):
+    os.makedirs(os.path.join(trash_dir, entry, "share.d"))
+    with open(os.path.join(trash_dir, entry, "share.d", "data"), "wt") as f:
+        f.write(entry)
+
+
+def test_failing_entry_does_not_block_the_others(tmp_path, monkeypatch):
+    reaper = PlaygroundReaper()
+    reaper._trash_dir = str(tmp_path / "trash")
+    reaper._archive_dir = str(tmp_path / "archive")
+    os.makedirs(reaper._archive_dir)
+    for entry in ("a-1", "b-2"):
+        make_entry(reaper._trash_dir, entry)
+
+    add = tarfile.TarFile.add
+
+    def add_or_fail(archive_f, name, arcname=None, *args, **kwargs):
+        if arcname == "a-1":
+            raise OSError(28, "No space left on device")
+        return add(archive_f, name, arcname, *args, **kwargs)
+
+    monkeypatch.setattr(tarfile.TarFile, "add", add_or_fail)
+    reaper.reap_all()
+    assert os.listdir(reaper._trash_dir) == ["a-1"]
+    # no half written archive is left behind
+    assert os.listdir(reaper._archive_dir) == ["b-2.tar.gz"]
+
+    for _ in range(REAP_ATTEMPTS - 1):
+        reaper.reap_all()
+    assert os.listdir(reaper._trash_dir) == [POISONED_DIR]
+    assert os.listdir(os.path.join(reaper._trash_dir, POISONED_DIR)) == [
+        "a-1"
+    ]
+    # entries put aside are left alone
+    reaper.reap_all()
+    assert os.listdir(reaper._archive_dir) == ["b-2.tar.gz"]
@@ -0,0 +1,65 @@
+import threading
+import time
+
+import pytest
+
+from chulai_agent import errors
+from chulai_agent.clients import supervisor_client
+from chulai_agent.instance.reloader import ReloadCoalescer
+
+
+class Supervisor(object):
+    """records multicall batches, answers them with ``reload_result``"""
+
+    def __init__(self, latency=0, reload_result=True):
+        self.batches = []
+        self.latency = latency
+        self.reload_result = reload_result
+
+    def multicall(self, calls):
+        self.batches.append(calls)
+        time.sleep(self.latency)
+        return [self.reload_result] + [True] * (len(calls) - 1)
+
+
+@pytest.fixture
+def reloader(agent):
+    reloader = ReloadCoalescer()
+    reloader._window = 5
+    return reloader
+
+
+def test_lone_change_does_not_wait(reloader, monkeypatch):
+    supervisor = Supervisor()
+    monkeypatch.setattr(supervisor_client, "multicall", supervisor.multicall)
+    started = time.time()
+    reloader.add("lone")
+    assert time.time() - started < 1
+    assert supervisor.batches == [
+        [("reloadConfig", ()), ("addProcessGroup", ("lone",))]
+    ]
+
+
+def test_changes_made_while_applying_are_batched(reloader, monkeypatch):
+    supervisor = Supervisor(latency=0.2)
+    monkeypatch.setattr(supervisor_client, "multicall", supervisor.multicall)
+    reloader._window = 0
+    threads = [
+        threading.Thread(target=reloader.add, args=("g{0}".format(index),))
+        for index in range(6)
+    ]
+    for thread in threads:
+        thread.start()
+        time.sleep(0.01)
+    for thread in threads:
+        thread.join()
+    assert len(supervisor.batches) == 2
+    assert sum(len(batch) - 1 for batch in supervisor.batches) == 6
+
+
+def test_failed_reload_fails_the_batch(reloader, monkeypatch):
+    supervisor = Supervisor(reload_result=errors.AgentError("bad conf"))
+    monkeypatch.setattr(supervisor_client, "multicall", supervisor.multicall)
+    with pytest.raises(errors.AgentError) as exc_info:
+        reloader.add("broken")
+    assert "bad conf" in exc_info.value.message
@@ -0,0 +1,55 @@
+import json
+import threading
+
+from chulai_agent.clients import supervisor_client
+from chulai_agent.instance.sampler import metrics_sampler
+
+import run
+
+
+def seed(agent):
+    instance_id = agent.new_id()
+    run.seed(agent.host, [instance_id])
+    # deployed behind the back of the cached process listing
+    supervisor_client.invalidate()
+    return instance_id
+
+
+def test_samples_are_shared(agent):
+    instance_id = seed(agent)
+    # the first pass only primes new processes
+    metrics_sampler.sample_all()
+    metrics_sampler.sample_all()
+
+    samples = []
+    reader = threading.Thread(
+        target=lambda: samples.append(metrics_sampler.latest(instance_id))
+    )
+    reader.start()
+    reader.join()
+    assert samples[0] is not None
+    assert samples[0]["cpu_percent"] is not None
+    assert instance_id in metrics_sampler.latest_all()
+
+    response = agent.client.get(
+        "/instances/{0}?window=60".format(instance_id)
+    )
+    assert response.status_code == 200
+    body = json.loads(response.data.decode("utf-8"))
+    assert "stale" not in body["stats"]
+    assert body["history"]
+    assert set(body["history"][-1]) == set(
+        metrics_sampler.history(instance_id, 0)[-1]
+    )
+
+
+def test_gone_instances_are_dropped(agent):
+    instance_id = seed(agent)
+    metrics_sampler.sample_all()
+    metrics_sampler.sample_all()
+    assert metrics_sampler.latest(instance_id) is not None
+
+    agent.wait_job(agent.client.delete("/instances/{0}".format(instance_id)))
+    supervisor_client.invalidate()
+    metrics_sampler.sample_all()
+    assert metrics_sampler.latest(instance_id) is None